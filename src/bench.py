@@ -0,0 +1,311 @@
+import os
+import random
+import socket
+import subprocess
+import tempfile
+import time
+from threading import Thread
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+from src.netsim import Impairments, ImpairmentProxy
+
+# The scenarios of infra/testall, run through the emulator in src/netsim.py
+# rather than through tc, so they need no root and come out the same on any
+# box, given the same seed.
+
+SEND = "./4254send"
+RECV = "./4254recv"
+
+# As in infra/nettest.
+SIZES = {
+    "small": 1000,
+    "medium": 10000,
+    "large": 100000,
+    "huge": 1000000,
+}
+DEFAULT_TIMEOUT = 30  # seconds
+# How long the receiver gets to finish once the sender has.
+RECEIVER_GRACE = 5  # seconds
+
+BASIC = "basic"
+ADVANCED = "advanced"
+PERFORMANCE = "performance"
+GROUPS = (BASIC, ADVANCED, PERFORMANCE)
+
+
+class Scenario(NamedTuple):
+    group: str
+    name: str
+    size: str
+    impairments: Impairments
+    timeout: float = DEFAULT_TIMEOUT
+
+
+def _performance(
+    bandwidth: float, latency: float, drop: float, duplicate: float, delay: float, size
+) -> Scenario:
+    return Scenario(
+        PERFORMANCE,
+        f"{size} {bandwidth} Mb/s, {latency} ms, {drop}% drop, "
+        f"{duplicate}% duplicate {delay}% delay",
+        size,
+        Impairments(
+            bandwidth=bandwidth,
+            latency=latency,
+            drop=drop,
+            duplicate=duplicate,
+            delay=delay,
+        ),
+        # testall leaves nettest's default.
+        DEFAULT_TIMEOUT,
+    )
+
+
+SCENARIOS = [
+    Scenario(BASIC, "Small 1 Mb/s, 10 ms latency", "small", Impairments()),
+    Scenario(
+        BASIC, "Small 0.1 Mb/s 10 ms latency", "small", Impairments(bandwidth=0.1)
+    ),
+    Scenario(
+        BASIC,
+        "Small 0.1 Mb/s 50 ms latency",
+        "small",
+        Impairments(bandwidth=0.1, latency=50),
+    ),
+    Scenario(BASIC, "Medium 1 Mb/s, 10 ms latency", "medium", Impairments()),
+    Scenario(
+        BASIC, "Medium 0.1 Mb/s 10 ms latency", "medium", Impairments(bandwidth=0.1)
+    ),
+    Scenario(
+        BASIC,
+        "Medium 0.1 Mb/s 50 ms latency",
+        "medium",
+        Impairments(bandwidth=0.1, latency=50),
+    ),
+    Scenario(BASIC, "Large 1 Mb/s, 10 ms latency", "large", Impairments()),
+    Scenario(
+        BASIC, "Large 0.5 Mb/s 10 ms latency", "large", Impairments(bandwidth=0.5)
+    ),
+    Scenario(
+        BASIC,
+        "Large 0.1 Mb/s 500 ms latency",
+        "large",
+        Impairments(bandwidth=0.1, latency=500),
+    ),
+    Scenario(
+        ADVANCED,
+        "Small 1Mb/s, 10 ms, 100% duplicate",
+        "small",
+        Impairments(duplicate=100),
+        15,
+    ),
+    Scenario(
+        ADVANCED,
+        "Medium 1Mb/s, 10 ms, 50% reorder 10% drop",
+        "medium",
+        Impairments(drop=10, reorder=50),
+        30,
+    ),
+    Scenario(
+        ADVANCED, "Medium 1Mb/s, 10 ms, 50% drop", "medium", Impairments(drop=50), 30
+    ),
+    Scenario(
+        ADVANCED,
+        "Medium 1Mb/s, 10 ms, 50% delay 25% duplicate",
+        "medium",
+        Impairments(delay=50, duplicate=25),
+        30,
+    ),
+    Scenario(
+        ADVANCED,
+        "Medium 5Mb/s, 10 ms, 5% delay 5% duplicate 5% drop",
+        "medium",
+        Impairments(bandwidth=5, delay=5, duplicate=5, drop=5),
+        30,
+    ),
+    Scenario(
+        ADVANCED,
+        "Large 1Mb/s, 10 ms, 10% delay 10% duplicate",
+        "large",
+        Impairments(delay=10, duplicate=10),
+        30,
+    ),
+    Scenario(
+        ADVANCED,
+        "Large 10Mb/s, 10ms, 1% delay 1% duplicate 1% drop",
+        "large",
+        Impairments(bandwidth=10, delay=1, drop=1, duplicate=1),
+        60,
+    ),
+    _performance(5, 10, 0, 0, 0, "huge"),
+    _performance(5, 10, 10, 0, 0, "large"),
+    _performance(5, 50, 10, 0, 0, "large"),
+    _performance(10, 25, 10, 10, 20, "large"),
+]
+
+
+def generate_input(size: int, rng: random.Random) -> bytes:
+    """
+    Random 7 bit bytes, control characters and NUL included, as nettest
+    generates its input, but from a seeded generator.
+    """
+
+    return bytes(rng.getrandbits(7) for _ in range(size))
+
+
+def perf_score(goodput: float, bandwidth: float, latency: float, drop: float) -> int:
+    """
+    testall's score out of 100 for a goodput in bits per second.
+    """
+
+    bandwidth = bandwidth * 1000 * 1000
+    minimum = min(2100000 * (1 + drop / 100) / latency, bandwidth / 2)
+    target = bandwidth * 2 / 4
+
+    if goodput < minimum:
+        return 0
+    if goodput > target:
+        return 100
+    return int((goodput - minimum) * 100 / (target - minimum))
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_scenario(
+    scenario: Scenario,
+    seed: int = 0,
+    send_args: Sequence[str] = (),
+    recv_args: Sequence[str] = (),
+    pipe: bool = False,
+) -> Dict:
+    """
+    Sends a scenario's input from 4254send to 4254recv through the emulator,
+    and returns what happened: whether the output matched, how long it took
+    from starting the receiver until both had exited, as nettest times it,
+    and what each end put on the wire.
+
+    The sender reads its input from a file, as under nettest, unless pipe is
+    set, when it's piped in instead. A pipe can't be mapped, so the sender
+    then keeps its packets in its send buffer, which files never exercise.
+    """
+
+    data = generate_input(SIZES[scenario.size], random.Random(seed))
+    port = free_port()
+    proxy = ImpairmentProxy(("127.0.0.1", port), scenario.impairments, seed=seed)
+    proxy.start()
+
+    error: Optional[str] = None
+    with tempfile.TemporaryFile() as input_file, tempfile.TemporaryFile() as output:
+        input_file.write(data)
+        input_file.seek(0)
+
+        start = time.monotonic()
+        recv = subprocess.Popen(
+            [RECV, str(port)] + list(recv_args),
+            stdout=output,
+            stderr=subprocess.DEVNULL,
+        )
+        send = subprocess.Popen(
+            [SEND, f"127.0.0.1:{proxy.port}"] + list(send_args),
+            stdin=subprocess.PIPE if pipe else input_file,
+            stderr=subprocess.DEVNULL,
+        )
+        if pipe:
+            Thread(target=_feed, args=(send.stdin, data), daemon=True).start()
+        try:
+            send.wait(scenario.timeout)
+            recv.wait(RECEIVER_GRACE)
+        except subprocess.TimeoutExpired:
+            error = "timed out"
+        elapsed = time.monotonic() - start
+
+        for process in (send, recv):
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+        proxy.stop()
+        output.seek(0)
+        matched = output.read() == data
+
+    if error is None and send.returncode != 0:
+        error = f"4254send exited with {send.returncode}"
+    elif error is None and recv.returncode != 0:
+        error = f"4254recv exited with {recv.returncode}"
+    elif error is None and not matched:
+        error = "data mismatch"
+
+    stats = proxy.stats()
+    goodput = 8 * len(data) / elapsed
+    impairments = scenario.impairments
+    score = 0
+    if error is None:
+        score = perf_score(
+            goodput, impairments.bandwidth, impairments.latency, impairments.drop
+        )
+    return {
+        "group": scenario.group,
+        "name": scenario.name,
+        "seed": seed,
+        "passed": error is None,
+        "error": error,
+        "size": len(data),
+        "time": elapsed,
+        # In bits per second, as testall has it.
+        "goodput": goodput,
+        "score": score,
+        "packets": stats["forward"]["packets"],
+        "acks": stats["backward"]["packets"],
+        "wire_bytes": stats["forward"]["bytes"] + stats["backward"]["bytes"],
+        "link": stats,
+    }
+
+
+def _feed(stream, data: bytes):
+    try:
+        stream.write(data)
+        stream.close()
+    except BrokenPipeError:
+        # The sender gave up before reading all of it.
+        pass
+
+
+def select_scenarios(
+    groups: Sequence[str] = GROUPS, match: Optional[str] = None
+) -> List[Scenario]:
+    return [
+        scenario
+        for scenario in SCENARIOS
+        if scenario.group in groups
+        and (match is None or match.lower() in scenario.name.lower())
+    ]
+
+
+def format_result(result: Dict) -> str:
+    status = "[ PASS ]" if result["passed"] else "[ FAIL ]"
+    line = (
+        f"  {result['name'][:56]:<58}{status} {result['time']:7.3f}s "
+        f"{format_bits(result['goodput'])}b/s {result['wire_bytes']:>9} B on wire "
+        f"{result['packets']:>6} pkts {result['acks']:>6} acks"
+    )
+    if result["group"] == PERFORMANCE and result["passed"]:
+        line += f" score {result['score']}"
+    if not result["passed"]:
+        line += f" ({result['error']})"
+    return line
+
+
+def format_bits(bits: float) -> str:
+    for unit in ("", "K", "M"):
+        if bits < 1000:
+            return f"{bits:6.1f}{unit}"
+        bits /= 1000
+    return f"{bits:6.1f}G"
+
+
+def in_repository() -> bool:
+    return os.path.exists(SEND) and os.path.exists(RECV)
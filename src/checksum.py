@@ -1,35 +1,65 @@
-import json
+import hashlib
 import zlib
-from typing import Dict
+from typing import Callable, Dict, NamedTuple
 
-from src.constants import CHECKSUM
+# Checksums are always computed over the exact bytes that go on the wire, once
+# when a datagram is encoded and once when it is received. Everything here
+# accepts any bytes-like object, so received datagrams can be verified through
+# a memoryview without copying them.
 
+CRC32 = "crc32"
+ADLER32 = "adler32"
+BLAKE2B = "blake2b"
 
-def compute_checksum(packet: Dict) -> int:
-    """
-    Computes a checksum for the packet and returns it.
 
-    Note that this mutates the input packet, to set `cksum` to None.
-    However, it does NOT set the cksum field to the computed value.
+class ChecksumAlgorithm(NamedTuple):
+    # Name used on the command line and in JSON packets.
+    name: str
+    # Identifier used in the binary header.
+    ident: int
+    # Size of the digest in bytes.
+    size: int
+    digest: Callable[[bytes], bytes]
+
+
+def _crc32(data) -> bytes:
+    return zlib.crc32(data).to_bytes(4, "big")
+
+
+def _adler32(data) -> bytes:
+    # Cheaper than CRC32, at the cost of weaker detection on short payloads.
+    return zlib.adler32(data).to_bytes(4, "big")
+
+
+def _blake2b(data) -> bytes:
+    # Stronger than CRC32 and twice as wide, at a higher CPU cost.
+    return hashlib.blake2b(data, digest_size=8).digest()
+
+
+ALGORITHMS: Dict[str, ChecksumAlgorithm] = {
+    CRC32: ChecksumAlgorithm(CRC32, 1, 4, _crc32),
+    ADLER32: ChecksumAlgorithm(ADLER32, 2, 4, _adler32),
+    BLAKE2B: ChecksumAlgorithm(BLAKE2B, 3, 8, _blake2b),
+}
+ALGORITHMS_BY_IDENT: Dict[int, ChecksumAlgorithm] = {
+    algorithm.ident: algorithm for algorithm in ALGORITHMS.values()
+}
+
+
+def compute_checksum(data, algorithm: str = CRC32) -> bytes:
+    """
+    Computes the checksum of the given bytes and returns the digest.
     """
 
-    packet[CHECKSUM] = None
-    return zlib.crc32(json.dumps(packet).encode())
+    return ALGORITHMS[algorithm].digest(data)
 
 
-def verify_checksum(packet: Dict) -> bool:
+def verify_checksum(data, expected, algorithm: str = CRC32) -> bool:
     """
-    Checks the packet against the expected checksum and returns true if they
+    Checks the given bytes against the expected digest and returns true if they
     match.
 
-    Note that this mutates packet to set `cksum` to None.
+    Neither argument is modified, and both may be memoryviews.
     """
 
-    try:
-        actual_checksum = packet[CHECKSUM]
-        packet[CHECKSUM] = None
-        expected_checksum = zlib.crc32(json.dumps(packet).encode())
-        return expected_checksum == actual_checksum
-    except KeyError:
-        # The packet has no checksum field, so it by default doesn't match.
-        return False
+    return ALGORITHMS[algorithm].digest(data) == expected
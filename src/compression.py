@@ -0,0 +1,154 @@
+import time
+import zlib
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+from src.logging import get_logger
+from src.pacing import Pacer
+
+# Payloads are compressed one packet at a time, as raw deflate streams: every
+# packet has to be decompressible on its own, whatever order packets arrive
+# in and whichever of them are lost, so there's no dictionary shared across
+# packets. The checksum already covers the payload, so zlib's own header and
+# trailer would only take up room.
+
+WINDOW_BITS = -15
+# The fastest level; the higher ones barely do better on 1KB payloads.
+LEVEL = 1
+# The most a payload may decompress to, which is also the most an
+# uncompressed one can hold.
+MAX_PAYLOAD = 0xFFFF
+
+# Compressing a payload is only worth it if it saves at least this much of it.
+MIN_SAVING = 1 / 16
+# Payloads this small aren't worth the bother.
+MIN_SIZE = 64  # bytes
+# After a payload that wasn't worth compressing, this many are sent as they are
+# before the next one is tried, doubling every time it still isn't worth it.
+MIN_BACKOFF = 8  # packets
+MAX_BACKOFF = 256  # packets
+
+
+def deflate(data: bytes, level: int = LEVEL) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WINDOW_BITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def inflate(data: bytes) -> Optional[bytes]:
+    """
+    Decompresses a payload, or returns None if it isn't valid, or would
+    decompress to more than MAX_PAYLOAD bytes.
+    """
+
+    decompressor = zlib.decompressobj(WINDOW_BITS)
+    try:
+        payload = decompressor.decompress(data, MAX_PAYLOAD)
+    except zlib.error:
+        return None
+
+    if not decompressor.eof or len(decompressor.unconsumed_tail) > 0:
+        return None
+    return payload
+
+
+class Compressor:
+    """
+    Decides, payload by payload, whether to send it compressed.
+
+    A payload is compressed when that pays off: when it shrinks by at least
+    MIN_SAVING, and the time the bytes saved would take on the link, at the
+    bottleneck bandwidth the pacer has estimated, is more than the time it
+    took to compress them. So compressible input is compressed on slow links,
+    but not on ones fast enough that the CPU is the bottleneck, nor when the
+    input doesn't compress, say, because it's compressed already.
+
+    Whenever a payload isn't worth compressing, the next few are sent as they
+    are without even trying, backing off exponentially, so that the cost of
+    finding out again is small.
+    """
+
+    def __init__(self, pacer: Optional[Pacer] = None, enabled: bool = True):
+        self.lock = Lock()
+        self.enabled = enabled
+        self.pacer = pacer
+
+        # How many payloads to send as they are before trying again, and how
+        # many to skip the next time it isn't worth it.
+        self.skip = 0
+        self.backoff = MIN_BACKOFF
+
+        # For the stats.
+        self.payloads = 0
+        self.tried = 0
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compress_time = 0.0
+
+        self.logger = get_logger("[4254send] Compressor")
+
+    def compress(self, data: bytes) -> Tuple[bytes, bool]:
+        """
+        Returns the payload to send for data, and whether it's compressed.
+        """
+
+        if not self.enabled:
+            return (data, False)
+
+        with self.lock:
+            self.payloads += 1
+            if len(data) < MIN_SIZE or self.skip > 0:
+                self.skip = max(self.skip - 1, 0)
+                self.__count(len(data), len(data))
+                return (data, False)
+
+        start = time.perf_counter()
+        compressed = deflate(data)
+        elapsed = time.perf_counter() - start
+
+        saved = len(data) - len(compressed)
+
+        with self.lock:
+            self.tried += 1
+            self.compress_time += elapsed
+
+            if self.__worth_it(len(data), saved, elapsed):
+                self.backoff = MIN_BACKOFF
+            else:
+                self.skip = self.backoff
+                self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+
+            if saved <= 0:
+                # It's been compressed already, so it might as well go as it is.
+                self.__count(len(data), len(data))
+                return (data, False)
+
+            self.compressed += 1
+            self.__count(len(data), len(compressed))
+            return (compressed, True)
+
+    def __worth_it(self, size: int, saved: int, elapsed: float) -> bool:
+        if saved < size * MIN_SAVING:
+            return False
+
+        bandwidth = None if self.pacer is None else self.pacer.bandwidth
+        if bandwidth is None:
+            # No idea how fast the link is yet, so assume it's slow.
+            return True
+        return saved / bandwidth > elapsed
+
+    def __count(self, size: int, sent: int):
+        self.bytes_in += size
+        self.bytes_out += sent
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "payloads": self.payloads,
+                "tried": self.tried,
+                "compressed": self.compressed,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "compress_time": self.compress_time,
+            }
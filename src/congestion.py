@@ -0,0 +1,302 @@
+import time
+from abc import ABC, abstractmethod
+from threading import Condition
+from typing import Callable, Dict, Type
+
+from src.logging import get_logger
+
+NEWRENO = "newreno"
+CUBIC = "cubic"
+NONE = "none"
+
+INITIAL_WINDOW = 10  # packets
+# RFC 6928's cap on the initial window in bytes, for packets bigger than ours
+# were when INITIAL_WINDOW was picked.
+INITIAL_WINDOW_BYTES = 14600
+MINIMUM_WINDOW = 4  # packets
+WAIT_FOR_WINDOW_TIMEOUT = 0.05  # seconds
+
+
+class CongestionController(ABC):
+    """
+    Base class for the congestion controllers that gate the socket writer.
+    Subclasses say how the window grows in congestion avoidance, and how it's
+    reduced on loss.
+
+    The window is counted in packets. Acks and loss signals come in from the
+    socket reader and timeout threads, and the socket writer blocks in
+    wait_for_window until there's room for another new packet in flight, so all
+    state is guarded by a single condition.
+    """
+
+    name = ""
+
+    def __init__(self, initial_window: int = INITIAL_WINDOW):
+        self.window_open = Condition()
+
+        self.cwnd: float = initial_window
+        self.ssthresh: float = float("inf")
+
+        # Highest packet number handed to the socket so far, and the value it
+        # had when we last reduced the window. Losses of packets sent before
+        # that point belong to the same loss episode and don't reduce the
+        # window again.
+        self.highest_sent = 0
+        self.recovery_point = 0
+        # Highest cumulatively acked packet number. Anything at or below it
+        # that is still queued doesn't need to be sent at all.
+        self.highest_acked = 0
+
+        # Every duplicate ack means a packet has left the network, even though
+        # the cumulative ack hasn't moved, so it makes room for one more packet
+        # until the next new ack.
+        self.inflation = 0
+
+        # How many packets past highest_acked the receiver is willing to buffer,
+        # as advertised in its acks. New packets beyond that aren't sent.
+        self.receive_window = float("inf")
+
+        # Retransmissions put into packets_to_send that the socket writer
+        # hasn't picked up yet. They must not get stuck behind a new packet
+        # that is waiting for the window to open.
+        self.retransmissions_queued = 0
+        # Set once the sender is quitting, so that nothing waits for the
+        # window to open any more: with the receiver gone, it never will.
+        self.quitting = False
+
+        self.logger = get_logger("[4254send] " + type(self).__name__)
+
+    @property
+    def window(self) -> int:
+        return max(int(self.cwnd), MINIMUM_WINDOW) + self.inflation
+
+    def wait_for_window(self, in_flight: Callable[[], int], pn: int) -> bool:
+        """
+        Blocks until fewer than window packets are in flight, and packet pn
+        fits in the receive window, and returns True.
+
+        Returns False early if a retransmission is queued in the meantime,
+        since those are sent regardless of the window, or if the sender is
+        quitting.
+        """
+
+        with self.window_open:
+            while not self.can_send(in_flight(), pn):
+                if self.retransmissions_queued > 0 or self.quitting:
+                    return False
+                self.window_open.wait(WAIT_FOR_WINDOW_TIMEOUT)
+
+            return True
+
+    def can_send(self, in_flight: int, pn: int) -> bool:
+        """
+        Whether new packet pn may be sent now, with in_flight packets in
+        flight. This is what wait_for_window waits for, for callers that can't
+        block.
+        """
+
+        with self.window_open:
+            return (
+                in_flight < self.window
+                and pn <= self.highest_acked + self.receive_window
+            )
+
+    def on_retransmission_queued(self):
+        with self.window_open:
+            self.retransmissions_queued += 1
+            self.window_open.notify_all()
+
+    def on_quit(self):
+        with self.window_open:
+            self.quitting = True
+            self.window_open.notify_all()
+
+    def on_retransmission_dequeued(self):
+        with self.window_open:
+            self.retransmissions_queued = max(self.retransmissions_queued - 1, 0)
+
+    def on_packet_sent(self, pn: int):
+        with self.window_open:
+            self.highest_sent = max(self.highest_sent, pn)
+
+    def on_receive_window(self, receive_window: int):
+        with self.window_open:
+            self.receive_window = receive_window
+            self.window_open.notify_all()
+
+    def on_ack(self, apn: int, acked: int):
+        """
+        Called when a cumulative ack for apn acknowledges acked new packets.
+        """
+
+        with self.window_open:
+            self.highest_acked = max(self.highest_acked, apn)
+            self.inflation = 0
+
+            if self.cwnd < self.ssthresh:
+                # Slow start
+                self.cwnd += acked
+            else:
+                self._congestion_avoidance(acked)
+
+            self.window_open.notify_all()
+
+    def on_selective_ack(self):
+        """
+        Called when SACKs show packets have left the network; they have
+        already been taken out of outstanding_packets.
+        """
+
+        with self.window_open:
+            self.window_open.notify_all()
+
+    def on_duplicate_ack(self):
+        with self.window_open:
+            self.inflation += 1
+            self.window_open.notify_all()
+
+    def on_loss(self, pn: int, timeout: bool):
+        """
+        Called when packet pn is presumed lost, either from duplicate acks or
+        from a timeout.
+        """
+
+        with self.window_open:
+            if pn > self.recovery_point:
+                self.recovery_point = self.highest_sent
+                self._reduce_window()
+            if timeout:
+                # Nothing came back for a whole RTO, so nothing is known about
+                # what the path can take any more: start again from the
+                # minimum window and slow start up to ssthresh (RFC 5681, 3.1).
+                # This holds even inside a loss episode, where it means
+                # recovery itself has stalled.
+                self.cwnd = MINIMUM_WINDOW
+
+            self.logger.debug(
+                "Loss of packet %s, cwnd %.1f ssthresh %.1f",
+                pn,
+                self.cwnd,
+                self.ssthresh,
+            )
+
+            # Packets presumed lost are no longer in flight.
+            self.window_open.notify_all()
+
+    @abstractmethod
+    def _congestion_avoidance(self, acked: int):
+        """
+        Grows the window for acked newly acked packets, once past slow start.
+        Called with window_open held.
+        """
+
+    @abstractmethod
+    def _reduce_window(self):
+        """
+        Reduces the window on the first loss of a loss episode. Called with
+        window_open held.
+        """
+
+
+class NewReno(CongestionController):
+    """
+    Classic AIMD: grow by one packet per window of acks, halve on loss.
+    """
+
+    name = NEWRENO
+
+    def _congestion_avoidance(self, acked: int):
+        self.cwnd += acked / self.cwnd
+
+    def _reduce_window(self):
+        self.ssthresh = max(self.cwnd / 2, MINIMUM_WINDOW)
+        self.cwnd = self.ssthresh
+
+
+class Cubic(CongestionController):
+    """
+    CUBIC-style growth: the window follows a cubic function of the time since
+    the last loss, centred on the window at which that loss happened.
+    """
+
+    name = CUBIC
+
+    C = 0.4
+    BETA = 0.7
+
+    def __init__(self, initial_window: int = INITIAL_WINDOW):
+        super().__init__(initial_window)
+
+        # Window just before the last reduction.
+        self.w_max: float = 0
+        # Time of the last reduction.
+        self.epoch_start = time.monotonic()
+
+    def _congestion_avoidance(self, acked: int):
+        t = time.monotonic() - self.epoch_start
+        k = (self.w_max * (1 - self.BETA) / self.C) ** (1 / 3)
+        target = self.C * (t - k) ** 3 + self.w_max
+
+        cubic_increase = acked * max(target - self.cwnd, 0) / self.cwnd
+        # Never grow slower than Reno would.
+        reno_increase = acked / self.cwnd
+
+        self.cwnd += max(cubic_increase, reno_increase)
+
+    def _reduce_window(self):
+        self.w_max = self.cwnd
+        self.epoch_start = time.monotonic()
+        self.ssthresh = max(self.cwnd * self.BETA, MINIMUM_WINDOW)
+        self.cwnd = self.ssthresh
+
+
+class Unlimited(CongestionController):
+    """
+    No congestion control at all: send as fast as the queue allows.
+    """
+
+    name = NONE
+
+    @property
+    def window(self) -> int:
+        return 2**31
+
+    def on_ack(self, apn: int, acked: int):
+        # There's no window to grow, but the receive window still counts from
+        # the cumulative ack.
+        with self.window_open:
+            self.highest_acked = max(self.highest_acked, apn)
+            self.window_open.notify_all()
+
+    def on_loss(self, pn: int, timeout: bool):
+        pass
+
+    def _congestion_avoidance(self, acked: int):
+        # Never called, as on_ack and on_loss are overridden.
+        pass
+
+    def _reduce_window(self):
+        pass
+
+
+CONTROLLERS: Dict[str, Type[CongestionController]] = {
+    NEWRENO: NewReno,
+    CUBIC: Cubic,
+    NONE: Unlimited,
+}
+
+
+def initial_window(data_size: int) -> int:
+    """
+    The initial window for packets with data_size byte payloads: as many as
+    INITIAL_WINDOW_BYTES allows, but at least two, and no more than
+    INITIAL_WINDOW.
+    """
+
+    return min(max(INITIAL_WINDOW_BYTES // data_size, 2), INITIAL_WINDOW)
+
+
+def create_controller(
+    name: str, initial_window: int = INITIAL_WINDOW
+) -> CongestionController:
+    return CONTROLLERS[name](initial_window)
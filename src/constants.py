@@ -6,3 +6,14 @@ END_OF_FILE = "eof"
 CHECKSUM = "cksum"
 ACKNOWLEDGED = "ack"
 QUIT = "quit"
+CHECKSUM_ALGORITHM = "cka"
+SELECTIVE_ACKS = "sack"
+RECEIVE_WINDOW = "wnd"
+REPAIR = "rep"
+REPAIR_LENGTH = "rlen"
+COMPRESSED = "cmp"
+CONNECTION_ID = "cid"
+CLOSE = "close"
+HELLO = "hello"
+PROBE = "probe"
+MAX_DATAGRAM = "mdg"
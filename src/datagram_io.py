@@ -0,0 +1,356 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import socket
+import struct
+from typing import Dict, List, Sequence, Tuple, Type
+
+from src.logging import get_logger
+
+AUTO = "auto"
+PLAIN = "plain"
+MMSG = "mmsg"
+GSO = "gso"
+BACKENDS = (AUTO, PLAIN, MMSG, GSO)
+
+# The most datagrams sent or received in one system call. Also the kernel's
+# limit on segments per UDP GSO send.
+MAX_BATCH = 64
+
+# Not exported by the socket module. From linux/udp.h.
+SOL_UDP = 17
+UDP_SEGMENT = 103
+UDP_GRO = 104
+# The largest UDP payload, which a GSO send or GRO receive can't exceed.
+MAX_UDP_PAYLOAD = 65507
+
+Address = Tuple[str, int]
+
+logger = get_logger("[4254] datagram_io")
+
+
+class DatagramIO:
+    """
+    Sends and receives datagrams on a UDP socket, one system call per datagram.
+
+    This is the portable fallback; the other backends send and receive whole
+    batches per system call. All of them follow the socket's timeout: a
+    blocking socket waits, one with a timeout raises TimeoutError when it runs
+    out, and a non-blocking one raises BlockingIOError when nothing could be
+    done at all.
+    """
+
+    name = PLAIN
+
+    def __init__(self, sock: socket.socket, message_size: int):
+        self.sock = sock
+        self.message_size = message_size
+
+    def send_batch(self, datagrams: Sequence[bytes], address: Address) -> int:
+        """
+        Sends the datagrams to address, in order, and returns how many were
+        sent. Fewer than all of them are only sent if the socket is
+        non-blocking and its buffer filled up.
+        """
+
+        sent = 0
+        for datagram in datagrams:
+            try:
+                self.sock.sendto(datagram, address)
+            except BlockingIOError:
+                if sent == 0:
+                    raise
+                break
+            sent += 1
+
+        return sent
+
+    def recv_batch(self) -> List[Tuple[bytes, Address]]:
+        """
+        Waits for at least one datagram, and returns it along with any others
+        that can be had from the same system call.
+        """
+
+        return [self.sock.recvfrom(self.message_size)]
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _msghdr), ("msg_len", ctypes.c_uint)]
+
+
+# Big enough for any socket address (struct sockaddr_storage).
+_SockaddrStorage = ctypes.c_char * 128
+
+
+def _encode_address(family: int, address: Address) -> bytes:
+    (host, port) = address[:2]
+    if family == socket.AF_INET6:
+        host_bytes = socket.inet_pton(family, host)
+        return struct.pack("=H", family) + struct.pack("!HI", port, 0) + host_bytes
+    host_bytes = socket.inet_aton(socket.gethostbyname(host))
+    return struct.pack("=H", family) + struct.pack("!H", port) + host_bytes + bytes(8)
+
+
+def _decode_address(raw: bytes) -> Address:
+    (family,) = struct.unpack_from("=H", raw)
+    (port,) = struct.unpack_from("!H", raw, 2)
+    if family == socket.AF_INET6:
+        return (socket.inet_ntop(family, raw[8:24]), port)
+    return (socket.inet_ntoa(raw[4:8]), port)
+
+
+class MmsgIO(DatagramIO):
+    """
+    Sends and receives up to MAX_BATCH datagrams per system call with Linux's
+    sendmmsg and recvmmsg, called through ctypes. The receive buffers and the
+    message headers pointing at them are allocated once, up front.
+    """
+
+    name = MMSG
+
+    def __init__(self, sock: socket.socket, message_size: int):
+        super().__init__(sock, message_size)
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        # Raises AttributeError where they don't exist.
+        self.sendmmsg = libc.sendmmsg
+        self.recvmmsg = libc.recvmmsg
+        self.sendmmsg.argtypes = [
+            ctypes.c_int,
+            ctypes.POINTER(_mmsghdr),
+            ctypes.c_uint,
+            ctypes.c_int,
+        ]
+        self.recvmmsg.argtypes = [
+            ctypes.c_int,
+            ctypes.POINTER(_mmsghdr),
+            ctypes.c_uint,
+            ctypes.c_int,
+            ctypes.c_void_p,
+        ]
+
+        self.send_iovecs = (_iovec * MAX_BATCH)()
+        self.send_msgs = (_mmsghdr * MAX_BATCH)()
+        self.destinations: Dict[Address, ctypes.Array] = {}
+        for i in range(MAX_BATCH):
+            self.send_msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.send_iovecs[i])
+            self.send_msgs[i].msg_hdr.msg_iovlen = 1
+
+        self.recv_buffers = [
+            ctypes.create_string_buffer(message_size) for _ in range(MAX_BATCH)
+        ]
+        self.recv_names = (_SockaddrStorage * MAX_BATCH)()
+        self.recv_iovecs = (_iovec * MAX_BATCH)()
+        self.recv_msgs = (_mmsghdr * MAX_BATCH)()
+        for i in range(MAX_BATCH):
+            self.recv_iovecs[i].iov_base = ctypes.addressof(self.recv_buffers[i])
+            self.recv_iovecs[i].iov_len = message_size
+            header = self.recv_msgs[i].msg_hdr
+            header.msg_name = ctypes.addressof(self.recv_names[i])
+            header.msg_namelen = ctypes.sizeof(_SockaddrStorage)
+            header.msg_iov = ctypes.pointer(self.recv_iovecs[i])
+            header.msg_iovlen = 1
+
+    def send_batch(self, datagrams: Sequence[bytes], address: Address) -> int:
+        if len(datagrams) == 1:
+            # Setting up the headers through ctypes costs more than it saves.
+            return super().send_batch(datagrams, address)
+
+        destination = self.destinations.get(address)
+        if destination is None:
+            raw = _encode_address(self.sock.family, address)
+            destination = ctypes.create_string_buffer(raw, len(raw))
+            self.destinations[address] = destination
+
+        sent = 0
+        while sent < len(datagrams):
+            batch = datagrams[sent : sent + MAX_BATCH]
+            # Keeps the buffers alive until sendmmsg has copied them.
+            pointers = [ctypes.c_char_p(bytes(datagram)) for datagram in batch]
+            for (i, pointer) in enumerate(pointers):
+                self.send_iovecs[i].iov_base = ctypes.cast(pointer, ctypes.c_void_p)
+                self.send_iovecs[i].iov_len = len(batch[i])
+                header = self.send_msgs[i].msg_hdr
+                header.msg_name = ctypes.addressof(destination)
+                header.msg_namelen = len(destination)
+
+            count = self.__call(
+                lambda: self.sendmmsg(
+                    self.sock.fileno(), self.send_msgs, len(batch), socket.MSG_DONTWAIT
+                ),
+                writing=True,
+                give_up=sent > 0,
+            )
+            if count == 0:
+                break
+            sent += count
+
+        return sent
+
+    def recv_batch(self) -> List[Tuple[bytes, Address]]:
+        count = self.__call(
+            lambda: self.recvmmsg(
+                self.sock.fileno(), self.recv_msgs, MAX_BATCH, socket.MSG_DONTWAIT, None
+            ),
+            writing=False,
+            give_up=False,
+        )
+
+        batch = []
+        for i in range(count):
+            header = self.recv_msgs[i].msg_hdr
+            batch.append(
+                (
+                    ctypes.string_at(self.recv_buffers[i], self.recv_msgs[i].msg_len),
+                    _decode_address(self.recv_names[i].raw[: header.msg_namelen]),
+                )
+            )
+            header.msg_namelen = ctypes.sizeof(_SockaddrStorage)
+
+        return batch
+
+    def __call(self, syscall, writing: bool, give_up: bool) -> int:
+        """
+        Makes the non-blocking system call, waiting for the socket to become
+        ready as its timeout allows while it would block. Returns 0 instead if
+        give_up is set, since some of the work is already done by then.
+        """
+
+        while True:
+            count = syscall()
+            if count >= 0:
+                return count
+
+            error = ctypes.get_errno()
+            if error == errno.EINTR:
+                continue
+            if error not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise OSError(error, os.strerror(error))
+            if give_up:
+                return 0
+
+            timeout = self.sock.gettimeout()
+            if timeout == 0:
+                raise BlockingIOError(error, os.strerror(error))
+
+            if writing:
+                (_, ready, _) = select.select([], [self.sock], [], timeout)
+            else:
+                (ready, _, _) = select.select([self.sock], [], [], timeout)
+            if len(ready) == 0:
+                raise TimeoutError("timed out")
+
+
+class GsoIO(DatagramIO):
+    """
+    Uses UDP generic segmentation offload: each run of consecutive datagrams of
+    the same size goes to the kernel as one buffer, split into datagrams on the
+    way out (the last one may be shorter). With generic receive offload, the
+    kernel likewise hands back runs of datagrams from the same sender as one
+    buffer, which is split again here.
+    """
+
+    name = GSO
+
+    def __init__(self, sock: socket.socket, message_size: int):
+        super().__init__(sock, message_size)
+
+        # Raise OSError on kernels without UDP GSO/GRO.
+        sock.setsockopt(SOL_UDP, UDP_SEGMENT, 0)
+        sock.setsockopt(SOL_UDP, UDP_GRO, 1)
+
+        self.control_size = socket.CMSG_SPACE(struct.calcsize("i"))
+
+    def send_batch(self, datagrams: Sequence[bytes], address: Address) -> int:
+        sent = 0
+        while sent < len(datagrams):
+            segment_size = len(datagrams[sent])
+            end = sent + 1
+            while (
+                end < len(datagrams)
+                and end - sent < min(MAX_BATCH, MAX_UDP_PAYLOAD // segment_size)
+                and len(datagrams[end - 1]) == segment_size
+                and len(datagrams[end]) <= segment_size
+            ):
+                end += 1
+
+            try:
+                if end - sent == 1:
+                    self.sock.sendto(datagrams[sent], address)
+                else:
+                    control = struct.pack("=H", segment_size)
+                    self.sock.sendmsg(
+                        datagrams[sent:end],
+                        [(SOL_UDP, UDP_SEGMENT, control)],
+                        0,
+                        address,
+                    )
+            except BlockingIOError:
+                if sent == 0:
+                    raise
+                break
+
+            sent = end
+
+        return sent
+
+    def recv_batch(self) -> List[Tuple[bytes, Address]]:
+        (data, control, _, address) = self.sock.recvmsg(
+            MAX_UDP_PAYLOAD, self.control_size
+        )
+
+        segment_size = len(data)
+        for (level, kind, value) in control:
+            if level == SOL_UDP and kind == UDP_GRO:
+                (segment_size,) = struct.unpack("=i", value[: struct.calcsize("i")])
+
+        if segment_size == 0 or segment_size >= len(data):
+            return [(data, address)]
+
+        return [
+            (data[offset : offset + segment_size], address)
+            for offset in range(0, len(data), segment_size)
+        ]
+
+
+BACKEND_CLASSES: Dict[str, Type[DatagramIO]] = {
+    PLAIN: DatagramIO,
+    MMSG: MmsgIO,
+    GSO: GsoIO,
+}
+
+
+def create_datagram_io(name: str, sock: socket.socket, message_size: int) -> DatagramIO:
+    """
+    Creates the named backend for sock, or for AUTO, the best one available.
+    Falls back to plain per-datagram calls if the backend isn't supported on
+    this system.
+    """
+
+    candidates = [MMSG, PLAIN] if name == AUTO else [name, PLAIN]
+
+    for candidate in candidates:
+        try:
+            return BACKEND_CLASSES[candidate](sock, message_size)
+        except (AttributeError, OSError) as e:
+            logger.info("Datagram I/O backend %s unavailable: %s", candidate, e)
+
+    return DatagramIO(sock, message_size)
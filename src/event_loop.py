@@ -0,0 +1,234 @@
+import os
+import selectors
+import socket
+import time
+from typing import List, Tuple
+
+from src.datagram_io import DatagramIO
+from src.input_reader import READ_CHUNKS, InputReader
+from src.logging import get_logger
+from src.scheduler import SendScheduler
+from src.socket_reader import SocketReader
+from src.socket_writer import SocketWriter
+from src.timeouts import MAX_TICK, Timeouts
+from src.timers import TimerQueue
+
+THREADS = "threads"
+EVENT_LOOP = "event-loop"
+ENGINES = (THREADS, EVENT_LOOP)
+
+
+class EventLoop:
+    """
+    Runs the sender in a single thread: reads STDIN, sends packets, reads acks
+    and fires retransmission timers from one non-blocking loop built on
+    selectors, instead of four threads handing work to each other.
+
+    The packet and ack logic is the same as the threaded sender's; this only
+    drives the InputReader, SocketWriter, SocketReader and Timeouts objects
+    through their non-blocking entry points.
+    """
+
+    def __init__(
+        self,
+        sock: socket.socket,
+        datagram_io: DatagramIO,
+        packets_to_send: SendScheduler,
+        input_reader: InputReader,
+        socket_writer: SocketWriter,
+        socket_reader: SocketReader,
+        timeouts: Timeouts,
+        timers: TimerQueue,
+    ):
+        self.sock = sock
+        self.datagram_io = datagram_io
+        self.packets_to_send = packets_to_send
+
+        self.input_reader = input_reader
+        self.socket_writer = socket_writer
+        self.socket_reader = socket_reader
+        self.timeouts = timeouts
+        self.timers = timers
+
+        self.selector = selectors.DefaultSelector()
+        self.input_fd = input_reader.stream.fileno()
+        # Regular files can't be polled, but are always readable anyway.
+        self.input_pollable = True
+        self.input_registered = False
+        self.input_nonblocking = False
+        self.input_done = False
+
+        # Whether we're waiting for the socket to drain before sending more.
+        self.socket_blocked = False
+        # When the pacer allows the next burst, if it's holding one back.
+        self.paced_until = None
+
+        # The threaded sender gives up once its socket has timed out waiting
+        # for acks; this gives up after just as long without any.
+        self.give_up_after = sock.gettimeout()
+        self.last_heard = time.monotonic()
+
+        self.logger = get_logger("[4254send] EventLoop")
+
+    def run(self):
+        """
+        Loop until the EOF ack arrives, or the timeouts give up waiting for it.
+        """
+
+        self.logger.info("Starting event loop.")
+
+        self.sock.setblocking(False)
+        self.selector.register(self.sock, selectors.EVENT_READ)
+
+        try:
+            self.__loop()
+        finally:
+            if self.input_registered:
+                self.selector.unregister(self.input_fd)
+            if self.input_nonblocking:
+                # STDIN may well be shared with other processes.
+                os.set_blocking(self.input_fd, True)
+            self.selector.close()
+
+        self.logger.info("Event loop finished.")
+        self.logger.info("FEC: %s", self.socket_writer.fec.stats())
+        self.logger.info("Send queue: %s", self.packets_to_send.stats())
+
+    def __loop(self):
+        while True:
+            self.__update_input_interest()
+            self.__send_queued()
+
+            events = self.selector.select(self.__timeout())
+
+            for (key, mask) in events:
+                if key.fd == self.input_fd:
+                    self.__read_input()
+                    continue
+
+                if mask & selectors.EVENT_WRITE:
+                    self.__set_socket_blocked(False)
+
+                if mask & selectors.EVENT_READ and not self.__read_acks():
+                    return
+
+            if not self.input_pollable and self.__wants_input():
+                self.__read_input()
+
+            if not self.timeouts.handle_expired(self.timers.pop_expired()):
+                return
+
+            if (
+                self.give_up_after is not None
+                and time.monotonic() - self.last_heard >= self.give_up_after
+            ):
+                # Nothing at all from the receiver for that long; it's gone.
+                self.logger.info(
+                    "Nothing from the receiver for %ss; quitting.", self.give_up_after
+                )
+                return
+
+    def __wants_input(self) -> bool:
+        # The loop can't block waiting for room in the send buffer, so it
+        # doesn't read STDIN until there is some. Waiting for room for a whole
+        # read keeps acks from trickling input in a packet at a time.
+        send_buffer = self.input_reader.send_buffer
+        wanted = min(READ_CHUNKS, send_buffer.capacity)
+        return not self.input_done and send_buffer.room() >= wanted
+
+    def __update_input_interest(self):
+        if not self.input_pollable:
+            return
+
+        wants_input = self.__wants_input()
+
+        if wants_input and not self.input_registered:
+            try:
+                self.selector.register(self.input_fd, selectors.EVENT_READ)
+            except PermissionError:
+                self.input_pollable = False
+                return
+
+            if not self.input_nonblocking:
+                os.set_blocking(self.input_fd, False)
+                self.input_nonblocking = True
+            self.input_registered = True
+        elif not wants_input and self.input_registered:
+            self.selector.unregister(self.input_fd)
+            self.input_registered = False
+
+    def __timeout(self) -> float:
+        """
+        How long select may block: until the next retransmission timer or the
+        next burst the pacer is holding back, and not at all while there's a
+        regular file to read.
+        """
+
+        if not self.input_pollable and self.__wants_input():
+            return 0
+
+        deadlines = [self.timers.next_deadline(), self.paced_until]
+        deadlines = [deadline for deadline in deadlines if deadline is not None]
+        if len(deadlines) == 0:
+            return MAX_TICK
+
+        return min(max(min(deadlines) - time.monotonic(), 0), MAX_TICK)
+
+    def __read_input(self):
+        if not self.input_reader.read_nonblocking():
+            self.input_done = True
+            self.logger.info("Read all of STDIN.")
+
+    def __read_acks(self) -> bool:
+        """
+        Handle every ack waiting on the socket. Returns False once the EOF ack
+        has arrived.
+        """
+
+        while True:
+            try:
+                received_data = self.datagram_io.recv_batch()
+            except BlockingIOError:
+                return True
+
+            self.last_heard = time.monotonic()
+            for (received_packet, _) in received_data:
+                if not self.socket_reader.handle_ack(received_packet):
+                    return False
+
+    def __send_queued(self):
+        """
+        Send queued retransmissions, and new packets while the windows allow,
+        in bursts, as fast as the pacer allows.
+        """
+
+        self.paced_until = None
+
+        while not self.socket_blocked:
+            now = time.monotonic()
+            delay = self.socket_writer.pacer.delay(now)
+            if delay > 0:
+                if len(self.packets_to_send) > 0:
+                    self.paced_until = now + delay
+                return
+
+            burst: List[Tuple[int, bytes]] = []
+            self.socket_writer.collect_burst(burst)
+
+            if len(burst) == 0:
+                # Either the queue is empty, or the rest has to wait for acks.
+                return
+
+            unsent = self.socket_writer.send_burst(burst)
+            if len(unsent) > 0:
+                self.packets_to_send.requeue(unsent)
+                self.__set_socket_blocked(True)
+                return
+
+    def __set_socket_blocked(self, blocked: bool):
+        self.socket_blocked = blocked
+
+        events = selectors.EVENT_READ
+        if blocked:
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(self.sock, events)
@@ -0,0 +1,260 @@
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+from src import checksum, wire
+from src.logging import get_logger
+from src.reorder_buffer import ReorderBuffer
+
+# The most and fewest packets one repair packet covers. The fewer, the more
+# losses can be repaired, and the more repair packets there are to send.
+MIN_GROUP = 2  # packets
+MAX_GROUP = 16  # packets
+# Below this loss rate, repair packets cost more than they're worth.
+MIN_LOSS_RATE = 0.01
+# Every packet sent moves the loss rate this much of the way towards 1 if it's
+# a retransmission, and towards 0 if it isn't.
+LOSS_GAIN = 1 / 32
+
+
+class RepairDatagram(bytes):
+    """
+    An encoded repair packet. The socket writer sends these along with the
+    data packets, but they're never acked, so they're never retransmitted.
+    """
+
+
+def xor_payload(accumulator: int, data: bytes, width: int) -> int:
+    """
+    XORs data, padded with zeros to width bytes, into accumulator. Working on
+    whole payloads as ints is far quicker than going byte by byte.
+    """
+
+    return accumulator ^ (int.from_bytes(data, "big") << (8 * (width - len(data))))
+
+
+class FecEncoder:
+    """
+    Makes a repair packet for every group of packets the socket writer sends:
+    the XOR of their payloads, from which the receiver can rebuild any one of
+    them that's lost, without waiting for it to be retransmitted.
+
+    How many packets a group has adapts to the loss rate, as seen by the
+    socket writer from how many packets it retransmits: the more loss, the
+    smaller the groups, so that most of them lose no more than one packet.
+    With little or no loss, no repair packets are made at all. Groups are
+    made as packets are first sent, rather than as they're read, so that they
+    follow the loss rate as it is at the time.
+    """
+
+    def __init__(
+        self,
+        data_size: int,
+        wire_format: str = wire.BINARY,
+        checksum_algorithm: str = checksum.CRC32,
+        enabled: bool = True,
+        connection_id: Optional[int] = None,
+    ):
+        self.lock = Lock()
+        self.enabled = enabled
+
+        self.data_size = data_size
+        self.wire_format = wire_format
+        self.checksum_algorithm = checksum_algorithm
+        self.connection_id = connection_id
+
+        # Until there's a measurement, assume there's some loss.
+        self.loss_rate = 1 / (2 * MAX_GROUP)
+
+        # The group being built.
+        self.first_pn = 0
+        self.count = 0
+        self.length_xor = 0
+        self.payload_xor = 0
+
+        self.repairs_made = 0
+
+        self.logger = get_logger("[4254send] FecEncoder")
+
+    @property
+    def group_size(self) -> int:
+        """
+        How many packets each repair packet should cover, at the current loss
+        rate, or 0 for none at all.
+        """
+
+        if not self.enabled or self.loss_rate < MIN_LOSS_RATE:
+            return 0
+        # Aim for half a loss per group, on average.
+        return min(max(int(1 / (2 * self.loss_rate)), MIN_GROUP), MAX_GROUP)
+
+    def add(self, pn: int, datagram: bytes) -> Optional[RepairDatagram]:
+        """
+        Adds new data packet pn, which has just been sent for the first time,
+        to the group, and returns the repair packet for the group once it's
+        complete. The EOF packet completes whatever group there is, so the
+        last packets are covered too.
+        """
+
+        with self.lock:
+            group_size = self.group_size
+            if group_size == 0:
+                return self.__finish_group()
+
+            data = wire.data_payload(datagram)
+            if len(data) == 0:
+                return self.__finish_group()
+
+            if self.count == 0:
+                self.first_pn = pn
+            self.count += 1
+            self.length_xor ^= len(data)
+            self.payload_xor = xor_payload(self.payload_xor, data, self.data_size)
+
+            if self.count < group_size:
+                return None
+            return self.__finish_group()
+
+    def __finish_group(self) -> Optional[RepairDatagram]:
+        if self.count == 0:
+            return None
+
+        repair = RepairDatagram(
+            wire.encode_repair(
+                self.first_pn,
+                self.count,
+                self.length_xor,
+                self.payload_xor.to_bytes(self.data_size, "big"),
+                fmt=self.wire_format,
+                algorithm=self.checksum_algorithm,
+                connection_id=self.connection_id,
+            )
+        )
+
+        self.count = 0
+        self.length_xor = 0
+        self.payload_xor = 0
+        self.repairs_made += 1
+
+        return repair
+
+    def on_sent(self, new: int, retransmitted: int):
+        """
+        Called when the socket writer has sent new and retransmitted packets.
+        """
+
+        if not self.enabled:
+            return
+
+        sent = new + retransmitted
+        if sent == 0:
+            return
+
+        with self.lock:
+            # The same as moving it once per packet, in any order.
+            weight = 1 - (1 - LOSS_GAIN) ** sent
+            self.loss_rate += weight * (retransmitted / sent - self.loss_rate)
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "loss_rate": self.loss_rate,
+                "group_size": self.group_size,
+                "repairs_made": self.repairs_made,
+            }
+
+
+class FecDecoder:
+    """
+    Rebuilds lost packets from repair packets, on the receiving end.
+
+    A packet can be rebuilt once every other packet in its group has been
+    received, which means their payloads have to be around still; they're
+    kept in the reorder buffer's slots. A repair packet that arrives with more
+    than one packet of its group missing is held on to, in case enough of the
+    others turn up later, say, as retransmissions.
+    """
+
+    def __init__(self, reorder_buffer: ReorderBuffer):
+        self.reorder_buffer = reorder_buffer
+
+        # first pn -> (count, length XOR, payload XOR) of the groups that were
+        # still missing more than one packet.
+        self.pending: Dict[int, Tuple[int, int, bytes]] = {}
+        # pn -> first pn of the pending group it belongs to.
+        self.groups: Dict[int, int] = {}
+
+        self.recovered = 0
+
+        self.logger = get_logger("[4254recv] FecDecoder")
+
+    def on_repair(
+        self, first_pn: int, count: int, length_xor: int, data: bytes
+    ) -> Optional[Tuple[int, bytes]]:
+        """
+        Handles a repair packet, returning the packet number and payload of
+        the packet it rebuilt, if it could.
+        """
+
+        last_pn = first_pn + count - 1
+        if last_pn <= self.reorder_buffer.hcp:
+            return None
+        if last_pn > self.reorder_buffer.hcp + self.reorder_buffer.capacity:
+            # Beyond the receive window, like the packets it covers would be.
+            return None
+
+        return self.__try_group(first_pn, (count, length_xor, bytes(data)))
+
+    def on_data(self, pn: int) -> Optional[Tuple[int, bytes]]:
+        """
+        Called when packet pn has been received, in case it was the last one
+        but one of a pending group.
+        """
+
+        first_pn = self.groups.get(pn)
+        if first_pn is None:
+            return None
+
+        return self.__try_group(first_pn, self.pending[first_pn])
+
+    def __try_group(
+        self, first_pn: int, group: Tuple[int, int, bytes]
+    ) -> Optional[Tuple[int, bytes]]:
+        (count, length_xor, data) = group
+        members = range(first_pn, first_pn + count)
+        missing = [pn for pn in members if pn not in self.reorder_buffer]
+
+        if len(missing) > 1:
+            if first_pn not in self.pending:
+                self.pending[first_pn] = group
+                for pn in members:
+                    self.groups[pn] = first_pn
+            return None
+
+        self.__forget(first_pn, members)
+        if len(missing) == 0:
+            return None
+
+        width = len(data)
+        payload_xor = int.from_bytes(data, "big")
+        for pn in members:
+            if pn == missing[0]:
+                continue
+            payload = self.reorder_buffer.payload(pn)
+            if payload is None:
+                # Its slot has been reused since.
+                return None
+            length_xor ^= len(payload)
+            payload_xor = xor_payload(payload_xor, payload, width)
+
+        if length_xor > width:
+            return None
+
+        self.recovered += 1
+        self.logger.debug("Rebuilt packet %s from its group.", missing[0])
+        return (missing[0], payload_xor.to_bytes(width, "big")[:length_xor])
+
+    def __forget(self, first_pn: int, members: range):
+        if self.pending.pop(first_pn, None) is not None:
+            for pn in members:
+                self.groups.pop(pn, None)
@@ -0,0 +1,324 @@
+import errno
+import socket
+import sys
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from src import checksum, wire
+from src.constants import (
+    ACKNOWLEDGED,
+    CONNECTION_ID,
+    HELLO,
+    MAX_DATAGRAM,
+    PROBE,
+    RECEIVE_WINDOW,
+)
+from src.datagram_io import MAX_UDP_PAYLOAD, Address, DatagramIO
+from src.logging import get_logger
+
+# The largest datagram the sender offers to send, and the receiver to take, by
+# default: as big as UDP over IPv4 goes, which loopback carries in one piece.
+MAX_DATAGRAM_SIZE = MAX_UDP_PAYLOAD
+
+# The hello is sent again if no answer has come after this long, doubling each
+# time up to MAX_HELLO_INTERVAL. Hellos are tiny, so they're resent far sooner
+# than a data packet would be, to keep a lost one from holding everything up.
+HELLO_INTERVAL = 0.05  # seconds
+MAX_HELLO_INTERVAL = 0.4  # seconds
+# How long to keep at it before going ahead without an answer, with the
+# default packet size, as if the receiver didn't know about handshakes.
+HANDSHAKE_TIMEOUT = 3  # seconds
+
+# Datagram sizes to probe for, smallest first: the largest UDP payloads that
+# fit in an Ethernet frame, in a jumbo frame, and in any IPv4 datagram, as on
+# loopback. Any smaller limit on either end is probed for too.
+PROBE_SIZES = (1472, 8972, MAX_UDP_PAYLOAD)
+# Datagrams bigger than Ethernet's only get through on local networks, and only
+# pay off where the link is fast enough for per-packet costs to matter. Further
+# away than this, each probe would hold the data up for longer than it saves.
+MAX_PROBE_RTT = 0.005  # seconds
+# Not exported by the socket module. From linux/in.h: probes are sent with DF
+# set, so that they're dropped rather than fragmented if they're too big.
+IP_MTU_DISCOVER = 10
+IP_PMTUDISC_DO = 2
+# How many times a probe is sent before taking it that datagrams that big are
+# lost, rather than just the probe.
+PROBE_ATTEMPTS = 2
+# How long to wait for a probe's ack, in round trips of the handshake, and at
+# least.
+PROBE_TIMEOUT_RTTS = 4
+MIN_PROBE_TIMEOUT = 0.01  # seconds
+
+logger = get_logger("[4254send] handshake")
+
+
+class Negotiated(NamedTuple):
+    """
+    What the handshake settled on for the connection.
+    """
+
+    # Payload bytes per data packet.
+    data_size: int
+    # The receiver's window, in packets, if it said.
+    receive_window: Optional[int] = None
+    # How long the hello took to be answered, if it was.
+    rtt: Optional[float] = None
+
+
+def negotiate(
+    sock: socket.socket,
+    datagram_io: DatagramIO,
+    destination: Address,
+    data_size: int,
+    wire_format: str = wire.BINARY,
+    checksum_algorithm: str = checksum.CRC32,
+    connection_id: Optional[int] = None,
+    max_datagram: int = MAX_DATAGRAM_SIZE,
+    probe: bool = True,
+) -> Negotiated:
+    """
+    Opens the connection before any data is sent: the hello offers the wire
+    format and checksum algorithm it's encoded in, and datagrams of up to
+    max_datagram bytes, and the receiver answers with its window and the
+    largest datagram it will take. Then, if probe is set and the receiver is
+    close by, probes with DF set for the largest datagram that actually gets
+    there, going up from data_size until one doesn't.
+
+    Returns the payload size for data packets, data_size unless a probe found
+    room for more, along with what else was learnt.
+    """
+
+    timeout = sock.gettimeout()
+    try:
+        hello_ack = _hello(
+            sock,
+            datagram_io,
+            destination,
+            wire_format,
+            checksum_algorithm,
+            connection_id,
+            max_datagram,
+        )
+        if hello_ack is None:
+            logger.info("No answer to the hello; going ahead without one.")
+            return Negotiated(data_size)
+
+        (rtt, max_datagram, receive_window) = hello_ack
+        logger.info(
+            "Hello answered in %.4fs: datagrams up to %s bytes, window %s.",
+            rtt,
+            max_datagram,
+            receive_window,
+        )
+
+        if not probe or wire_format != wire.BINARY or rtt > MAX_PROBE_RTT:
+            return Negotiated(data_size, receive_window, rtt)
+
+        sizes = [
+            size
+            for size in PROBE_SIZES + (max_datagram,)
+            if size <= max_datagram
+            and wire.max_payload(size, checksum_algorithm, connection_id) > data_size
+        ]
+        probed = _probe(
+            sock,
+            datagram_io,
+            destination,
+            checksum_algorithm,
+            connection_id,
+            sorted(set(sizes)),
+            rtt,
+        )
+        if probed is None:
+            return Negotiated(data_size, receive_window, rtt)
+
+        (size, receive_window) = probed
+        data_size = wire.max_payload(size, checksum_algorithm, connection_id)
+        logger.info(
+            "Datagrams of %s bytes get through; payloads of %s bytes, window %s.",
+            size,
+            data_size,
+            receive_window,
+        )
+        return Negotiated(data_size, receive_window, rtt)
+    finally:
+        sock.settimeout(timeout)
+
+
+def _hello(
+    sock: socket.socket,
+    datagram_io: DatagramIO,
+    destination: Address,
+    wire_format: str,
+    checksum_algorithm: str,
+    connection_id: Optional[int],
+    max_datagram: int,
+) -> Optional[Tuple[float, int, int]]:
+    """
+    Sends hellos until one is answered, and returns how long that one took,
+    and the largest datagram and window the receiver answered with. Returns
+    None if none are answered within HANDSHAKE_TIMEOUT.
+    """
+
+    start = time.monotonic()
+    deadline = start + HANDSHAKE_TIMEOUT
+    # When each attempt was sent, by attempt number, from 1.
+    sent_times: List[float] = []
+    next_hello = start
+    interval = HELLO_INTERVAL
+
+    while True:
+        now = time.monotonic()
+        if now >= deadline:
+            return None
+
+        if now >= next_hello:
+            hello = wire.encode_hello(
+                len(sent_times) + 1,
+                max_datagram,
+                fmt=wire_format,
+                algorithm=checksum_algorithm,
+                connection_id=connection_id,
+            )
+            sock.sendto(hello, destination)
+            sent_times.append(now)
+            next_hello = now + interval
+            interval = min(interval * 2, MAX_HELLO_INTERVAL)
+
+        for packet in _receive(sock, datagram_io, min(next_hello, deadline)):
+            if packet.get(CONNECTION_ID) != connection_id:
+                continue
+            if packet.get(ACKNOWLEDGED) != HELLO:
+                continue
+
+            attempt = packet[HELLO]
+            if not 1 <= attempt <= len(sent_times):
+                continue
+
+            return (
+                time.monotonic() - sent_times[attempt - 1],
+                packet[MAX_DATAGRAM],
+                packet[RECEIVE_WINDOW],
+            )
+
+
+def _probe(
+    sock: socket.socket,
+    datagram_io: DatagramIO,
+    destination: Address,
+    checksum_algorithm: str,
+    connection_id: Optional[int],
+    sizes: List[int],
+    rtt: float,
+) -> Optional[Tuple[int, int]]:
+    """
+    Probes sizes in turn, smallest first, with DF set, until one isn't acked.
+    Returns the largest one that was, and the receiver's window for datagrams
+    that big, or None if none were.
+
+    Each probe is only sent if the one before it was acked soon enough to
+    leave room for it: how much longer it took than the hello is about how
+    long it took to send, and bigger probes take longer in proportion.
+    """
+
+    # Without DF, probes would be fragmented rather than lost, and all of them
+    # would seem to get through.
+    if not sys.platform.startswith("linux"):
+        logger.info("Can't set DF here, so not probing.")
+        return None
+    df = sock.getsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER)
+    sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+
+    timeout = max(PROBE_TIMEOUT_RTTS * rtt, MIN_PROBE_TIMEOUT)
+    largest = None
+    # How much longer than the hello the last probe acked took, per byte.
+    per_byte = 0.0
+
+    try:
+        for size in sizes:
+            if rtt + per_byte * size > timeout:
+                logger.info("Not probing %s bytes; it'd take too long.", size)
+                break
+
+            probed = _probe_once(
+                sock,
+                datagram_io,
+                destination,
+                checksum_algorithm,
+                connection_id,
+                size,
+                timeout,
+            )
+            if probed is None:
+                logger.info("Datagrams of %s bytes don't get through.", size)
+                break
+
+            (elapsed, receive_window) = probed
+            largest = (size, receive_window)
+            per_byte = max(elapsed - rtt, 0) / size
+    finally:
+        sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, df)
+
+    return largest
+
+
+def _probe_once(
+    sock: socket.socket,
+    datagram_io: DatagramIO,
+    destination: Address,
+    checksum_algorithm: str,
+    connection_id: Optional[int],
+    size: int,
+    timeout: float,
+) -> Optional[Tuple[float, int]]:
+    """
+    Sends a probe of size bytes, up to PROBE_ATTEMPTS times, each waiting
+    timeout for its ack. Returns how long the acked one took, and the window
+    it was acked with, or None if none were, or if the probe is bigger than
+    the kernel knows the path takes.
+    """
+
+    datagram = wire.encode_probe(size, checksum_algorithm, connection_id)
+
+    for _ in range(PROBE_ATTEMPTS):
+        sent_time = time.monotonic()
+        try:
+            sock.sendto(datagram, destination)
+        except OSError as e:
+            if e.errno == errno.EMSGSIZE:
+                return None
+            raise
+
+        deadline = sent_time + timeout
+        while time.monotonic() < deadline:
+            for packet in _receive(sock, datagram_io, deadline):
+                if (
+                    packet.get(CONNECTION_ID) == connection_id
+                    and packet.get(ACKNOWLEDGED) == PROBE
+                    and packet[PROBE] == size
+                ):
+                    return (time.monotonic() - sent_time, packet[RECEIVE_WINDOW])
+
+    return None
+
+
+def _receive(
+    sock: socket.socket, datagram_io: DatagramIO, deadline: float
+) -> List[Dict]:
+    """
+    Waits until deadline at the latest for datagrams, and returns the ones that
+    decode.
+    """
+
+    sock.settimeout(max(deadline - time.monotonic(), 0))
+    try:
+        received = datagram_io.recv_batch()
+    except (BlockingIOError, TimeoutError):
+        return []
+
+    packets = []
+    for (datagram, _) in received:
+        packet = wire.decode(datagram)
+        if packet is not None:
+            packets.append(packet)
+    return packets
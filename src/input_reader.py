@@ -1,11 +1,15 @@
+import os
 import sys
-from base64 import b64encode
-from queue import PriorityQueue, Queue
-from typing import Dict, TextIO, Tuple
+from typing import Optional, TextIO
 
-from src import checksum
-from src.constants import CHECKSUM, DATA, END_OF_FILE, SEQUENCE_NUMBER
+from src import checksum, wire
+from src.compression import Compressor
 from src.logging import get_logger
+from src.scheduler import SendScheduler
+from src.send_buffer import MappedPackets, SendBuffer
+
+# How many chunks to read from a pipe per system call, in read_nonblocking.
+READ_CHUNKS = 64
 
 
 class InputReader:
@@ -16,17 +20,33 @@ class InputReader:
 
     def __init__(
         self,
-        packets_to_send: "PriorityQueue[Tuple[int, Dict]]",
-        all_packets: Dict[int, Dict],
+        packets_to_send: SendScheduler,
+        send_buffer: SendBuffer,
+        compressor: Compressor,
         data_size: int,
         stream: TextIO = sys.stdin,
+        wire_format: str = wire.BINARY,
+        checksum_algorithm: str = checksum.CRC32,
+        connection_id: Optional[int] = None,
     ):
         self.packets_to_send = packets_to_send
-        self.all_packets = all_packets
+        # Holds packets until they're acked, and holds us back while it's
+        # full, so that we don't read all of STDIN into memory.
+        self.send_buffer = send_buffer
+        # Decides which payloads go out compressed.
+        self.compressor = compressor
         self.stream = stream
         self.data_size = data_size
+        self.wire_format = wire_format
+        self.checksum_algorithm = checksum_algorithm
+        self.connection_id = connection_id
         self.sequence_number = 0
 
+        # Chunks are read into these, and recycled once they've been encoded.
+        self.buffers = [memoryview(bytearray(data_size)) for _ in range(READ_CHUNKS)]
+        # How many bytes of the buffers read_nonblocking has filled.
+        self.buffered = 0
+
         self.logger = get_logger("[4254send] InputReader")
 
     def run(self):
@@ -39,33 +59,108 @@ class InputReader:
 
         self.logger.info("Starting to read from STDIN")
 
-        while True:
-            data = self.stream.buffer.read(self.data_size)
-            self.sequence_number += 1
+        # The sender quits without waiting for the rest of the input once
+        # the receiver is gone, and closes the send buffer.
+        if isinstance(self.send_buffer, MappedPackets):
+            while self.queue_mapped_chunk() and not self.send_buffer.closed:
+                pass
+        else:
+            buffer = self.buffers[0]
+            while not self.send_buffer.closed:
+                size = self.stream.buffer.readinto(buffer)
+                self.queue_chunk(buffer[:size])
 
-            if len(data) > 0:
-                msg = {
-                    SEQUENCE_NUMBER: self.sequence_number,
-                    DATA: b64encode(data).decode(),
-                    END_OF_FILE: False,
-                }
+                if size == 0:
+                    break
 
-                self.queue_packet(msg)
-            else:
-                msg = {
-                    SEQUENCE_NUMBER: self.sequence_number,
-                    DATA: "",
-                    END_OF_FILE: True,
-                }
+        self.logger.info("Read all of STDIN; ending thread.")
 
-                self.queue_packet(msg)
-                break
+    def read_nonblocking(self) -> bool:
+        """
+        Queue as many chunks as one read from the stream allows, up to
+        READ_CHUNKS of them or as many as the send buffer has room for, without
+        blocking. The stream must be non-blocking, unless it's mapped. Returns
+        False once the EOF packet has been queued.
+        """
 
-        self.logger.info("Read all of STDIN; ending thread.")
+        chunks = min(max(self.send_buffer.room(), 1), READ_CHUNKS)
+
+        if isinstance(self.send_buffer, MappedPackets):
+            for _ in range(chunks):
+                if not self.queue_mapped_chunk(block=False):
+                    return False
+            return True
+
+        # Fill the buffers in order, carrying on from the partly filled one.
+        (full, partial) = divmod(self.buffered, self.data_size)
+        try:
+            size = os.readv(
+                self.stream.fileno(),
+                [self.buffers[full][partial:]] + self.buffers[full + 1 : chunks],
+            )
+        except BlockingIOError:
+            return True
+
+        self.buffered += size
+        (full, partial) = divmod(self.buffered, self.data_size)
+
+        for buffer in self.buffers[:full]:
+            self.queue_chunk(buffer, block=False)
+
+        if size == 0:
+            if partial > 0:
+                self.queue_chunk(self.buffers[full][:partial], block=False)
+            self.queue_chunk(b"", block=False)
+            return False
+
+        if partial > 0 and full > 0:
+            # Move the partly filled buffer to the front, to carry on from
+            # there.
+            self.buffers[0][:partial] = self.buffers[full][:partial]
+        self.buffered = partial
+        return True
+
+    def queue_mapped_chunk(self, block: bool = True) -> bool:
+        """
+        Queue the next packet of a mapped stream, straight from the mapping.
+        Returns False once that was the EOF packet.
+        """
+
+        chunk = self.send_buffer.chunk(self.sequence_number + 1)
+        self.queue_chunk(chunk, block)
+        return len(chunk) > 0
+
+    def queue_chunk(self, data: bytes, block: bool = True):
+        """
+        Make the next packet out of a chunk of at most data_size bytes. An
+        empty chunk means the end of the stream, and makes the EOF packet.
+
+        The chunk is copied into the packet, so its buffer can be reused as
+        soon as this returns.
+        """
+
+        self.sequence_number += 1
+        self.queue_packet(data, eof=len(data) == 0, block=block)
+
+    def queue_packet(self, data: bytes, eof: bool, block: bool = True):
+        """
+        Encode the packet once, and queue the resulting datagram to be sent,
+        waiting for room in the send buffer first if block is set.
+        """
+
+        (payload, compressed) = self.compressor.compress(data)
+        datagram = wire.encode_data(
+            self.sequence_number,
+            payload,
+            eof=eof,
+            fmt=self.wire_format,
+            algorithm=self.checksum_algorithm,
+            compressed=compressed,
+            connection_id=self.connection_id,
+        )
 
-    def queue_packet(self, msg):
-        cksum = checksum.compute_checksum(msg)
-        msg[CHECKSUM] = cksum
+        self.send_buffer.add(self.sequence_number, datagram, block, eof)
+        self.packets_to_send.add_new(self.sequence_number, datagram)
 
-        self.packets_to_send.put((self.sequence_number, msg), block=True)
-        self.all_packets[self.sequence_number] = msg
+        if eof:
+            self.logger.info("Compression: %s", self.compressor.stats())
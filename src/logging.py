@@ -11,6 +11,10 @@ def get_logger(name: str) -> logging.Logger:
 
     logger = logging.getLogger(name)
     logger.setLevel(GLOBAL_LOG_LEVEL)
+    if len(logger.handlers) > 0:
+        # Another instance of the same class set it up already.
+        return logger
+
     # Log to stderr, since stdout is used for actual IO
     stderr_handler = logging.StreamHandler(sys.stderr)
     formatter = logging.Formatter("%(name)s - %(levelname)s - %(message)s")
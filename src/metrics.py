@@ -0,0 +1,273 @@
+import csv
+import json
+import math
+import time
+from bisect import bisect_left
+from threading import Event, Lock, Thread
+from typing import Any, Callable, Dict, List, Optional, Sequence, TextIO
+
+JSON = "json"
+CSV = "csv"
+FORMATS = (JSON, CSV)
+
+# How often metrics are written out, by default. 0 only writes them at exit.
+METRICS_INTERVAL = 1.0  # seconds
+
+SENDER = "sender"
+RECEIVER = "receiver"
+
+# What each end counts as it goes. Everything else is read off the objects
+# that keep track of it anyway, only when a snapshot is taken.
+SENDER_COUNTERS = (
+    "acks_received",
+    "corrupt_acks",
+    "duplicate_acks",
+    "retransmits_fast",
+    "retransmits_reorder",
+    "retransmits_timeout",
+    "loss_probes",
+)
+RECEIVER_COUNTERS = (
+    "corrupt_packets",
+    "duplicate_packets",
+    "out_of_window_packets",
+    "repairs_received",
+    "bytes_delivered",
+)
+
+# Histogram bucket upper bounds. RTT samples are in seconds, from 1ms up, and
+# reorder distances are how many packets past the next one expected an
+# arriving packet is, 0 being in order.
+RTT_BUCKETS = tuple(0.001 * 2**i for i in range(13))
+REORDER_BUCKETS = (0,) + tuple(2**i for i in range(11))
+
+PERCENTILES = (50, 90, 99)
+
+
+class Histogram:
+    """
+    Counts observations into buckets with fixed upper bounds, plus one for
+    everything above the last. Percentiles are the upper bound of the bucket
+    they fall into, so they're only as precise as the buckets.
+    """
+
+    def __init__(self, bounds: Sequence[float]):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+
+        rank = self.count * percentile / 100
+        seen = 0
+        for (bound, count) in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def summary(self) -> Dict[str, Any]:
+        summary = {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count > 0 else None,
+            "min": self.min,
+            "max": self.max,
+        }
+        for percentile in PERCENTILES:
+            summary[f"p{percentile}"] = self.percentile(percentile)
+        return summary
+
+
+class Metrics:
+    """
+    Counters and histograms for one connection, along with gauges read off
+    other objects whenever a snapshot is taken.
+
+    When it's disabled, count and observe return straight away, and nothing
+    else is ever called, so it costs next to nothing. Every counter and
+    histogram is declared up front, and each is only updated from one thread,
+    so snapshots can be taken from another without a lock.
+    """
+
+    def __init__(
+        self,
+        role: str,
+        counters: Sequence[str] = (),
+        histograms: Optional[Dict[str, Sequence[float]]] = None,
+        enabled: bool = True,
+    ):
+        self.enabled = enabled
+        self.role = role
+        self.connection: Optional[str] = None
+        self.start = time.monotonic()
+
+        self.counters = {name: 0 for name in counters}
+        self.histograms = {
+            name: Histogram(bounds) for (name, bounds) in (histograms or {}).items()
+        }
+        self.gauges: List[Callable[[], Dict[str, Any]]] = []
+
+    def count(self, name: str, n: int = 1):
+        if self.enabled:
+            self.counters[name] += n
+
+    def observe(self, name: str, value: float):
+        if self.enabled:
+            self.histograms[name].observe(value)
+
+    def add_gauges(self, gauges: Callable[[], Dict[str, Any]]):
+        """
+        Adds a function returning gauges by name, to be called for every
+        snapshot.
+        """
+
+        self.gauges.append(gauges)
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start
+
+    def snapshot(self, final: bool = False) -> Dict[str, Any]:
+        gauges: Dict[str, Any] = {}
+        for source in self.gauges:
+            gauges.update(source())
+        for (name, value) in gauges.items():
+            if isinstance(value, float) and not math.isfinite(value):
+                # Like a window that hasn't been set yet; JSON can't say inf.
+                gauges[name] = None
+
+        return {
+            "time": time.time(),
+            "elapsed": self.elapsed(),
+            "role": self.role,
+            "connection": self.connection,
+            "final": final,
+            "counters": dict(self.counters),
+            "gauges": gauges,
+            "histograms": {
+                name: histogram.summary()
+                for (name, histogram) in self.histograms.items()
+            },
+        }
+
+
+def sender_metrics(enabled: bool) -> Metrics:
+    return Metrics(SENDER, SENDER_COUNTERS, {"rtt": RTT_BUCKETS}, enabled)
+
+
+def receiver_metrics(enabled: bool) -> Metrics:
+    return Metrics(
+        RECEIVER, RECEIVER_COUNTERS, {"reorder_distance": REORDER_BUCKETS}, enabled
+    )
+
+
+def flatten(snapshot: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Flattens a snapshot into a single CSV row, with a column per counter,
+    gauge and histogram statistic.
+    """
+
+    row = {
+        key: snapshot[key] for key in ("time", "elapsed", "role", "connection", "final")
+    }
+    row.update(snapshot["counters"])
+    row.update(snapshot["gauges"])
+    for (name, summary) in snapshot["histograms"].items():
+        for (key, value) in summary.items():
+            row[f"{name}_{key}"] = value
+    return row
+
+
+class MetricsExporter:
+    """
+    Writes snapshots of every connection's metrics to a file, every interval
+    seconds from a thread of its own, and a final one for each as it's
+    removed, or when the exporter is closed.
+
+    JSON is one snapshot per line. CSV is one flattened snapshot per row, with
+    the columns of the first one.
+    """
+
+    def __init__(self, path: str, fmt: str = JSON, interval: float = METRICS_INTERVAL):
+        self.lock = Lock()
+        self.fmt = fmt
+        self.interval = interval
+
+        self.file: TextIO = open(path, "w", newline="")
+        self.csv_writer: Optional[csv.DictWriter] = None
+
+        self.metrics: List[Metrics] = []
+        self.closed = Event()
+        self.thread: Optional[Thread] = None
+
+    def start(self):
+        if self.interval > 0:
+            self.thread = Thread(target=self.__run, daemon=True)
+            self.thread.start()
+
+    def add(self, metrics: Metrics):
+        with self.lock:
+            self.metrics.append(metrics)
+
+    def remove(self, metrics: Metrics):
+        """
+        Stops exporting metrics, writing a final snapshot of them.
+        """
+
+        with self.lock:
+            if metrics not in self.metrics:
+                return
+            self.metrics.remove(metrics)
+            self.__write(metrics.snapshot(final=True))
+            self.file.flush()
+
+    def close(self):
+        """
+        Writes a final snapshot of every connection still being exported, and
+        closes the file. Safe to call more than once.
+        """
+
+        if self.closed.is_set():
+            return
+        self.closed.set()
+
+        with self.lock:
+            for metrics in self.metrics:
+                self.__write(metrics.snapshot(final=True))
+            self.metrics.clear()
+            self.file.close()
+
+    def __run(self):
+        while not self.closed.wait(self.interval):
+            with self.lock:
+                if self.closed.is_set():
+                    return
+                for metrics in self.metrics:
+                    self.__write(metrics.snapshot())
+                self.file.flush()
+
+    def __write(self, snapshot: Dict[str, Any]):
+        if self.fmt == JSON:
+            self.file.write(json.dumps(snapshot) + "\n")
+            return
+
+        row = flatten(snapshot)
+        if self.csv_writer is None:
+            self.csv_writer = csv.DictWriter(
+                self.file, fieldnames=list(row), extrasaction="ignore"
+            )
+            self.csv_writer.writeheader()
+        self.csv_writer.writerow(row)
@@ -0,0 +1,418 @@
+import json
+import random
+import statistics
+import socket
+import sys
+import time
+import tracemalloc
+from queue import Queue
+from threading import RLock
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from src import checksum, congestion, wire
+from src.compression import Compressor
+from src.constants import SEQUENCE_NUMBER
+from src.datagram_io import Address, DatagramIO
+from src.input_reader import InputReader
+from src.pacing import Pacer
+from src.receiver import Receiver
+from src.recovery import LossRecovery
+from src.rtt import RttEstimator
+from src.scheduler import SendScheduler
+from src.send_buffer import SendBuffer
+from src.socket_reader import SocketReader
+from src.timers import TimerQueue
+
+# Microbenchmarks
+#
+# Each benchmark drives one per-packet stage over a synthetic trace, with no
+# sockets and no threads: set up runs first, untimed, and returns a step to
+# call once per item of the trace. The receiver's acks go nowhere and its
+# output is thrown away, and the trace of acks the sender's socket reader is
+# driven with comes from running a receiver over a trace of data packets.
+
+DATA_SIZE = 1000
+MESSAGE_SIZE = 1500
+# How many packets each trace has, by default.
+PACKETS = 2000
+# How many times each benchmark is run through its trace, timing it a chunk of
+# packets at a time. The median chunk counts: whatever else runs on the machine
+# only slows some of them down.
+REPEAT = 5
+CHUNK = 50
+
+# Traces
+IN_ORDER = "in-order"
+REORDER = "reorder"
+DUPLICATE = "duplicate"
+ACK_STORM = "ack-storm"
+
+# How far packets are shuffled in the reorder trace.
+REORDER_SPAN = 64
+# How many packets later each one turns up again in the duplicate trace.
+DUPLICATE_LAG = 3
+
+# By how much a comparison lets a benchmark be slower, or allocate more, than
+# its baseline before it counts as a regression. Speed is compared relative to
+# the reference loop, since the same box can run half as fast from one minute
+# to the next; relative to it, runs still differ by up to a third for the
+# shortest stages. Allocations hardly vary at all.
+TIME_TOLERANCE = 0.40
+ALLOCATION_TOLERANCE = 0.10
+
+ADDRESS = ("127.0.0.1", 4254)
+
+Step = Callable[[Any], Any]
+
+
+class Benchmark(NamedTuple):
+    name: str
+    # Returns the step to time, and the items to call it with.
+    setup: Callable[[int], Tuple[Step, Sequence]]
+
+
+class NullIO(DatagramIO):
+    """
+    Sends nowhere, and keeps what it was asked to send if keep is set.
+    """
+
+    def __init__(self, keep: bool = False):
+        super().__init__(socket.socket(socket.AF_INET, socket.SOCK_DGRAM), MESSAGE_SIZE)
+        self.keep = keep
+        self.sent: List[bytes] = []
+
+    def send_batch(self, datagrams: Sequence[bytes], address: Address) -> int:
+        if self.keep:
+            self.sent.extend(datagrams)
+        return len(datagrams)
+
+    def recv_batch(self) -> List[Tuple[bytes, Address]]:
+        return []
+
+
+class NullOutput:
+    def write(self, data) -> int:
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def payloads(count: int) -> List[bytes]:
+    rng = random.Random(count)
+    return [bytes(rng.getrandbits(7) for _ in range(DATA_SIZE)) for _ in range(count)]
+
+
+def order(trace: str, count: int) -> List[int]:
+    """
+    The order packets 1 to count arrive in, in a trace.
+    """
+
+    pns = list(range(1, count + 1))
+    if trace == REORDER:
+        rng = random.Random(count)
+        for start in range(0, count, REORDER_SPAN):
+            window = pns[start : start + REORDER_SPAN]
+            rng.shuffle(window)
+            pns[start : start + REORDER_SPAN] = window
+    elif trace == DUPLICATE:
+        duplicated = []
+        for i, pn in enumerate(pns):
+            duplicated.append(pn)
+            if i >= DUPLICATE_LAG:
+                duplicated.append(pns[i - DUPLICATE_LAG])
+        pns = duplicated
+    return pns
+
+
+def datagrams(count: int, fmt: str = wire.BINARY) -> Dict[int, bytes]:
+    return {
+        pn: wire.encode_data(pn, payload, eof=False, fmt=fmt)
+        for (pn, payload) in enumerate(payloads(count), start=1)
+    }
+
+
+def data_trace(trace: str, count: int, fmt: str = wire.BINARY) -> List[bytes]:
+    by_pn = datagrams(count, fmt)
+    return [by_pn[pn] for pn in order(trace, count)]
+
+
+def new_receiver(datagram_io: DatagramIO) -> Receiver:
+    return Receiver(
+        sock=datagram_io.sock,
+        message_size=MESSAGE_SIZE,
+        output=NullOutput(),
+        datagram_io=datagram_io,
+    )
+
+
+def receive(receiver: Receiver, data: bytes):
+    """
+    What the receiver's loop does with each datagram, with a batch of one.
+    """
+
+    packet = wire.decode(data)
+    if packet is not None and SEQUENCE_NUMBER in packet:
+        receiver.handle_packet(packet, data, ADDRESS)
+    receiver.flush()
+
+
+def ack_trace(trace: str, count: int) -> List[bytes]:
+    """
+    The acks a receiver sends for a trace of data packets, or, for an ack
+    storm, one ack followed by nothing but duplicates of it.
+    """
+
+    if trace == ACK_STORM:
+        return [wire.encode_ack(1, receive_window=1024)] * count
+
+    datagram_io = NullIO(keep=True)
+    receiver = new_receiver(datagram_io)
+    for data in data_trace(trace, count):
+        receive(receiver, data)
+    return datagram_io.sent
+
+
+def checksum_setup(algorithm: str) -> Callable[[int], Tuple[Step, Sequence]]:
+    def setup(count: int) -> Tuple[Step, Sequence]:
+        return (
+            lambda data: checksum.compute_checksum(data, algorithm),
+            payloads(count),
+        )
+
+    return setup
+
+
+def verify_setup(count: int) -> Tuple[Step, Sequence]:
+    items = [(data, checksum.compute_checksum(data)) for data in payloads(count)]
+    return (lambda item: checksum.verify_checksum(item[0], item[1]), items)
+
+
+def encode_setup(fmt: str) -> Callable[[int], Tuple[Step, Sequence]]:
+    def setup(count: int) -> Tuple[Step, Sequence]:
+        items = list(enumerate(payloads(count), start=1))
+        return (
+            lambda item: wire.encode_data(item[0], item[1], eof=False, fmt=fmt),
+            items,
+        )
+
+    return setup
+
+
+def decode_setup(fmt: str) -> Callable[[int], Tuple[Step, Sequence]]:
+    def setup(count: int) -> Tuple[Step, Sequence]:
+        return (wire.decode, data_trace(IN_ORDER, count, fmt))
+
+    return setup
+
+
+def input_reader_setup(count: int) -> Tuple[Step, Sequence]:
+    input_reader = InputReader(
+        packets_to_send=SendScheduler(),
+        send_buffer=SendBuffer(capacity=count + 1),
+        compressor=Compressor(enabled=False),
+        data_size=DATA_SIZE,
+    )
+    return (lambda data: input_reader.queue_chunk(data, block=False), payloads(count))
+
+
+def receiver_setup(trace: str) -> Callable[[int], Tuple[Step, Sequence]]:
+    def setup(count: int) -> Tuple[Step, Sequence]:
+        receiver = new_receiver(NullIO())
+        return (lambda data: receive(receiver, data), data_trace(trace, count))
+
+    return setup
+
+
+def socket_reader_setup(trace: str) -> Callable[[int], Tuple[Step, Sequence]]:
+    def setup(count: int) -> Tuple[Step, Sequence]:
+        acks = ack_trace(trace, count)
+
+        # Every packet has been sent, and is waiting for its ack.
+        send_buffer = SendBuffer(capacity=count + 1)
+        outstanding_packets: Dict[int, Tuple[bytes, float]] = {}
+        timers = TimerQueue()
+        now = time.monotonic()
+        for pn, datagram in datagrams(count).items():
+            send_buffer.add(pn, datagram, block=False)
+            outstanding_packets[pn] = (datagram, now)
+            timers.schedule(pn, now + 1)
+
+        rtt = RttEstimator()
+        recovery = LossRecovery(rtt, timers)
+        recovery.on_sent(list(outstanding_packets), [], now)
+        socket_reader = SocketReader(
+            sock=None,
+            packets_to_send=SendScheduler(),
+            send_buffer=send_buffer,
+            outstanding_packets=outstanding_packets,
+            outstanding_packets_lock=RLock(),
+            timeout_messagebox=Queue(maxsize=1),
+            destination=ADDRESS,
+            message_size=MESSAGE_SIZE,
+            congestion=congestion.create_controller(congestion.NEWRENO),
+            rtt=rtt,
+            timers=timers,
+            datagram_io=NullIO(),
+            pacer=Pacer(),
+            recovery=recovery,
+        )
+        return (socket_reader.handle_ack, acks)
+
+    return setup
+
+
+BENCHMARKS = [
+    Benchmark("checksum.compute/crc32", checksum_setup(checksum.CRC32)),
+    Benchmark("checksum.compute/adler32", checksum_setup(checksum.ADLER32)),
+    Benchmark("checksum.compute/blake2b", checksum_setup(checksum.BLAKE2B)),
+    Benchmark("checksum.verify/crc32", verify_setup),
+    Benchmark("wire.encode_data/binary", encode_setup(wire.BINARY)),
+    Benchmark("wire.encode_data/json", encode_setup(wire.JSON)),
+    Benchmark("wire.decode/binary", decode_setup(wire.BINARY)),
+    Benchmark("wire.decode/json", decode_setup(wire.JSON)),
+    Benchmark("InputReader.queue_chunk", input_reader_setup),
+    Benchmark(f"Receiver/{IN_ORDER}", receiver_setup(IN_ORDER)),
+    Benchmark(f"Receiver/{REORDER}", receiver_setup(REORDER)),
+    Benchmark(f"Receiver/{DUPLICATE}", receiver_setup(DUPLICATE)),
+    Benchmark(f"SocketReader.handle_ack/{IN_ORDER}", socket_reader_setup(IN_ORDER)),
+    Benchmark(f"SocketReader.handle_ack/{REORDER}", socket_reader_setup(REORDER)),
+    Benchmark(f"SocketReader.handle_ack/{ACK_STORM}", socket_reader_setup(ACK_STORM)),
+]
+
+
+def reference() -> float:
+    """
+    Times a fixed loop of the kind of work every stage does, in ns per
+    iteration. Timed right after each chunk of a benchmark, it says how fast
+    the machine happened to be running just then.
+    """
+
+    packets: Dict[int, bytes] = {}
+    data = bytes(DATA_SIZE)
+    start = time.perf_counter_ns()
+    for pn in range(CHUNK):
+        packets[pn] = wire.HEADER.pack(pn & 0xFF, 0, pn) + data[: pn + 1]
+        packets.pop(pn - 1, None)
+    return (time.perf_counter_ns() - start) / CHUNK
+
+
+def measure(benchmark: Benchmark, count: int = PACKETS, repeat: int = REPEAT) -> Dict:
+    """
+    Times a benchmark, and then runs it once more under tracemalloc to see
+    what it allocates.
+
+    Time is the median over chunks of packets, in ns and relative to the
+    reference loop timed after each chunk.
+
+    CPython doesn't count allocations as such, so there are two measures of
+    them: the most memory a step held at once beyond what it started with,
+    which is what it allocated and freed again, averaged over the steps, and
+    the memory blocks still allocated after all of them, per step, which is
+    what it kept.
+    """
+
+    samples = []
+    relative = []
+    for _ in range(repeat):
+        (step, items) = benchmark.setup(count)
+        for first in range(0, len(items), CHUNK):
+            chunk = items[first : first + CHUNK]
+            start = time.perf_counter_ns()
+            for item in chunk:
+                step(item)
+            elapsed = (time.perf_counter_ns() - start) / len(chunk)
+
+            samples.append(elapsed)
+            relative.append(elapsed / reference())
+
+    (step, items) = benchmark.setup(count)
+    peak_bytes = 0
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    for item in items:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        step(item)
+        peak_bytes += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    blocks = sys.getallocatedblocks() - blocks
+
+    return {
+        "ns_per_packet": statistics.median(samples),
+        "relative": statistics.median(relative),
+        "peak_bytes_per_packet": peak_bytes / len(items),
+        "blocks_per_packet": blocks / len(items),
+        "packets": len(items),
+    }
+
+
+def select(match: Optional[str] = None) -> List[Benchmark]:
+    return [
+        benchmark
+        for benchmark in BENCHMARKS
+        if match is None or match.lower() in benchmark.name.lower()
+    ]
+
+
+def regressions(
+    results: Dict[str, Dict],
+    baseline: Dict[str, Dict],
+    time_tolerance: float = TIME_TOLERANCE,
+    allocation_tolerance: float = ALLOCATION_TOLERANCE,
+) -> List[str]:
+    """
+    Describes every way results are worse than baseline by more than the
+    tolerances. Benchmarks missing from either are skipped.
+    """
+
+    found = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+
+        limits = (
+            ("relative", time_tolerance, 0),
+            # A handful of bytes either way is the allocator, not the code.
+            ("peak_bytes_per_packet", allocation_tolerance, 64),
+            ("blocks_per_packet", allocation_tolerance, 0.1),
+        )
+        for key, tolerance, slack in limits:
+            # Blocks per packet go negative when a stage frees what setup made.
+            limit = base[key] + abs(base[key]) * tolerance + slack
+            if result[key] > limit:
+                found.append(
+                    f"{name}: {key} {result[key]:.2f} > {limit:.2f} "
+                    f"(baseline {base[key]:.2f})"
+                )
+    return found
+
+
+def load_baseline(path: str) -> Dict[str, Dict]:
+    with open(path) as file:
+        return json.load(file)["benchmarks"]
+
+
+def save_baseline(path: str, results: Dict[str, Dict]):
+    with open(path, "w") as file:
+        json.dump(
+            {"python": sys.version.split()[0], "benchmarks": results},
+            file,
+            indent=2,
+            sort_keys=True,
+        )
+        file.write("\n")
+
+
+def format_result(name: str, result: Dict, base: Optional[Dict] = None) -> str:
+    line = (
+        f"  {name:<36} {result['ns_per_packet']:8.0f} ns/pkt "
+        f"{result['relative']:6.2f}x ref "
+        f"{result['peak_bytes_per_packet']:8.0f} B/pkt "
+        f"{result['blocks_per_packet']:6.2f} blocks/pkt"
+    )
+    if base is not None:
+        change = result["relative"] / base["relative"] - 1
+        line += f"  {change:+6.1%} vs baseline"
+    return line
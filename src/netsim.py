@@ -0,0 +1,284 @@
+import heapq
+import random
+import select
+import socket
+import time
+from threading import Event, Thread
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from src.logging import get_logger
+
+# A network emulator in user space
+#
+# infra/netsim impairs the loopback device with tc, which needs root, and
+# draws from the kernel's random numbers, so no two runs are alike. This does
+# the same between two UDP endpoints instead: the sender sends to the proxy,
+# which sends on to the receiver, and relays the receiver's acks back. Each
+# direction is a Link of its own, with its own bottleneck queue and its own
+# random numbers, seeded, so that the same packets meet the same fate every
+# run; only queue drops depend on timing.
+
+# Largest datagram the proxy relays.
+MAX_DATAGRAM = 65536
+# Longest the proxy waits for packets before checking whether it's stopped.
+POLL_INTERVAL = 0.05  # seconds
+
+logger = get_logger("[4254netsim] proxy")
+
+
+class Impairments(NamedTuple):
+    """
+    What a link does to the packets crossing it, with netsim's options and
+    units.
+    """
+
+    # Link rate in Mb/s; 0 is unlimited.
+    bandwidth: float = 1
+    # One-way delay in milliseconds.
+    latency: float = 10
+    # Jitter in milliseconds, added to or taken off the latency at random, as
+    # in netem's "delay LATENCY JITTER", which is what netsim's --delay is.
+    delay: float = 0
+    # Percentages of packets dropped, duplicated, corrupted and reordered.
+    # Reordered packets skip the latency, as with netem.
+    drop: float = 0
+    duplicate: float = 0
+    corrupt: float = 0
+    reorder: float = 0
+    # Bottleneck queue size in megabits; packets that don't fit are dropped.
+    limit: float = 1000
+
+    def describe(self) -> str:
+        return (
+            f"{self.bandwidth} Mb/s, {self.latency} ms latency, {self.delay} ms "
+            f"jitter, {self.drop}% drop, {self.duplicate}% duplicate, "
+            f"{self.corrupt}% corrupt, {self.reorder}% reorder"
+        )
+
+
+class Link:
+    """
+    One direction of the emulated network.
+
+    Each packet first meets its fate, drop, duplicate or corrupt, then waits
+    its turn in the bottleneck queue, and then takes the latency, give or take
+    the jitter, to arrive. transmit doesn't wait for any of it: it returns
+    when each copy of the packet is due to arrive, and the proxy sends it on
+    then. The same number of random numbers is drawn for every packet, so a
+    packet's fate only depends on the seed and how many packets came before.
+    """
+
+    def __init__(self, impairments: Impairments, seed: int):
+        self.impairments = impairments
+        self.rng = random.Random(seed)
+
+        # Bytes per second, or 0 for no bottleneck at all.
+        self.rate = impairments.bandwidth * 1e6 / 8
+        self.queue_limit = impairments.limit * 1e6 / 8  # bytes
+        # When the bottleneck is done with every packet queued so far.
+        self.busy_until = 0.0
+
+        self.packets = 0
+        self.bytes = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.queue_dropped = 0
+        self.duplicated = 0
+        self.corrupted = 0
+        self.reordered = 0
+
+    def transmit(self, data: bytes, now: float) -> List[Tuple[float, bytes]]:
+        """
+        Sends data across the link at time now, and returns when each copy of
+        it that makes it across arrives.
+        """
+
+        self.packets += 1
+        self.bytes += len(data)
+        impairments = self.impairments
+
+        dropped = self.rng.random() * 100 < impairments.drop
+        duplicated = self.rng.random() * 100 < impairments.duplicate
+        if dropped:
+            self.dropped += 1
+            return []
+
+        copies = [data]
+        if duplicated:
+            self.duplicated += 1
+            copies.append(data)
+
+        arrivals = []
+        for copy in copies:
+            corrupted = self.rng.random() * 100 < impairments.corrupt
+            position = self.rng.randrange(len(copy) * 8) if len(copy) > 0 else 0
+            reordered = self.rng.random() * 100 < impairments.reorder
+            jitter = self.rng.uniform(-impairments.delay, impairments.delay)
+
+            if corrupted and len(copy) > 0:
+                self.corrupted += 1
+                flipped = bytearray(copy)
+                flipped[position // 8] ^= 1 << (position % 8)
+                copy = bytes(flipped)
+
+            departure = now
+            if self.rate > 0:
+                backlog = max(self.busy_until - now, 0) * self.rate
+                if backlog + len(copy) > self.queue_limit:
+                    self.queue_dropped += 1
+                    continue
+                self.busy_until = max(self.busy_until, now) + len(copy) / self.rate
+                departure = self.busy_until
+
+            if reordered:
+                self.reordered += 1
+                delay = 0.0
+            else:
+                delay = max(impairments.latency + jitter, 0) / 1000
+
+            self.delivered += 1
+            arrivals.append((departure + delay, copy))
+
+        return arrivals
+
+    def stats(self) -> Dict:
+        return {
+            "packets": self.packets,
+            "bytes": self.bytes,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "queue_dropped": self.queue_dropped,
+            "duplicated": self.duplicated,
+            "corrupted": self.corrupted,
+            "reordered": self.reordered,
+        }
+
+
+class ImpairmentProxy:
+    """
+    Relays datagrams between senders and a receiver through a Link each way.
+
+    Senders send to the proxy's port. Each one gets a socket of its own to
+    send on to target from, so the receiver can tell them apart, and so that
+    acks find their way back. Every sender shares the same two links, as they
+    would share a bottleneck. It all runs on one thread: packets waiting to
+    arrive are kept in a heap by arrival time, and the proxy sleeps in select
+    until the next one is due or a packet comes in.
+    """
+
+    def __init__(
+        self,
+        target: Tuple[str, int],
+        forward: Impairments,
+        backward: Optional[Impairments] = None,
+        seed: int = 0,
+        port: int = 0,
+        host: str = "127.0.0.1",
+    ):
+        self.target = target
+        self.forward = Link(forward, seed)
+        # Acks are impaired just the same, as on the loopback device, but
+        # never by the same random numbers.
+        self.backward = Link(backward or forward, seed + 1)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1]
+
+        # Each sender's socket towards the receiver, and back again.
+        self.upstreams: Dict[Tuple[str, int], socket.socket] = {}
+        self.senders: Dict[socket.socket, Tuple[str, int]] = {}
+
+        # (arrival, sequence, socket, data, address); sequence keeps packets
+        # due at the same time in the order they were sent.
+        self.pending: List[Tuple[float, int, socket.socket, bytes, Tuple]] = []
+        self.sequence = 0
+
+        self.stopped = Event()
+        self.thread: Optional[Thread] = None
+
+    def start(self):
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        for sock in [self.sock] + list(self.upstreams.values()):
+            sock.close()
+
+    def run(self):
+        logger.info(
+            "Relaying port %s to %s: %s",
+            self.port,
+            self.target,
+            self.forward.impairments.describe(),
+        )
+
+        while not self.stopped.is_set():
+            now = self.__deliver(time.monotonic())
+
+            timeout = POLL_INTERVAL
+            if len(self.pending) > 0:
+                timeout = min(max(self.pending[0][0] - now, 0), timeout)
+
+            sockets = [self.sock] + list(self.senders)
+            (readable, _, _) = select.select(sockets, [], [], timeout)
+            for sock in readable:
+                self.__receive(sock)
+
+    def stats(self) -> Dict:
+        return {"forward": self.forward.stats(), "backward": self.backward.stats()}
+
+    def __deliver(self, now: float) -> float:
+        """
+        Sends every packet that has arrived by now on to where it's going, and
+        returns the time after that.
+        """
+
+        while len(self.pending) > 0 and self.pending[0][0] <= now:
+            (_, _, sock, data, address) = heapq.heappop(self.pending)
+            try:
+                sock.sendto(data, address)
+            except OSError:
+                # Nobody's listening any more, as when a receiver has quit.
+                pass
+            now = time.monotonic()
+
+        return now
+
+    def __receive(self, sock: socket.socket):
+        while True:
+            try:
+                (data, address) = sock.recvfrom(MAX_DATAGRAM)
+            except (BlockingIOError, ConnectionRefusedError):
+                return
+
+            now = time.monotonic()
+            if sock is self.sock:
+                (link, out, destination) = (
+                    self.forward,
+                    self.__upstream(address),
+                    self.target,
+                )
+            else:
+                (link, out, destination) = (self.backward, self.sock, self.senders[sock])
+
+            for (arrival, copy) in link.transmit(data, now):
+                heapq.heappush(
+                    self.pending, (arrival, self.sequence, out, copy, destination)
+                )
+                self.sequence += 1
+
+    def __upstream(self, sender: Tuple[str, int]) -> socket.socket:
+        upstream = self.upstreams.get(sender)
+        if upstream is None:
+            upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            upstream.bind((self.sock.getsockname()[0], 0))
+            upstream.setblocking(False)
+            self.upstreams[sender] = upstream
+            self.senders[upstream] = sender
+            logger.info("New sender %s.", sender)
+        return upstream
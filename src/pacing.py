@@ -0,0 +1,300 @@
+import math
+import time
+from collections import deque
+from threading import Lock
+from typing import Deque, Dict, Iterable, Optional, Set, Tuple
+
+from src.datagram_io import MAX_BATCH
+from src.logging import get_logger
+
+STARTUP = "startup"
+DRAIN = "drain"
+PROBE_BW = "probe_bw"
+
+# BBR's gains: startup doubles the delivery rate every round trip, drain
+# empties the queue that built up doing so, and probing cycles between
+# pushing for more bandwidth and draining what that queued.
+STARTUP_GAIN = 2 / math.log(2)
+DRAIN_GAIN = 1 / STARTUP_GAIN
+PROBE_BW_GAINS = (1.25, 0.75, 1, 1, 1, 1, 1, 1)
+
+# The bottleneck bandwidth is the highest delivery rate seen over this many
+# round trips, so that a few slow acks don't drag it down.
+BANDWIDTH_WINDOW = 10  # round trips
+# Startup ends once the bandwidth hasn't grown by this much for this many
+# round trips in a row, i.e. the pipe is full.
+FULL_BANDWIDTH_GROWTH = 1.25
+FULL_BANDWIDTH_ROUNDS = 3
+
+# How much sending time a single burst may take up, so that bursts can still
+# be batched into one system call without upsetting the pacing much.
+SEND_QUANTUM = 0.001  # seconds
+MIN_BURST = 2  # packets
+
+
+class Pacer:
+    """
+    Spaces out the packets the socket writer sends, at a pacing rate derived
+    from an estimate of the bottleneck bandwidth, in the style of BBR.
+
+    Every packet sent records how much had been delivered by then, and every
+    packet acked or SACKed yields a delivery rate sample from that: the
+    amount delivered in between, over the time it took (as in
+    draft-cheng-iccrg-delivery-rate-estimation). The bottleneck bandwidth is
+    the maximum of the recent samples, and the pacing rate is that times a
+    gain that depends on the phase BBR would be in.
+
+    When it's disabled, nothing is estimated and nothing is ever delayed;
+    only the bytes sent are counted, for the stats.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.lock = Lock()
+        self.enabled = enabled
+
+        # Bytes acked or SACKed so far, when the last of them was, and when
+        # the packet acked then was sent.
+        self.delivered = 0
+        self.delivered_time = time.monotonic()
+        self.first_sent_time = self.delivered_time
+
+        # pn -> (delivered, delivered_time, first_sent_time, sent_time, size)
+        # as they were when the packet was sent.
+        self.sent_state: Dict[int, Tuple[int, float, float, float, int]] = {}
+        # Packets sent more than once, whose acks can't be matched to a send
+        # time for the RTT (Karn's rule).
+        self.retransmitted: Set[int] = set()
+
+        # Round trips are counted in deliveries: one ends when a packet sent
+        # after the previous one ended is delivered.
+        self.round_count = 0
+        self.next_round_delivered = 0
+
+        # Delivery rate samples (round, bytes per second), kept as a
+        # decreasing run so the maximum is always the first one.
+        self.bandwidth_samples: Deque[Tuple[int, float]] = deque()
+        self.min_rtt: Optional[float] = None
+
+        self.state = STARTUP
+        self.full_bandwidth = 0.0
+        self.full_bandwidth_rounds = 0
+        self.drain_round = 0
+        self.cycle_index = 0
+        self.cycle_start = 0.0
+
+        # When the next packet may be sent.
+        self.next_send_time = 0.0
+        self.packet_size = 0
+
+        # For the stats.
+        self.bytes_sent = 0
+        self.first_send: Optional[float] = None
+        self.last_send: Optional[float] = None
+
+        self.logger = get_logger("[4254send] Pacer")
+
+    @property
+    def bandwidth(self) -> Optional[float]:
+        """
+        The bottleneck bandwidth estimate in bytes per second, if there's been
+        a sample yet.
+        """
+
+        if len(self.bandwidth_samples) == 0:
+            return None
+        return self.bandwidth_samples[0][1]
+
+    @property
+    def pacing_gain(self) -> float:
+        if self.state == STARTUP:
+            return STARTUP_GAIN
+        if self.state == DRAIN:
+            return DRAIN_GAIN
+        return PROBE_BW_GAINS[self.cycle_index]
+
+    @property
+    def pacing_rate(self) -> Optional[float]:
+        """
+        The rate to send at in bytes per second, or None until the first
+        delivery rate sample, before which nothing is paced.
+        """
+
+        bandwidth = self.bandwidth
+        if not self.enabled or bandwidth is None:
+            return None
+        return self.pacing_gain * bandwidth
+
+    def delay(self, now: float) -> float:
+        """
+        How long to wait from now before sending the next burst.
+        """
+
+        if not self.enabled:
+            return 0
+        with self.lock:
+            return max(self.next_send_time - now, 0)
+
+    def burst_size(self) -> int:
+        """
+        How many packets may go out together, without waiting in between:
+        SEND_QUANTUM's worth at the pacing rate, but at least MIN_BURST.
+        """
+
+        with self.lock:
+            rate = self.pacing_rate
+            if rate is None or self.packet_size == 0:
+                return MAX_BATCH
+            quantum = int(rate * SEND_QUANTUM / self.packet_size)
+            return min(max(quantum, MIN_BURST), MAX_BATCH)
+
+    def on_sent(self, packets: Iterable[Tuple[Optional[int], int]], in_flight: int):
+        """
+        Called when packets, as (pn, size) pairs, have been written to the
+        socket, with in_flight packets already in flight before them. pn is
+        None for packets that are never acked. They aren't paced either: they
+        never count towards the delivery rate, so pacing them would only take
+        that much away from the packets that do, and drag the rate down.
+        """
+
+        now = time.monotonic()
+
+        with self.lock:
+            if self.first_send is None:
+                self.first_send = now
+            self.last_send = now
+
+            size = 0
+            paced_size = 0
+            for (pn, packet_size) in packets:
+                size += packet_size
+                self.packet_size = max(self.packet_size, packet_size)
+
+                if not self.enabled or pn is None:
+                    continue
+                paced_size += packet_size
+                if pn in self.sent_state:
+                    self.retransmitted.add(pn)
+                if in_flight == 0:
+                    # Nothing is in flight to be delivered, so the delivery
+                    # rate starts over from here.
+                    self.first_sent_time = now
+                    self.delivered_time = now
+                self.sent_state[pn] = (
+                    self.delivered,
+                    self.delivered_time,
+                    self.first_sent_time,
+                    now,
+                    packet_size,
+                )
+                in_flight += 1
+
+            self.bytes_sent += size
+
+            rate = self.pacing_rate
+            if rate is not None:
+                self.next_send_time = max(self.next_send_time, now) + paced_size / rate
+
+    def on_delivered(self, pns: Iterable[int]):
+        """
+        Called when packets pns have been acked or SACKed for the first time.
+        """
+
+        if not self.enabled:
+            return
+
+        now = time.monotonic()
+
+        with self.lock:
+            latest = None
+            ambiguous = False
+            for pn in pns:
+                state = self.sent_state.pop(pn, None)
+                if state is None:
+                    continue
+                if pn in self.retransmitted:
+                    self.retransmitted.discard(pn)
+                    ambiguous = True
+
+                self.delivered += state[4]
+                self.delivered_time = now
+                # The sample comes from the most recently sent packet.
+                if latest is None or state[3] > latest[3]:
+                    latest = state
+
+            if latest is None:
+                return
+
+            (delivered, delivered_time, first_sent_time, sent_time, _) = latest
+            self.first_sent_time = sent_time
+
+            rtt = now - sent_time
+            if not ambiguous and (self.min_rtt is None or rtt < self.min_rtt):
+                self.min_rtt = rtt
+
+            if delivered >= self.next_round_delivered:
+                self.round_count += 1
+                self.next_round_delivered = self.delivered
+                round_start = True
+            else:
+                round_start = False
+
+            if self.min_rtt is None:
+                return
+
+            # The slower of sending and acking is the bottleneck; acks that
+            # arrive in a bunch mustn't make the rate look higher than it is.
+            interval = max(sent_time - first_sent_time, now - delivered_time)
+            if interval >= self.min_rtt and interval > 0:
+                self.__add_sample((self.delivered - delivered) / interval)
+
+            self.__update_state(now, round_start)
+
+    def __add_sample(self, rate: float):
+        samples = self.bandwidth_samples
+        while len(samples) > 0 and samples[-1][1] <= rate:
+            samples.pop()
+        samples.append((self.round_count, rate))
+        while samples[0][0] <= self.round_count - BANDWIDTH_WINDOW:
+            samples.popleft()
+
+    def __update_state(self, now: float, round_start: bool):
+        bandwidth = self.bandwidth
+        if bandwidth is None:
+            return
+
+        if self.state == STARTUP and round_start:
+            if bandwidth >= self.full_bandwidth * FULL_BANDWIDTH_GROWTH:
+                self.full_bandwidth = bandwidth
+                self.full_bandwidth_rounds = 0
+            else:
+                self.full_bandwidth_rounds += 1
+                if self.full_bandwidth_rounds >= FULL_BANDWIDTH_ROUNDS:
+                    self.state = DRAIN
+                    self.drain_round = self.round_count
+                    self.logger.debug("Pipe full at %.0f B/s, draining.", bandwidth)
+        elif self.state == DRAIN and self.round_count > self.drain_round:
+            # What startup queued has had a round trip to drain.
+            self.state = PROBE_BW
+            self.cycle_index = 0
+            self.cycle_start = now
+        elif self.state == PROBE_BW and now - self.cycle_start >= self.min_rtt:
+            self.cycle_index = (self.cycle_index + 1) % len(PROBE_BW_GAINS)
+            self.cycle_start = now
+
+    def stats(self) -> Dict:
+        with self.lock:
+            elapsed = None
+            if self.first_send is not None:
+                elapsed = self.last_send - self.first_send
+
+            return {
+                "enabled": self.enabled,
+                "state": self.state,
+                "bandwidth": self.bandwidth,
+                "pacing_rate": self.pacing_rate,
+                "min_rtt": self.min_rtt,
+                "rounds": self.round_count,
+                "bytes_sent": self.bytes_sent,
+                # The rate the socket writer actually sent at.
+                "achieved_rate": self.bytes_sent / elapsed if elapsed else None,
+            }
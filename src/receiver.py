@@ -1,36 +1,92 @@
-import heapq
-import json
 import sys
-from base64 import b64decode
+import time
 from socket import socket
-from typing import Any, Dict, Optional
-
-from src.checksum import compute_checksum, verify_checksum
-from src.constants import ACKNOWLEDGED, CHECKSUM, END_OF_FILE, SEQUENCE_NUMBER
+from typing import Any, BinaryIO, Dict, List, Optional, Sequence, Tuple
+
+from src import checksum, wire
+from src.datagram_io import Address, DatagramIO
+from src.fec import FecDecoder
+from src.constants import (
+    CHECKSUM_ALGORITHM,
+    CLOSE,
+    CONNECTION_ID,
+    DATA,
+    END_OF_FILE,
+    HELLO,
+    PROBE,
+    REPAIR,
+    REPAIR_LENGTH,
+    SEQUENCE_NUMBER,
+)
 from src.logging import get_logger
+from src.metrics import Metrics, receiver_metrics
+from src.reorder_buffer import ReorderBuffer
+
+# How many SACK blocks to put in each ack, at most.
+MAX_SACK_BLOCKS = 4
+# How many packets past the hcp we're willing to buffer, by default.
+RECEIVE_WINDOW = 1024
+# The window never shrinks below this to make room for bigger datagrams: it
+# would hold the sender back more than the bigger datagrams speed it up.
+MIN_RECEIVE_WINDOW = 16
+# In-order packets are acked every ACK_EVERY packets, or ACK_DELAY after the
+# first one that hasn't been, whichever comes first. The sender allows for the
+# delay in its RTO (MAX_ACK_DELAY in src/rtt.py), so the two have to agree.
+ACK_EVERY = 2  # packets
+ACK_DELAY = 0.02  # seconds
+# How many copies of the EOF ack to send at once. Any the sender misses are
+# made up for by acking its EOF again when it's retransmitted.
+EOF_ACKS = 2
+# Once everything has been received and the EOF acked, how long to wait for
+# the sender's close before giving up on it: long enough for the sender to
+# retransmit its EOF if it missed every EOF ack. It isn't extended by packets
+# that arrive in the meantime, since on a slow link those can be queued up
+# retransmissions sent long before our EOF ack arrived.
+LINGER_TIME = 1  # seconds
 
 
 class Receiver:
     """
     Class that binds together data and behaviour for the thread that receives
     data in 4254recv.
+
+    run drives it from its own socket, for a single connection. A
+    ReceiverServer (src/server.py) drives one per connection instead, through
+    handle_packet, flush and the delayed ack and EOF methods.
     """
 
-    def __init__(self, sock: socket, message_size: int):
+    def __init__(
+        self,
+        sock: socket,
+        message_size: int,
+        receive_window: int = RECEIVE_WINDOW,
+        output: BinaryIO = sys.stdout.buffer,
+        datagram_io: Optional[DatagramIO] = None,
+        ack_every: int = ACK_EVERY,
+        ack_delay: float = ACK_DELAY,
+        metrics: Optional[Metrics] = None,
+    ):
         self.sock = sock
         self.message_size = message_size
-
-        # ACK and duplicate handling
-
-        # Highest Cumulative Packet number
-        self.hcp = 0
-        # Other packet numbers received with sequence > hcp
-        self.other_packets = []
-
-        # Ordering handling
-
-        # All packets received so far
-        self.received_packets = []
+        if datagram_io is None:
+            datagram_io = DatagramIO(sock, message_size)
+        self.datagram_io = datagram_io
+        self.receive_window = receive_window
+        self.output = output
+
+        # ACK, duplicate and ordering handling
+
+        # Packets received above the hcp, waiting for the gap below them to be
+        # filled. Everything up to the hcp has already been written to the
+        # output, so this is all the data we hold on to. No payload is bigger
+        # than a datagram, even decompressed: the sender only compresses what
+        # it could have sent as it is.
+        self.reorder_buffer = ReorderBuffer(receive_window, message_size)
+        # What the slots come to. If the sender probes for bigger datagrams,
+        # the window shrinks to keep them to this.
+        self.buffer_size = receive_window * message_size
+        # Rebuilds lost packets from repair packets, if the sender sends any.
+        self.fec = FecDecoder(self.reorder_buffer)
 
         # EOF handling (since the EOF can arrive out of order.)
 
@@ -40,18 +96,142 @@ class Receiver:
         self.max_packets = 0
         self.eof_address = None
 
+        # Acks are sent back in whichever format and checksum algorithm the
+        # sender is using.
+        self.wire_format = wire.BINARY
+        self.checksum_algorithm = checksum.CRC32
+        # And with the sender's connection ID, if it sends one.
+        self.connection_id: Optional[int] = None
+        # Acks for the batch of packets being handled, sent together once the
+        # whole batch has been.
+        self.acks_to_send: List[Tuple[bytes, Address]] = []
+
+        # Delayed acks: in-order packets received since the last ack, and when
+        # and where one is due for them.
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay
+        self.unacked_packets = 0
+        self.ack_deadline: Optional[float] = None
+        self.ack_address: Optional[Address] = None
+        # How long to wait for a packet when no ack is due.
+        self.timeout = sock.gettimeout()
+
+        self.packets_received = 0
+        self.acks_sent = 0
+        self.metrics = metrics or receiver_metrics(enabled=False)
+        if self.metrics.enabled:
+            self.metrics.add_gauges(self.gauges)
+
         self.logger = get_logger("[4254recv] Receiver")
 
-    def __generate_ack_packet(self, pn: Any) -> Dict:
+    @property
+    def hcp(self) -> int:
         """
-        Generate an ack packet for packet number pn with the checksum included.
+        Highest Cumulative Packet number
         """
 
-        packet = {ACKNOWLEDGED: pn}
-        cksum = compute_checksum(packet)
-        packet[CHECKSUM] = cksum
+        return self.reorder_buffer.hcp
 
-        return packet
+    @property
+    def finished(self) -> bool:
+        """
+        Whether the EOF packet and every packet before it have been received.
+        """
+
+        return self.reached_eof and self.hcp == self.max_packets
+
+    def __generate_ack_packet(
+        self, pn: Any, sack_blocks: Sequence[Tuple[int, int]] = ()
+    ) -> bytes:
+        """
+        Generate an encoded ack packet for packet number pn with the checksum
+        included.
+        """
+
+        return wire.encode_ack(
+            pn,
+            fmt=self.wire_format,
+            algorithm=self.checksum_algorithm,
+            sack_blocks=sack_blocks,
+            receive_window=self.receive_window,
+            connection_id=self.connection_id,
+        )
+
+    def __send_ack(self, address):
+        """
+        Ack the hcp to address, with SACK blocks for everything held above it.
+        """
+
+        self.logger.debug("Acking packet number %s", self.hcp)
+        ack_packet = self.__generate_ack_packet(
+            self.hcp, self.reorder_buffer.sack_blocks(MAX_SACK_BLOCKS)
+        )
+        self.acks_to_send.append((ack_packet, address))
+
+        # This covers everything received so far.
+        self.unacked_packets = 0
+        self.ack_deadline = None
+
+    def __delay_ack(self, address):
+        """
+        Ack an in-order packet once ack_every of them have arrived, or once
+        ack_delay has passed, rather than straight away.
+        """
+
+        self.unacked_packets += 1
+        self.ack_address = address
+
+        if self.unacked_packets >= self.ack_every:
+            self.__send_ack(address)
+        elif self.ack_deadline is None:
+            self.ack_deadline = time.monotonic() + self.ack_delay
+
+    def __wait_for_ack_deadline(self) -> bool:
+        """
+        Make the next read from the socket wait no longer than until the
+        delayed ack is due. Returns False if it's due already.
+        """
+
+        if self.ack_deadline is None:
+            if self.sock.gettimeout() != self.timeout:
+                self.sock.settimeout(self.timeout)
+            return True
+
+        remaining = self.ack_deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+
+        self.sock.settimeout(remaining)
+        return True
+
+    def send_delayed_ack(self):
+        """
+        Send the delayed ack, now that it's due.
+        """
+
+        self.__send_ack(self.ack_address)
+        self.__flush_acks()
+
+    def __flush_acks(self):
+        """
+        Send the acks for the last batch, as few system calls as possible.
+        """
+
+        start = 0
+        while start < len(self.acks_to_send):
+            address = self.acks_to_send[start][1]
+            end = start + 1
+            while end < len(self.acks_to_send) and self.acks_to_send[end][1] == address:
+                end += 1
+
+            self.datagram_io.send_batch(
+                [ack_packet for (ack_packet, _) in self.acks_to_send[start:end]],
+                address,
+            )
+            start = end
+
+        self.acks_sent += len(self.acks_to_send)
+        self.acks_to_send.clear()
 
     def __handle_eof_packet(self, pn: int, addr):
         """
@@ -68,104 +248,288 @@ class Receiver:
         self.reached_eof = True
         self.eof_address = addr
 
-    def __packet_number_to_ack(self, pn: int) -> Optional[int]:
+    def eof_ack(self) -> bytes:
+        return self.__generate_ack_packet(END_OF_FILE)
+
+    def ack_eof(self):
+        if self.ack_deadline is not None:
+            # The EOF ack covers these too, but the sender can still make use
+            # of this one if the EOF acks are all lost.
+            self.__send_ack(self.ack_address)
+
+        self.logger.debug("Acking EOF %s times.", EOF_ACKS)
+        eof_ack = self.eof_ack()
+        self.acks_to_send.extend((eof_ack, self.eof_address) for _ in range(EOF_ACKS))
+        self.__flush_acks()
+
+    def linger(self, linger_time: float = LINGER_TIME):
+        """
+        After acking the EOF, wait for the sender to close the connection,
+        acking the EOF again for anything else it sends: it only sends more if
+        none of the EOF acks made it. Gives up after linger_time, in case the
+        close got lost instead.
+        """
+
+        deadline = time.monotonic() + linger_time
+        eof_ack = self.eof_ack()
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.logger.info(
+                    "No close from the sender after %ss; quitting.", linger_time
+                )
+                return
+
+            self.sock.settimeout(remaining)
+            try:
+                received_data = self.datagram_io.recv_batch()
+            except TimeoutError:
+                continue
+
+            for (data, address) in received_data:
+                packet = wire.decode(data)
+                if packet is None or SEQUENCE_NUMBER not in packet:
+                    continue
+
+                if CLOSE in packet:
+                    self.logger.info("Sender closed the connection; quitting.")
+                    return
+
+                self.logger.debug("Sender is still at it; acking EOF again.")
+                self.datagram_io.send_batch([eof_ack], address)
+                self.acks_sent += 1
+
+    def __handle_data(self, pn: int, data: bytes, address):
         """
-        Compute which packet number to send in the ack when a packet with number
-        pn is received.
+        Writes out, buffers or drops data packet pn, and acks it.
         """
 
-        self.logger.debug("Ack logic for pn %s, curent hcp %s", pn, self.hcp)
+        if pn > self.hcp + self.receive_window:
+            # Beyond what we advertised we'd buffer, so drop it; the sender
+            # will have to send it again once the window has moved.
+            self.logger.debug("Packet %s is outside the receive window.", pn)
+            self.metrics.count("out_of_window_packets")
+            return
+
+        if pn in self.reorder_buffer:
+            # The sender only retransmits what it thinks is lost, so our ack
+            # for it may have been lost instead. Ack again, so that the sender
+            # doesn't have to wait for a packet we haven't received.
+            self.logger.debug("Packet received was duplicate, re-acking.")
+            self.metrics.count("duplicate_packets")
+            self.__send_ack(address)
+            return
 
-        if pn <= self.hcp or pn in self.other_packets:
-            # Duplicate packet, do nothing.
-            return None
+        self.metrics.observe("reorder_distance", pn - self.hcp - 1)
 
         if pn == self.hcp + 1:
-            # Next packet
-            self.hcp = pn
-
-            # If the lowest packet in other_packets is sequentially after hcp,
-            # pop it and incrememnt hcp.
-            while len(self.other_packets) > 0:
-                lowest_other_packet = self.other_packets[0]
-
-                if lowest_other_packet == self.hcp + 1:
-                    self.hcp = lowest_other_packet
-                    heapq.heappop(self.other_packets)
-                else:
-                    break
+            # Filling a hole is acked straight away, so the sender learns
+            # about it as soon as possible.
+            filled_hole = len(self.reorder_buffer.blocks) > 0
+            # Everything stored right after it can go out now too.
+            payloads = self.reorder_buffer.advance()
+            if filled_hole:
+                self.__send_ack(address)
+            else:
+                self.__delay_ack(address)
+
+            # Kept in case it's needed to rebuild another packet in its group.
+            self.reorder_buffer.keep(pn, data)
+            self.output.write(data)
+            delivered = len(data)
+            for payload in payloads:
+                self.output.write(payload)
+                delivered += len(payload)
+            self.metrics.count("bytes_delivered", delivered)
         else:
-            heapq.heappush(self.other_packets, pn)
+            # Out of order, so acked straight away: the sender counts these
+            # duplicate acks, and needs the SACK blocks.
+            self.reorder_buffer.store(pn, data)
+            self.__send_ack(address)
+
+        recovered = self.fec.on_data(pn)
+        if recovered is not None:
+            self.__handle_data(*recovered, address)
 
-        return self.hcp
+    def __handle_repair(self, pn: int, packet: Dict, address):
+        """
+        Rebuilds the packet the repair packet for the group starting at pn
+        covers, if that's the only one missing.
+        """
+
+        self.metrics.count("repairs_received")
+        recovered = self.fec.on_repair(
+            pn, packet[REPAIR], packet[REPAIR_LENGTH], packet[DATA]
+        )
+        if recovered is not None:
+            self.__handle_data(*recovered, address)
+
+    def __handle_hello(self, attempt: int, max_datagram: int, address):
+        """
+        Answers the sender's hello with the largest datagram we'll take, as
+        long as it's no larger than the sender's, and our window.
+        """
+
+        self.logger.info("Hello from the sender, attempt %s.", attempt)
+        hello_ack = wire.encode_hello_ack(
+            attempt,
+            min(max_datagram, self.datagram_io.message_size),
+            self.receive_window,
+            fmt=self.wire_format,
+            algorithm=self.checksum_algorithm,
+            connection_id=self.connection_id,
+        )
+        self.acks_to_send.append((hello_ack, address))
+
+    def __handle_probe(self, size: int, length: int, address):
+        """
+        Acks a path MTU probe of size bytes, once the slots are big enough for
+        packets that size: a payload is always smaller than the datagram it
+        came in, so a slot a probe fits in fits any packet no bigger than it.
+        """
 
-    def __ack_eof(self):
-        # Doing it 10 times so that the chances of it getting dropped are low.
-        self.logger.debug("Acking EOF 10 times.")
-        ack_packet = json.dumps(self.__generate_ack_packet(END_OF_FILE)).encode()
-        for _ in range(10):
-            self.sock.sendto(ack_packet, self.eof_address)
+        if length != size:
+            return
+
+        if size > self.reorder_buffer.slot_size:
+            window = min(
+                max(self.buffer_size // size, MIN_RECEIVE_WINDOW), self.receive_window
+            )
+            if not self.reorder_buffer.resize(window, size):
+                # Packets are held in the slots, so data is well under way
+                # already; the sender has long stopped waiting for this ack.
+                self.logger.debug("Not acking a late probe of %s bytes.", size)
+                return
+
+            self.logger.info(
+                "Resized slots for %s byte datagrams; window is %s packets.",
+                size,
+                window,
+            )
+            self.receive_window = window
+
+        probe_ack = wire.encode_probe_ack(
+            size,
+            self.receive_window,
+            algorithm=self.checksum_algorithm,
+            connection_id=self.connection_id,
+        )
+        self.acks_to_send.append((probe_ack, address))
 
     def run(self):
         """
-        Reads from the socket, puts non-duplicate received packets into the
-        received_packets heap, and acks as described in the design.
+        Reads from the socket, writes received packets to the output as soon as
+        everything before them has been written, buffering the ones that
+        arrive out of order, and acks as described in the design.
         """
 
         self.logger.info("Starting to read from socket.")
 
         while True:
-            if self.reached_eof and self.hcp == self.max_packets:
+            if self.finished:
                 self.logger.info(
-                    "Received EOF and all packets; acking EOF and quitting."
+                    "Received EOF and all packets; acking EOF and lingering."
                 )
-                self.__ack_eof()
+                self.ack_eof()
+                self.log_stats()
+                self.linger()
                 break
 
-            received_data = self.sock.recvfrom(self.message_size)
+            if not self.__wait_for_ack_deadline():
+                self.send_delayed_ack()
+                continue
+
+            try:
+                received_data = self.datagram_io.recv_batch()
+            except TimeoutError:
+                if self.ack_deadline is None:
+                    raise
+                # Nothing arrived before the delayed ack was due.
+                continue
 
             if not received_data:
                 self.logger.info("Socket timed out; quitting.")
                 break
 
-            (data, address) = received_data
-            decoded_data = data.decode()
-            packet = json.loads(decoded_data)
+            for (data, address) in received_data:
+                packet = wire.decode(data)
 
-            if not verify_checksum(packet):
-                # Corrupted packet, ignore.
-                continue
+                if packet is None or SEQUENCE_NUMBER not in packet:
+                    # Corrupted packet, ignore.
+                    self.metrics.count("corrupt_packets")
+                    continue
 
-            pn = int(packet[SEQUENCE_NUMBER])
-            self.logger.debug("Received %s bytes of packet %s", len(decoded_data), pn)
+                self.handle_packet(packet, data, address)
 
-            if packet[END_OF_FILE]:
-                self.__handle_eof_packet(pn, address)
-                # We don't expect the EOF packet to have any data!
-                continue
+            self.flush()
 
-            pn_to_ack = self.__packet_number_to_ack(pn)
-            if pn_to_ack is None:
-                self.logger.debug("Packet received was duplicate, doing nothing.")
-                continue
+    def handle_packet(self, packet: Dict, data: bytes, address):
+        """
+        Handles a decoded data, EOF, repair, hello or probe packet, which
+        arrived as datagram data from address. Acks are only sent once flush is called.
+        """
 
-            self.logger.debug(
-                "Acking packet number %s for received packet %s", pn_to_ack, pn
-            )
-            ack_packet = self.__generate_ack_packet(pn_to_ack)
-            self.sock.sendto(json.dumps(ack_packet).encode(), address)
+        if CLOSE in packet:
+            # A late one, from the last connection on this port.
+            return
+
+        self.packets_received += 1
+        self.wire_format = wire.wire_format(data)
+        self.checksum_algorithm = packet[CHECKSUM_ALGORITHM]
+        self.connection_id = packet.get(CONNECTION_ID)
+        if self.metrics.connection is None and self.connection_id is not None:
+            self.metrics.connection = f"{self.connection_id:08x}"
+        pn = int(packet[SEQUENCE_NUMBER])
+        self.logger.debug("Received %s bytes of packet %s", len(data), pn)
+
+        if HELLO in packet:
+            self.__handle_hello(pn, packet[HELLO], address)
+            return
+
+        if PROBE in packet:
+            self.__handle_probe(pn, len(data), address)
+            return
+
+        if REPAIR in packet:
+            self.__handle_repair(pn, packet, address)
+            return
 
-            heapq.heappush(self.received_packets, (pn, packet))
+        if packet[END_OF_FILE]:
+            self.__handle_eof_packet(pn, address)
+            # We don't expect the EOF packet to have any data!
+            return
 
-    def print(self):
+        self.__handle_data(pn, packet[DATA], address)
+
+    def flush(self):
+        """
+        Flushes the output, and sends the acks for the packets handled since
+        the last flush.
+        """
+
+        self.output.flush()
+        self.__flush_acks()
+
+    def gauges(self) -> Dict[str, Any]:
         """
-        Prints the received packets in order.
+        What the metrics read off the receiver for each snapshot.
         """
 
-        self.logger.info("Proceeding to print received data to STDOUT")
-        self.logger.info("Received: %s packets", len(self.received_packets))
-        while len(self.received_packets) > 0:
-            (_, decoded) = heapq.heappop(self.received_packets)
-            if decoded["data"]:
-                data = b64decode(decoded["data"].encode())
-                sys.stdout.buffer.write(data)
+        elapsed = self.metrics.elapsed()
+        return {
+            "packets_received": self.packets_received,
+            "acks_sent": self.acks_sent,
+            "packets_rebuilt": self.fec.recovered,
+            "hcp": self.hcp,
+            "receive_window": self.receive_window,
+            "goodput": self.metrics.counters["bytes_delivered"] / elapsed,
+        }
+
+    def log_stats(self):
+        self.logger.info(
+            "Received %s packets, rebuilt %s, sent %s acks.",
+            self.packets_received,
+            self.fec.recovered,
+            self.acks_sent,
+        )
@@ -0,0 +1,266 @@
+import math
+from collections import deque
+from threading import Lock
+from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from src.rtt import RttEstimator
+from src.timers import TimerQueue
+
+# The timer in the sender's timer queue for the reorder window and tail loss
+# probes. Packet numbers are never negative, so it never clashes with a
+# packet's, even in ranges of them starting from a cumulative ack of 0.
+RECOVERY_TIMER = -1
+
+# A packet sent before one that has been delivered gets this fraction of the
+# minimum RTT on top of that packet's RTT to turn up, in case it was only
+# reordered, before it's presumed lost (RFC 8985's reordering window).
+REORDER_WINDOW_FRACTION = 1 / 4
+# Thread wake-ups aren't much more precise than this.
+MIN_REORDER_WINDOW = 0.002  # seconds
+# Every retransmission that turns out to have been spurious widens the window
+# by another REORDER_WINDOW_FRACTION of the minimum RTT, up to this many times.
+# It's never wider than SRTT.
+MAX_REORDER_MULTIPLIER = 8
+# Shortest time to wait for an ack before probing the tail of a flight.
+MIN_PROBE_TIMEOUT = 0.01  # seconds
+
+
+class LossRecovery:
+    """
+    Works out which packets in flight are lost from when they were sent, rather
+    than from how many packets were SACKed above them (RACK, RFC 8985), and
+    when to probe for losses at the tail of a flight (TLP).
+
+    A packet is lost once a packet sent after it has been delivered, and it's
+    been outstanding for longer than that packet's RTT, plus the reorder window.
+    Packets are kept in the order they were sent, so only the oldest ever need
+    looking at; entries for packets that have since been delivered, or taken
+    out to be retransmitted, are skipped once they reach the front, as in the
+    timer queue.
+
+    If nothing is delivered for a couple of RTTs while packets are in flight,
+    the last of them are probably lost, with nothing sent after them to show
+    it. Rather than waiting out the RTO, the highest outstanding packet is sent
+    again as a probe, whose ack then shows which ones are missing.
+
+    Both share a single timer in the timer queue, which is only ever moved
+    earlier; when it expires late deadlines are armed again, so that acks and
+    bursts pushing the probe back don't keep waking the timeout thread. When
+    it's armed for is always asked of the timer queue, so a timer that expired
+    or was cancelled is never mistaken for one still armed.
+    """
+
+    def __init__(self, rtt: RttEstimator, timers: TimerQueue):
+        self.lock = Lock()
+        self.rtt = rtt
+        self.timers = timers
+
+        # Send time and RTT of the most recently sent packet known to have
+        # been delivered.
+        self.delivered_sent_time = -math.inf
+        self.delivered_rtt = 0.0
+        # Lowest RTT of a packet that had only been sent once.
+        self.min_rtt = math.inf
+        self.reorder_multiplier = 1
+
+        # (sent time, pn) for every packet sent, oldest first, including ones
+        # no longer outstanding that haven't reached the front yet.
+        self.sent: Deque[Tuple[float, int]] = deque()
+        # Packets retransmitted that haven't been delivered since.
+        self.retransmitted: Set[int] = set()
+
+        # When the oldest outstanding packet sent before the last delivered one
+        # is lost, if it's still outstanding then.
+        self.reorder_deadline: Optional[float] = None
+        # When to probe, if nothing has been delivered by then.
+        self.probe_deadline: Optional[float] = None
+        # Only one probe per flight; the next delivery allows another.
+        self.probed = False
+
+        self.spurious_retransmissions = 0
+
+    def on_sent(self, sent: Iterable[int], retransmitted: Iterable[int], now: float):
+        """
+        Called by the socket writer after each burst, with the packets in it,
+        and those of them that were sent before.
+        """
+
+        with self.lock:
+            self.sent.extend((now, pn) for pn in sent)
+            self.retransmitted.update(retransmitted)
+            self.__arm_probe(now)
+            self.__schedule()
+
+    def on_ack(
+        self,
+        delivered: List[Tuple[int, float]],
+        hcap: int,
+        outstanding_packets: Dict[int, Tuple[bytes, float]],
+        now: float,
+    ) -> List[int]:
+        """
+        Called by the socket reader for each ack that delivers anything, with
+        the packets it newly acked or SACKed, each with the time it was last
+        sent, and with the lock on outstanding_packets held. Returns the
+        outstanding packets that are lost by now, oldest first, for the caller
+        to take out of outstanding_packets and retransmit.
+        """
+
+        with self.lock:
+            for (pn, sent_time) in delivered:
+                rtt = now - sent_time
+
+                if pn in self.retransmitted:
+                    self.retransmitted.discard(pn)
+                    if rtt < self.min_rtt:
+                        # Too quick to be the retransmission's ack, so the
+                        # first transmission made it after all, and the
+                        # reorder window was too narrow.
+                        self.spurious_retransmissions += 1
+                        self.reorder_multiplier = min(
+                            self.reorder_multiplier + 1, MAX_REORDER_MULTIPLIER
+                        )
+                    # Either way, there's no telling which transmission this
+                    # is for. Taking it for the last one after a spurious
+                    # retransmission would make everything sent before it
+                    # look lost; packets sent after it show soon enough if it
+                    # was lost again.
+                    continue
+
+                self.min_rtt = min(self.min_rtt, rtt)
+                if sent_time >= self.delivered_sent_time:
+                    self.delivered_sent_time = sent_time
+                    self.delivered_rtt = rtt
+
+            if len(self.retransmitted) > 0:
+                # Retransmissions acked while still queued are never sent, so
+                # they never show up above.
+                self.retransmitted = {pn for pn in self.retransmitted if pn > hcap}
+
+            self.probed = False
+            lost = self.__detect_losses(outstanding_packets, now)
+
+            self.probe_deadline = None
+            if len(outstanding_packets) > len(lost):
+                self.__arm_probe(now)
+            self.__schedule()
+
+            return lost
+
+    def is_retransmitted(self, pn: int) -> bool:
+        with self.lock:
+            return pn in self.retransmitted
+
+    def on_expired(
+        self, outstanding_packets: Dict[int, Tuple[bytes, float]], now: float
+    ) -> Tuple[List[int], Optional[int]]:
+        """
+        Called by the timeout thread when the recovery timer expires, with the
+        lock on outstanding_packets held. Returns the packets that are lost by
+        now, and the packet to send as a probe, if it's time for one.
+        """
+
+        with self.lock:
+            lost = self.__detect_losses(outstanding_packets, now)
+
+            probe = None
+            if len(lost) > 0:
+                # Those retransmissions will show what else is missing.
+                self.probe_deadline = None
+            elif (
+                self.probe_deadline is not None
+                and now >= self.probe_deadline
+                and len(outstanding_packets) > 0
+            ):
+                # The highest packet sent, as its ack says the most about
+                # what else is missing.
+                probe = max(outstanding_packets)
+                self.probed = True
+                self.probe_deadline = None
+
+            self.__schedule()
+            return (lost, probe)
+
+    def reorder_window(self) -> float:
+        window = self.reorder_multiplier * self.min_rtt * REORDER_WINDOW_FRACTION
+        srtt = self.rtt.srtt
+        if srtt is not None:
+            window = min(window, srtt)
+        return max(window, MIN_REORDER_WINDOW)
+
+    def probe_timeout(self) -> Optional[float]:
+        """
+        Two RTTs, plus however long the receiver may hold the ack back, or None
+        if that's no sooner than the retransmission timer would fire anyway.
+        """
+
+        srtt = self.rtt.srtt
+        if srtt is None:
+            return None
+
+        timeout = max(2 * srtt, MIN_PROBE_TIMEOUT) + self.rtt.max_ack_delay
+        if timeout >= self.rtt.rto:
+            return None
+        return timeout
+
+    def stats(self) -> Dict:
+        return {
+            "min_rtt": self.min_rtt,
+            "reorder_window": self.reorder_window(),
+            "spurious_retransmissions": self.spurious_retransmissions,
+        }
+
+    def __detect_losses(
+        self, outstanding_packets: Dict[int, Tuple[bytes, float]], now: float
+    ) -> List[int]:
+        self.reorder_deadline = None
+        if self.delivered_sent_time == -math.inf:
+            return []
+
+        window = self.delivered_rtt + self.reorder_window()
+        lost = []
+        while len(self.sent) > 0:
+            (sent_time, pn) = self.sent[0]
+            outstanding = outstanding_packets.get(pn)
+            if outstanding is None or outstanding[1] != sent_time:
+                self.sent.popleft()
+                continue
+
+            if sent_time > self.delivered_sent_time:
+                # This and everything after it was sent after the last
+                # delivered packet; nothing says they're lost yet.
+                break
+
+            deadline = sent_time + window
+            if deadline > now:
+                # Not lost yet, but it will be then, unless it's delivered in
+                # the meantime.
+                self.reorder_deadline = deadline
+                break
+
+            self.sent.popleft()
+            lost.append(pn)
+
+        return lost
+
+    def __arm_probe(self, now: float):
+        if self.probed:
+            return
+
+        timeout = self.probe_timeout()
+        if timeout is not None:
+            self.probe_deadline = now + timeout
+
+    def __schedule(self):
+        deadline = self.reorder_deadline
+        if deadline is None or (
+            self.probe_deadline is not None and self.probe_deadline < deadline
+        ):
+            deadline = self.probe_deadline
+        if deadline is None:
+            # If it's armed, it'll find nothing to do when it expires.
+            return
+
+        timer_deadline = self.timers.deadline(RECOVERY_TIMER)
+        if timer_deadline is None or deadline < timer_deadline:
+            self.timers.schedule(RECOVERY_TIMER, deadline)
@@ -0,0 +1,175 @@
+from collections import OrderedDict
+from itertools import islice
+from typing import Dict, List, Optional, Tuple
+
+
+class ReorderBuffer:
+    """
+    Holds the packets received above the highest cumulative packet (hcp) until
+    the holes below them are filled.
+
+    Payloads live in a ring of preallocated slots indexed by packet number
+    modulo the capacity, with a bitmap recording which slots are full, so
+    checking for duplicates, storing a packet and advancing the hcp are all
+    O(1) per packet no matter how badly packets are reordered.
+
+    The slots, which are most of its memory, are only allocated once they're
+    needed, and can be given back with release while nothing is held in them,
+    so idle connections cost next to nothing. Likewise, they can be resized
+    while nothing is held, as they are when the sender probes for bigger
+    datagrams.
+    """
+
+    def __init__(self, capacity: int, slot_size: int):
+        self.capacity = capacity
+        self.slot_size = slot_size
+
+        # Highest Cumulative Packet number
+        self.hcp = 0
+
+        self.slots: Optional[bytearray] = None
+        self.lengths = [0] * capacity
+        self.present = bytearray((capacity + 7) // 8)
+        # Which packet's payload each slot holds, if any. Slots keep their
+        # payloads after the hcp has moved past them, until they're reused.
+        self.owners = [0] * capacity
+
+        # The runs of consecutive packets held in the buffer, start -> end
+        # (inclusive), least recently extended first. Kept up to date as
+        # packets arrive, so the SACK blocks never have to be worked out by
+        # scanning the buffer.
+        self.blocks: "OrderedDict[int, int]" = OrderedDict()
+        # The same runs, end -> start.
+        self.block_ends: Dict[int, int] = {}
+
+    def __contains__(self, pn: int) -> bool:
+        """
+        Whether packet pn has already been received. pn must not be more than
+        capacity packets past the hcp.
+        """
+
+        if pn <= self.hcp:
+            return True
+
+        index = pn % self.capacity
+        return bool(self.present[index >> 3] & (1 << (index & 7)))
+
+    def store(self, pn: int, data: bytes):
+        """
+        Copies the payload of packet pn, which is above hcp + 1 and hasn't been
+        received yet, into its slot.
+        """
+
+        index = self.keep(pn, data)
+        self.present[index >> 3] |= 1 << (index & 7)
+
+        # Join the run ending just below pn and the one starting just above it,
+        # if there are any.
+        start = self.block_ends.pop(pn - 1, pn)
+        end = self.blocks.pop(pn + 1, pn)
+        self.blocks.pop(start, None)
+        self.blocks[start] = end
+        self.block_ends[end] = start
+
+    def keep(self, pn: int, data: bytes) -> int:
+        """
+        Copies the payload of packet pn into its slot, without storing it as
+        received, so that it's still around after it has been written out.
+        Returns the slot's index.
+        """
+
+        if len(data) > self.slot_size:
+            raise ValueError(
+                f"Payload of {len(data)} bytes doesn't fit a {self.slot_size} byte slot."
+            )
+
+        if self.slots is None:
+            self.slots = bytearray(self.capacity * self.slot_size)
+
+        index = pn % self.capacity
+        offset = index * self.slot_size
+        self.slots[offset : offset + len(data)] = data
+        self.lengths[index] = len(data)
+        self.owners[index] = pn
+        return index
+
+    def payload(self, pn: int) -> Optional[memoryview]:
+        """
+        The payload of packet pn, if its slot still holds it.
+        """
+
+        index = pn % self.capacity
+        if self.slots is None or self.owners[index] != pn:
+            return None
+
+        offset = index * self.slot_size
+        return memoryview(self.slots)[offset : offset + self.lengths[index]]
+
+    def advance(self) -> List[memoryview]:
+        """
+        Moves the hcp past packet hcp + 1, which has just been received and
+        isn't stored, and past the run of stored packets that follows it, if
+        any. Returns the payloads of those stored packets, in order.
+
+        The payloads are views of their slots, so they have to be used before
+        anything else is stored.
+        """
+
+        self.hcp += 1
+        payloads = []
+
+        end = self.blocks.pop(self.hcp + 1, None)
+        if end is None:
+            return payloads
+
+        del self.block_ends[end]
+        slots = memoryview(self.slots)
+
+        for pn in range(self.hcp + 1, end + 1):
+            index = pn % self.capacity
+            offset = index * self.slot_size
+            payloads.append(slots[offset : offset + self.lengths[index]])
+            self.present[index >> 3] &= ~(1 << (index & 7))
+
+        self.hcp = end
+        return payloads
+
+    def release(self) -> bool:
+        """
+        Frees the slots, unless packets are being held in them. The payloads
+        kept for FEC are lost, so it's only worth doing once no more are
+        expected for a while. Returns whether they were freed.
+        """
+
+        if self.slots is None or len(self.blocks) > 0:
+            return False
+
+        self.slots = None
+        self.owners = [0] * self.capacity
+        return True
+
+    def resize(self, capacity: int, slot_size: int) -> bool:
+        """
+        Changes how many slots there are and how big they are, unless packets
+        are being held in them, much as release does. Returns whether they
+        were changed.
+        """
+
+        if len(self.blocks) > 0:
+            return False
+
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self.slots = None
+        self.lengths = [0] * capacity
+        self.present = bytearray((capacity + 7) // 8)
+        self.owners = [0] * capacity
+        return True
+
+    def sack_blocks(self, limit: int) -> List[Tuple[int, int]]:
+        """
+        Returns up to limit runs of stored packets, most recently extended
+        first, as the RFC 2018 SACK blocks.
+        """
+
+        return list(islice(reversed(self.blocks.items()), limit))
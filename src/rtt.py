@@ -0,0 +1,161 @@
+from collections import deque
+from threading import Lock
+from typing import Deque, Dict, List, Optional, Set
+
+from src.logging import get_logger
+from src.metrics import Metrics, sender_metrics
+
+# Constants from RFC 6298, apart from the minimum RTO: 1s is far too long for
+# the links we run on, where RTTs are in the tens of milliseconds.
+ALPHA = 1 / 8
+BETA = 1 / 4
+K = 4
+CLOCK_GRANULARITY = 0.001  # seconds
+
+INITIAL_RTO = 0.6  # seconds
+MIN_RTO = 0.05  # seconds
+# Well below the sender's socket timeout, so that a run of backed off timeouts
+# can't starve the socket reader of acks for long enough to give up.
+MAX_RTO = 3  # seconds
+# The longest the receiver holds an ack back (its ACK_DELAY). Samples are taken
+# from the packet that triggered each ack, so they never include that wait, but
+# the packet before it may well have sat out the whole of it.
+MAX_ACK_DELAY = 0.02  # seconds
+# On the lossy links we test on, a retransmission that times out has usually
+# just been dropped again, so the backoff is capped at two doublings.
+MAX_BACKOFF = 4
+
+# How many of the most recent samples to keep around for inspection.
+SAMPLES_TO_KEEP = 100
+
+
+class RttEstimator:
+    """
+    Estimates the round trip time from acks, and derives the retransmission
+    timeout from it, as described in RFC 6298.
+
+    The socket writer marks retransmitted packets, the socket reader feeds in
+    samples, and the timeout thread backs the RTO off when packets time out.
+    """
+
+    def __init__(
+        self,
+        initial_rto: float = INITIAL_RTO,
+        min_rto: float = MIN_RTO,
+        max_rto: float = MAX_RTO,
+        max_ack_delay: float = MAX_ACK_DELAY,
+        metrics: Optional[Metrics] = None,
+    ):
+        self.lock = Lock()
+        self.metrics = metrics or sender_metrics(enabled=False)
+
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.max_ack_delay = max_ack_delay
+
+        self.srtt: Optional[float] = None
+        self.rttvar: Optional[float] = None
+        self.base_rto = initial_rto
+        # Doubled when retransmissions time out, reset by the next new ack.
+        self.backoff = 1
+
+        # Most recent samples, in seconds.
+        self.samples: Deque[float] = deque(maxlen=SAMPLES_TO_KEEP)
+
+        # Karn's rule: acks for retransmitted packets are ambiguous, so they
+        # never produce a sample.
+        self.retransmitted: Set[int] = set()
+
+        self.logger = get_logger("[4254send] RttEstimator")
+
+    @property
+    def rto(self) -> float:
+        return min(self.base_rto * self.backoff, self.max_rto)
+
+    def on_retransmit(self, pn: int):
+        with self.lock:
+            self.retransmitted.add(pn)
+
+    def on_ack(self, first_pn: int, last_pn: int, sample: Optional[float]):
+        """
+        Called when packets first_pn to last_pn (inclusive) are newly acked.
+        sample is the time since last_pn was sent, if it was still
+        outstanding.
+        """
+
+        with self.lock:
+            # The path is delivering again, even if this ack yields no sample.
+            self.backoff = 1
+
+            ambiguous = False
+            for pn in range(first_pn, last_pn + 1):
+                if pn in self.retransmitted:
+                    self.retransmitted.discard(pn)
+                    ambiguous = True
+
+            if sample is None or ambiguous:
+                return
+
+            self.__add_sample(sample)
+
+    def on_handshake(self, sample: float):
+        """
+        Called with the round trip of the handshake, before any data has gone
+        out. Its packets are tiny, so it's no sample of how long full ones
+        take, but it does say how far away the receiver is: until the first
+        real sample, the RTO is at least what this one would have made it, so
+        a path far longer than the initial RTO allows for doesn't time the
+        whole first flight out.
+        """
+
+        with self.lock:
+            if self.srtt is not None:
+                return
+
+            rto = sample + max(CLOCK_GRANULARITY, K * sample / 2) + self.max_ack_delay
+            self.base_rto = max(self.base_rto, rto)
+
+    def on_timeout(self, pns: List[int]):
+        """
+        Called with the packets that timed out together. The RTO is backed off
+        once, and only if one of them was already a retransmission: the first
+        timeout of a packet is covered by the current RTO.
+        """
+
+        with self.lock:
+            if not any(pn in self.retransmitted for pn in pns):
+                return
+
+            if self.backoff < MAX_BACKOFF and self.rto < self.max_rto:
+                self.backoff *= 2
+
+            self.logger.debug("Timeout, backing RTO off to %.3f", self.rto)
+
+    def __add_sample(self, sample: float):
+        if self.srtt is None or self.rttvar is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - sample)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * sample
+
+        # Without the ack delay, a path with steady RTTs would bring RTTVAR,
+        # and the RTO with it, down to where every delayed ack times out.
+        variation = max(CLOCK_GRANULARITY, K * self.rttvar)
+        self.base_rto = max(self.srtt + variation + self.max_ack_delay, self.min_rto)
+        self.samples.append(sample)
+        self.metrics.observe("rtt", sample)
+
+    def stats(self) -> Dict:
+        """
+        A snapshot of the estimator's state, for logging and tuning.
+        """
+
+        with self.lock:
+            return {
+                "srtt": self.srtt,
+                "rttvar": self.rttvar,
+                "rto": self.rto,
+                "backoff": self.backoff,
+                "samples": list(self.samples),
+            }
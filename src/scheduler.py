@@ -0,0 +1,190 @@
+import heapq
+from collections import deque
+from queue import Empty
+from threading import Condition
+from typing import Any, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from src.constants import QUIT
+
+# What get hands the socket writer once the sender is quitting.
+QUIT_MESSAGE = (0, {QUIT: True})
+
+
+class SendScheduler:
+    """
+    The packets waiting to be sent, in three lanes, taken in this order:
+
+    1. Retransmissions, lowest packet number first. Each packet is queued for
+       retransmission at most once at a time, and ones that are acked or
+       SACKed before they go out are dropped, since sending them would only
+       waste the link.
+    2. Packets the socket writer took but couldn't send after all, because
+       the socket was full or the window was, put back in the order they came
+       out. They're dropped once delivered too, and a retransmission of one
+       of them isn't queued again.
+    3. New data, as the input reader made it, with repair packets cutting in
+       right after the packets they cover.
+
+    So retransmissions never wait behind new data, however much of it there
+    is, not even a new packet put back to wait for the window, which may well
+    be waiting for those retransmissions to be delivered. And nothing ever
+    waits to be queued: how many new packets there can be is bounded by the
+    send buffer instead.
+    """
+
+    def __init__(self):
+        self.changed = Condition()
+
+        self.front: Deque[Tuple[float, Any]] = deque()
+        # The packet numbers in front.
+        self.requeued: Set[float] = set()
+        # Packet numbers in a min-heap, with the datagrams pending
+        # retransmission alongside them. Entries for packets that are no
+        # longer pending are skipped when they reach the top.
+        self.retransmit_heap: List[int] = []
+        self.retransmits: Dict[int, bytes] = {}
+        self.new: Deque[Tuple[float, Any]] = deque()
+
+        self.quitting = False
+
+        # Retransmissions not queued because the packet already was.
+        self.duplicates_suppressed = 0
+        # Retransmissions dropped because the receiver had the packet by the
+        # time they'd have gone out.
+        self.delivered_suppressed = 0
+
+    def __len__(self) -> int:
+        return len(self.front) + len(self.retransmits) + len(self.new)
+
+    def add_new(self, pn: int, datagram: bytes):
+        with self.changed:
+            self.new.append((pn, datagram))
+            self.changed.notify()
+
+    def add_repair(self, pn: float, repair: Any):
+        # The packets it covers have just gone out, so it's ahead of any new
+        # data still queued.
+        with self.changed:
+            self.new.appendleft((pn, repair))
+            self.changed.notify()
+
+    def add_retransmission(self, pn: int, datagram: bytes) -> bool:
+        """
+        Queues packet pn for retransmission, unless it's queued already.
+        Returns whether it was queued.
+        """
+
+        with self.changed:
+            if pn in self.retransmits or pn in self.requeued:
+                self.duplicates_suppressed += 1
+                return False
+
+            self.retransmits[pn] = datagram
+            heapq.heappush(self.retransmit_heap, pn)
+            self.changed.notify()
+            return True
+
+    def requeue(self, packets: Iterable[Tuple[float, Any]]):
+        """
+        Puts packets taken with get back ahead of new data, in the same order,
+        but for those queued for retransmission since, which go out from there.
+        """
+
+        with self.changed:
+            packets = [(pn, p) for (pn, p) in packets if pn not in self.retransmits]
+            self.front.extendleft(reversed(packets))
+            self.requeued.update(pn for (pn, _) in packets)
+            self.changed.notify()
+
+    def on_delivered(self, hcap: int, sacked: Iterable[int]) -> int:
+        """
+        Drops pending retransmissions, and packets put back, of packets the
+        receiver now has, up to the cumulative ack hcap and the newly SACKed
+        ones. Returns how many retransmissions were dropped; packets put back
+        had already been taken for sending, so they aren't counted.
+        """
+
+        if len(self.retransmits) == 0 and len(self.front) == 0:
+            # Checked without the lock, as it nearly always holds on an ack,
+            # and it needn't be exact: at worst, a retransmission queued just
+            # now goes out as if the ack had come a moment later.
+            return 0
+
+        with self.changed:
+            sacked = set(sacked)
+
+            if len(self.front) > 0:
+                kept = [
+                    (pn, packet)
+                    for (pn, packet) in self.front
+                    if pn > hcap and pn not in sacked
+                ]
+                self.delivered_suppressed += len(self.front) - len(kept)
+                self.front = deque(kept)
+                self.requeued = {pn for (pn, _) in kept}
+
+            delivered = [pn for pn in self.retransmits if pn <= hcap or pn in sacked]
+            for pn in delivered:
+                del self.retransmits[pn]
+            self.delivered_suppressed += len(delivered)
+
+            if len(self.retransmit_heap) > 2 * len(self.retransmits) + 64:
+                self.retransmit_heap = list(self.retransmits)
+                heapq.heapify(self.retransmit_heap)
+
+            return len(delivered)
+
+    def quit(self):
+        """
+        From now on, get only ever returns QUIT_MESSAGE.
+        """
+
+        with self.changed:
+            self.quitting = True
+            self.changed.notify_all()
+
+    def get(self, block: bool = True) -> Tuple[float, Any]:
+        """
+        Takes the next packet to send as (pn, packet), waiting for one if block
+        is set, or raising queue.Empty if not.
+        """
+
+        with self.changed:
+            while True:
+                packet = self.__next()
+                if packet is not None:
+                    return packet
+                if not block:
+                    raise Empty
+                self.changed.wait()
+
+    def get_nowait(self) -> Tuple[float, Any]:
+        return self.get(block=False)
+
+    def stats(self) -> Dict:
+        return {
+            "queued_retransmissions": len(self.retransmits),
+            "queued_new": len(self.new),
+            "duplicates_suppressed": self.duplicates_suppressed,
+            "delivered_suppressed": self.delivered_suppressed,
+        }
+
+    def __next(self) -> Optional[Tuple[float, Any]]:
+        if self.quitting:
+            return QUIT_MESSAGE
+
+        while len(self.retransmit_heap) > 0:
+            pn = heapq.heappop(self.retransmit_heap)
+            datagram = self.retransmits.pop(pn, None)
+            if datagram is not None:
+                return (pn, datagram)
+
+        if len(self.front) > 0:
+            (pn, packet) = self.front.popleft()
+            self.requeued.discard(pn)
+            return (pn, packet)
+
+        if len(self.new) > 0:
+            return self.new.popleft()
+
+        return None
@@ -0,0 +1,37 @@
+from typing import List, Sequence, Set, Tuple
+
+
+class SackScoreboard:
+    """
+    Tracks which packets above the cumulative ack the receiver has reported in
+    SACK blocks, so that each one is only taken as delivered once. Which of the
+    holes between them are lost is up to src/recovery.py.
+    """
+
+    def __init__(self):
+        # Packet numbers above the cumulative ack that have been SACKed.
+        self.sacked: Set[int] = set()
+
+    def update(self, hcap: int, blocks: Sequence[Tuple[int, int]]) -> List[int]:
+        """
+        Records the SACK blocks from an ack, and returns the packet numbers
+        that were SACKed for the first time.
+        """
+
+        newly_sacked = []
+
+        for (start, end) in blocks:
+            for pn in range(max(start, hcap + 1), end + 1):
+                if pn not in self.sacked:
+                    self.sacked.add(pn)
+                    newly_sacked.append(pn)
+
+        return newly_sacked
+
+    def advance(self, old_hcap: int, hcap: int):
+        """
+        Forgets about packets that are now covered by the cumulative ack.
+        """
+
+        for pn in range(old_hcap + 1, hcap + 1):
+            self.sacked.discard(pn)
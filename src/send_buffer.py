@@ -0,0 +1,245 @@
+import mmap
+import os
+import stat
+from threading import Condition
+from typing import Dict, Optional, TextIO, Tuple
+
+from src import checksum, wire
+from src.compression import Compressor
+from src.logging import get_logger
+
+# How many packets past the cumulative ack the sender holds on to, by default.
+# It has to be comfortably more than the receive window, or it'll limit how
+# many packets can be in flight.
+SEND_BUFFER_SIZE = 4096  # packets
+
+logger = get_logger("[4254send] send_buffer")
+
+
+class SendBuffer:
+    """
+    Holds every packet the input reader has made that hasn't been acked
+    cumulatively yet, so it can be retransmitted.
+
+    It's bounded: once capacity packets are held, add blocks until acks free
+    some, which holds the input reader back, so the sender's memory doesn't
+    depend on how much input there is.
+    """
+
+    def __init__(self, capacity: int = SEND_BUFFER_SIZE):
+        self.space = Condition()
+        self.capacity = capacity
+
+        self.packets: Dict[int, bytes] = {}
+        # Everything up to here has been acked cumulatively and dropped.
+        self.released_through = 0
+        self.highest_added = 0
+        # The EOF packet's number, once the input reader has made it.
+        self.eof_pn: Optional[int] = None
+
+        self.bytes_held = 0
+        self.peak_packets = 0
+        self.peak_bytes = 0
+        # How many times add had to wait for acks to make room.
+        self.full_waits = 0
+        # Set once the sender is quitting, after which no acks will make room.
+        self.closed = False
+
+    def __len__(self) -> int:
+        return self.highest_added - self.released_through
+
+    def room(self) -> int:
+        """
+        How many more packets can be added without waiting.
+        """
+
+        with self.space:
+            return max(self.capacity - len(self), 0)
+
+    def add(self, pn: int, datagram: bytes, block: bool = True, eof: bool = False):
+        """
+        Holds on to packet pn, the EOF packet if eof is set, waiting for room
+        first if block is set. Otherwise, the caller is expected to have checked
+        room. Once closed, it doesn't wait any more.
+        """
+
+        with self.space:
+            if block and len(self) >= self.capacity:
+                self.full_waits += 1
+                while len(self) >= self.capacity and not self.closed:
+                    self.space.wait()
+
+            self.highest_added = max(self.highest_added, pn)
+            if eof:
+                self.eof_pn = pn
+            self.bytes_held += self._store(pn, datagram)
+            self.peak_packets = max(self.peak_packets, len(self))
+            self.peak_bytes = max(self.peak_bytes, self.bytes_held)
+
+    def __getitem__(self, pn: int) -> bytes:
+        return self.packets[pn]
+
+    def release_through(self, pn: int):
+        """
+        Drops every packet up to and including pn, now that they're acked.
+        """
+
+        with self.space:
+            for pn_to_drop in range(self.released_through + 1, pn + 1):
+                self.bytes_held -= self._drop(pn_to_drop)
+
+            self.released_through = max(self.released_through, pn)
+            self.space.notify_all()
+
+    def close(self):
+        with self.space:
+            self.closed = True
+            self.space.notify_all()
+
+    def stats(self) -> Dict:
+        with self.space:
+            return {
+                "capacity": self.capacity,
+                "packets": len(self),
+                "bytes": self.bytes_held,
+                "peak_packets": self.peak_packets,
+                "peak_bytes": self.peak_bytes,
+                "full_waits": self.full_waits,
+            }
+
+    def _store(self, pn: int, datagram: bytes) -> int:
+        """
+        Keeps the datagram for packet pn, and returns how many bytes that
+        takes up.
+        """
+
+        self.packets[pn] = datagram
+        return len(datagram)
+
+    def _drop(self, pn: int) -> int:
+        """
+        Forgets packet pn, and returns how many bytes that freed.
+        """
+
+        datagram = self.packets.pop(pn, None)
+        return 0 if datagram is None else len(datagram)
+
+
+class MappedPackets(SendBuffer):
+    """
+    The send buffer for when STDIN is a regular file, which is memory-mapped
+    instead of read.
+
+    Nothing is kept per packet: the datagram for packet pn is encoded again
+    from its slice of the mapping whenever it's asked for, which only happens
+    for retransmissions. So the file is never copied onto the heap, beyond
+    the packets queued or in flight. The capacity still applies, to bound
+    those. The compressor decides again whether the payload goes out
+    compressed, which needn't be how it went the first time.
+
+    If byte_range is given, only that (start, end) range of the file is sent,
+    as if it were all there was; that's how striped transfers split a file.
+    """
+
+    def __init__(
+        self,
+        mapping: mmap.mmap,
+        data_size: int,
+        wire_format: str = wire.BINARY,
+        checksum_algorithm: str = checksum.CRC32,
+        capacity: int = SEND_BUFFER_SIZE,
+        compressor: Optional[Compressor] = None,
+        byte_range: Optional[Tuple[int, int]] = None,
+        connection_id: Optional[int] = None,
+    ):
+        super().__init__(capacity)
+
+        self.mapping = mapping
+        self.view = memoryview(mapping)
+        if byte_range is not None:
+            self.view = self.view[byte_range[0] : byte_range[1]]
+        self.data_size = data_size
+        self.wire_format = wire_format
+        self.checksum_algorithm = checksum_algorithm
+        self.compressor = compressor or Compressor(enabled=False)
+        self.connection_id = connection_id
+
+    def chunk(self, pn: int) -> memoryview:
+        """
+        The payload of packet pn, as a slice of the mapping. It's empty for
+        the EOF packet.
+        """
+
+        offset = (pn - 1) * self.data_size
+        return self.view[offset : offset + self.data_size]
+
+    def __getitem__(self, pn: int) -> bytes:
+        chunk = self.chunk(pn)
+        (payload, compressed) = self.compressor.compress(chunk)
+        return wire.encode_data(
+            pn,
+            payload,
+            eof=len(chunk) == 0,
+            fmt=self.wire_format,
+            algorithm=self.checksum_algorithm,
+            compressed=compressed,
+            connection_id=self.connection_id,
+        )
+
+    def _store(self, pn: int, datagram: bytes) -> int:
+        # Every packet can be encoded again from the mapping.
+        return 0
+
+    def _drop(self, pn: int) -> int:
+        return 0
+
+
+def create_send_buffer(
+    stream: TextIO,
+    data_size: int,
+    wire_format: str = wire.BINARY,
+    checksum_algorithm: str = checksum.CRC32,
+    capacity: int = SEND_BUFFER_SIZE,
+    compressor: Optional[Compressor] = None,
+    byte_range: Optional[Tuple[int, int]] = None,
+    connection_id: Optional[int] = None,
+) -> SendBuffer:
+    """
+    Creates the buffer the sender keeps packets in for retransmission: a
+    MappedPackets if stream is a non-empty regular file that can be mapped, and
+    a SendBuffer holding the datagrams otherwise. byte_range only applies to
+    the former.
+    """
+
+    mapping = _map(stream)
+    if mapping is None:
+        return SendBuffer(capacity)
+
+    return MappedPackets(
+        mapping,
+        data_size,
+        wire_format,
+        checksum_algorithm,
+        capacity,
+        compressor,
+        byte_range,
+        connection_id,
+    )
+
+
+def _map(stream: TextIO) -> Optional[mmap.mmap]:
+    try:
+        fd = stream.fileno()
+        status = os.fstat(fd)
+        if not stat.S_ISREG(status.st_mode) or status.st_size == 0:
+            return None
+
+        if os.lseek(fd, 0, os.SEEK_CUR) != 0:
+            # Some of it was consumed before we got to it, so the packets
+            # wouldn't line up with the mapping.
+            return None
+
+        return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError) as e:
+        logger.info("Not mapping the input: %s", e)
+        return None
@@ -0,0 +1,292 @@
+import os
+import time
+from collections import OrderedDict
+from socket import socket
+from typing import Any, BinaryIO, Dict, Hashable, Optional, Set
+
+from src import wire
+from src.constants import CLOSE, CONNECTION_ID, SEQUENCE_NUMBER
+from src.datagram_io import DatagramIO
+from src.logging import get_logger
+from src.metrics import MetricsExporter, receiver_metrics
+from src.receiver import ACK_DELAY, ACK_EVERY, RECEIVE_WINDOW, Receiver
+
+# How many connections to serve at once, by default. Packets that would open
+# another one are dropped, and the sender keeps retransmitting until there's
+# room.
+MAX_CONNECTIONS = 512
+# Connections nothing has arrived on for this long are given up on, as a
+# receiver on its own would give up on its socket.
+IDLE_TIMEOUT = 10  # seconds
+# Connections nothing has arrived on for this long give their reorder buffer's
+# slots back, unless packets are held in them.
+RELEASE_AFTER = 1  # seconds
+# How often to look for idle connections.
+SWEEP_INTERVAL = 0.5  # seconds
+# How many finished connections to remember, so that their EOF can be acked
+# again if the sender missed every ack for it, and so that packets arriving
+# late for them, even after their sender closed them, don't open them again.
+MAX_FINISHED = 4096
+
+# Suffix of the output files of connections that haven't finished.
+PARTIAL_SUFFIX = ".part"
+
+
+def connection_name(key: Hashable) -> str:
+    """
+    The output file name for a connection: its ID in hex, or its sender's
+    address, for senders that don't send an ID.
+    """
+
+    if isinstance(key, int):
+        return f"{key:08x}"
+    (host, port) = key
+    return f"{host}-{port}"
+
+
+class ReceiverServer:
+    """
+    Serves any number of senders on one socket, demultiplexing their packets
+    by connection ID.
+
+    Each connection gets a Receiver of its own, with its own reorder buffer,
+    acks and output file in output_dir, named after the connection ID; all of
+    them share the socket. A connection's file has PARTIAL_SUFFIX until every
+    packet has been received, and is renamed once it has. Idle connections
+    give back their reorder buffer's slots, and are dropped altogether if
+    they stay idle for long enough, so they cost next to nothing.
+
+    With a metrics exporter, each connection's metrics are exported while it's
+    open, with a final snapshot as it finishes or is dropped.
+    """
+
+    def __init__(
+        self,
+        sock: socket,
+        message_size: int,
+        output_dir: str,
+        receive_window: int = RECEIVE_WINDOW,
+        datagram_io: Optional[DatagramIO] = None,
+        ack_every: int = ACK_EVERY,
+        ack_delay: float = ACK_DELAY,
+        max_connections: int = MAX_CONNECTIONS,
+        idle_timeout: float = IDLE_TIMEOUT,
+        metrics_exporter: Optional[MetricsExporter] = None,
+    ):
+        self.sock = sock
+        self.message_size = message_size
+        if datagram_io is None:
+            datagram_io = DatagramIO(sock, message_size)
+        self.datagram_io = datagram_io
+
+        self.output_dir = output_dir
+        self.receive_window = receive_window
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.metrics_exporter = metrics_exporter
+
+        self.connections: Dict[Hashable, Receiver] = {}
+        # When each connection last received a packet, least recently first.
+        self.last_active: "OrderedDict[Hashable, float]" = OrderedDict()
+        # Connections with a delayed ack pending.
+        self.delayed: Set[Hashable] = set()
+        # The EOF acks of finished connections, least recently finished first,
+        # or None once their sender has closed them.
+        self.finished: "OrderedDict[Hashable, Optional[bytes]]" = OrderedDict()
+        # The connection each sender's address last sent a packet for, so that
+        # corrupted packets, which don't say, can be counted against it.
+        self.addresses: Dict[Any, Hashable] = {}
+
+        self.next_sweep = time.monotonic() + SWEEP_INTERVAL
+
+        self.connections_served = 0
+        self.connections_dropped = 0
+        self.connections_refused = 0
+
+        self.logger = get_logger("[4254recv] ReceiverServer")
+
+    def run(self):
+        """
+        Serves connections until interrupted.
+        """
+
+        self.logger.info("Serving connections into %s.", self.output_dir)
+
+        try:
+            while True:
+                self.__serve_once()
+        finally:
+            for key in list(self.connections):
+                self.__close(key)
+            self.logger.info(
+                "Served %s connections, dropped %s idle ones, refused %s.",
+                self.connections_served,
+                self.connections_dropped,
+                self.connections_refused,
+            )
+
+    def __serve_once(self):
+        self.sock.settimeout(self.__timeout())
+        try:
+            received_data = self.datagram_io.recv_batch()
+        except (BlockingIOError, TimeoutError):
+            # With a timeout of 0, when an ack is due already, the socket is
+            # non-blocking.
+            received_data = []
+
+        now = time.monotonic()
+        # The connections that got packets, to flush once the batch is done.
+        touched: Dict[Hashable, Receiver] = {}
+
+        for (data, address) in received_data:
+            packet = wire.decode(data)
+
+            if packet is None or SEQUENCE_NUMBER not in packet:
+                # Corrupted packet, ignore.
+                receiver = self.connections.get(self.addresses.get(address))
+                if receiver is not None:
+                    receiver.metrics.count("corrupt_packets")
+                continue
+
+            key = packet.get(CONNECTION_ID, address)
+            if CLOSE in packet:
+                # The sender has our EOF ack, so there's no need to keep it.
+                # The connection is still remembered, so that a late or
+                # duplicated packet doesn't open it again, over its output.
+                if key in self.finished:
+                    self.finished[key] = None
+                continue
+
+            if key in self.finished:
+                eof_ack = self.finished[key]
+                if eof_ack is not None:
+                    # Our EOF acks didn't make it, so the sender is still at it.
+                    self.datagram_io.send_batch([eof_ack], address)
+                continue
+
+            receiver = self.connections.get(key)
+            if receiver is None:
+                receiver = self.__open(key)
+                if receiver is None:
+                    continue
+
+            receiver.handle_packet(packet, data, address)
+            if self.metrics_exporter is not None:
+                self.addresses[address] = key
+            self.last_active[key] = now
+            self.last_active.move_to_end(key)
+            touched[key] = receiver
+
+        for (key, receiver) in touched.items():
+            receiver.flush()
+            if receiver.finished:
+                self.__finish(key)
+            elif receiver.ack_deadline is not None:
+                self.delayed.add(key)
+
+        self.__send_delayed_acks(now)
+        if now >= self.next_sweep:
+            self.__sweep(now)
+            self.next_sweep = now + SWEEP_INTERVAL
+
+    def __timeout(self) -> float:
+        """
+        How long to wait for packets: until the next delayed ack is due, or
+        the next sweep for idle connections.
+        """
+
+        deadline = self.next_sweep
+        for key in self.delayed:
+            deadline = min(deadline, self.connections[key].ack_deadline)
+        return max(deadline - time.monotonic(), 0)
+
+    def __send_delayed_acks(self, now: float):
+        for key in list(self.delayed):
+            receiver = self.connections[key]
+            if receiver.ack_deadline is None:
+                self.delayed.discard(key)
+            elif receiver.ack_deadline <= now:
+                receiver.send_delayed_ack()
+                self.delayed.discard(key)
+
+    def __open(self, key: Hashable) -> Optional[Receiver]:
+        if len(self.connections) >= self.max_connections:
+            self.connections_refused += 1
+            self.logger.debug("Refusing connection %s; serving the most already.", key)
+            return None
+
+        name = connection_name(key)
+        path = os.path.join(self.output_dir, name + PARTIAL_SUFFIX)
+        output: BinaryIO = open(path, "wb")
+
+        metrics = receiver_metrics(enabled=self.metrics_exporter is not None)
+        metrics.connection = name
+
+        receiver = Receiver(
+            sock=self.sock,
+            message_size=self.message_size,
+            receive_window=self.receive_window,
+            output=output,
+            datagram_io=self.datagram_io,
+            ack_every=self.ack_every,
+            ack_delay=self.ack_delay,
+            metrics=metrics,
+        )
+        self.connections[key] = receiver
+        self.connections_served += 1
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.add(metrics)
+        self.logger.info("Opened connection %s.", name)
+
+        return receiver
+
+    def __finish(self, key: Hashable):
+        receiver = self.connections[key]
+        receiver.ack_eof()
+        receiver.log_stats()
+
+        self.finished[key] = receiver.eof_ack()
+        while len(self.finished) > MAX_FINISHED:
+            self.finished.popitem(last=False)
+
+        self.__close(key)
+
+        name = connection_name(key)
+        path = os.path.join(self.output_dir, name)
+        os.replace(path + PARTIAL_SUFFIX, path)
+        self.logger.info("Connection %s finished.", name)
+
+    def __close(self, key: Hashable):
+        receiver = self.connections.pop(key)
+        self.last_active.pop(key, None)
+        self.delayed.discard(key)
+        receiver.output.close()
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.remove(receiver.metrics)
+            for address in [a for (a, k) in self.addresses.items() if k == key]:
+                del self.addresses[address]
+
+    def __sweep(self, now: float):
+        """
+        Releases the slots of connections idle for RELEASE_AFTER, and drops
+        those idle for the idle timeout, leaving their output partial.
+        """
+
+        for (key, last_active) in list(self.last_active.items()):
+            idle = now - last_active
+            if idle < RELEASE_AFTER:
+                # The rest have been active more recently still.
+                break
+
+            if idle >= self.idle_timeout:
+                self.logger.info(
+                    "Dropping connection %s, idle for %.1fs.",
+                    connection_name(key),
+                    idle,
+                )
+                self.__close(key)
+                self.connections_dropped += 1
+            else:
+                self.connections[key].reorder_buffer.release()
@@ -1,15 +1,36 @@
-import heapq
-import json
 import socket
-from queue import Empty, Queue, PriorityQueue
+import time
+from queue import Empty, Queue
 from threading import RLock
-from typing import Dict, Tuple
+from typing import Dict, List, Optional, Tuple
 
-from src.checksum import verify_checksum
-from src.constants import ACKNOWLEDGED, END_OF_FILE, QUIT, SEQUENCE_NUMBER
+from src import checksum, wire
+from src.congestion import CongestionController
+from src.constants import (
+    ACKNOWLEDGED,
+    CONNECTION_ID,
+    END_OF_FILE,
+    HELLO,
+    PROBE,
+    QUIT,
+    RECEIVE_WINDOW,
+    SELECTIVE_ACKS,
+)
+from src.datagram_io import DatagramIO
 from src.logging import get_logger
+from src.metrics import Metrics, sender_metrics
+from src.pacing import Pacer
+from src.recovery import LossRecovery
+from src.rtt import RttEstimator
+from src.scheduler import SendScheduler
+from src.scoreboard import SackScoreboard
+from src.send_buffer import SendBuffer
+from src.timers import TimerQueue
 
 DUPLICATES_FOR_RETRANSMIT = 2
+# How many copies of the close to send once the EOF ack arrives. If they're all
+# lost, the receiver waits a little longer before giving up on us.
+CLOSE_COPIES = 2
 
 
 class SocketReader:
@@ -21,25 +42,47 @@ class SocketReader:
     def __init__(
         self,
         sock: socket.socket,
-        packets_to_send: "PriorityQueue[Tuple[int,Dict]]",
-        all_packets: Dict[int, Dict],
-        outstanding_packets: Dict[int, Tuple[Dict, float]],
+        packets_to_send: SendScheduler,
+        send_buffer: SendBuffer,
+        outstanding_packets: Dict[int, Tuple[bytes, float]],
         outstanding_packets_lock: RLock,
         timeout_messagebox: Queue,
         destination: Tuple[str, int],
         message_size: int,
+        congestion: CongestionController,
+        rtt: RttEstimator,
+        timers: TimerQueue,
+        datagram_io: DatagramIO,
+        pacer: Pacer,
+        recovery: LossRecovery,
+        wire_format: str = wire.BINARY,
+        checksum_algorithm: str = checksum.CRC32,
+        connection_id: Optional[int] = None,
+        metrics: Optional[Metrics] = None,
     ):
         self.sock = sock
+        self.datagram_io = datagram_io
+        self.congestion = congestion
+        self.rtt = rtt
+        self.timers = timers
+        self.pacer = pacer
+        self.recovery = recovery
 
         self.packets_to_send = packets_to_send
         self.timeout_messagebox = timeout_messagebox
 
-        self.all_packets = all_packets
+        self.send_buffer = send_buffer
         self.outstanding_packets = outstanding_packets
         self.outstanding_packets_lock = outstanding_packets_lock
 
         self.destination = destination
         self.message_size = message_size
+        self.connection_id = connection_id
+        self.metrics = metrics or sender_metrics(enabled=False)
+        # Tells the receiver the EOF ack made it, so it can quit too.
+        self.close_packet = wire.encode_close(
+            fmt=wire_format, algorithm=checksum_algorithm, connection_id=connection_id
+        )
 
         # Highest Cumulative Acknowledged Packet
         #
@@ -47,6 +90,8 @@ class SocketReader:
         # excessive line lengths and therefore questionable formatting.
         self.hcap: int = 0
         self.duplicate_acks_count = 0
+        # Which packets above the hcap the receiver has, from SACK blocks.
+        self.scoreboard = SackScoreboard()
 
         self.logger = get_logger("[4254send] SocketReader")
 
@@ -55,44 +100,166 @@ class SocketReader:
         # equal to the hcap.
 
         self.duplicate_acks_count += 1
+        self.congestion.on_duplicate_ack()
 
         if self.duplicate_acks_count == DUPLICATES_FOR_RETRANSMIT:
             self.logger.debug("Received triple ack for packet %s", self.hcap)
-            packet_to_resend = None
             pn_to_resend = self.hcap + 1
-            packet_to_resend = self.all_packets[pn_to_resend]
 
-            self.packets_to_send.put((pn_to_resend, packet_to_resend), block=True)
-            self.logger.debug("Put packet %s back into the send queue.", pn_to_resend)
+            self.__retransmit(pn_to_resend)
 
             self.duplicate_acks_count = 0
 
-    def __accept_acknowledgement(self, apn: int):
+    def __detect_losses(self, delivered: List[Tuple[int, float]]):
+        # Retransmit every packet that's been outstanding for too long, given
+        # what's been delivered since it was sent, rather than one per round
+        # of duplicate acks. Nothing changes that until something is
+        # delivered; if it's just a matter of time, the recovery timer sees
+        # to it.
+        now = time.monotonic()
+        with self.outstanding_packets_lock:
+            lost = self.recovery.on_ack(
+                delivered, self.hcap, self.outstanding_packets, now
+            )
+
+        for pn in lost:
+            self.logger.debug("Packet %s was lost.", pn)
+            self.__retransmit(pn)
+
+    def __retransmit(self, pn: int):
+        # It's presumed lost, so it's no longer in flight, and its timer mustn't
+        # send it again before the retransmission has even gone out. If it
+        # isn't in flight, the timer has queued it already, or it hasn't been
+        # sent at all: duplicate acks can also be for packets the receiver had
+        # already, such as ones it rebuilt from a repair packet.
+        with self.outstanding_packets_lock:
+            if self.outstanding_packets.pop(pn, None) is None:
+                return
+            self.timers.cancel(pn)
+
+        if pn <= self.send_buffer.released_through:
+            # Acked cumulatively after all, so there's nothing to resend, and
+            # the send buffer no longer has it to resend anyway.
+            return
+
+        self.metrics.count("retransmits_fast")
+        self.congestion.on_loss(pn, timeout=False)
+        if self.packets_to_send.add_retransmission(pn, self.send_buffer[pn]):
+            self.congestion.on_retransmission_queued()
+            self.logger.debug("Put packet %s back into the send queue.", pn)
+
+    def __accept_selective_acks(
+        self,
+        sack_blocks: List[Tuple[int, int]],
+        delivered: List[Tuple[int, float]],
+    ) -> List[int]:
+        newly_sacked = self.scoreboard.update(self.hcap, sack_blocks)
+
+        if len(newly_sacked) > 0:
+            now = time.monotonic()
+            rtt_sample = None
+            # The packet rtt_sample was taken from.
+            sample_pn = None
+
+            # SACKed packets have been delivered, so they are no longer in
+            # flight and don't need a timer.
+            with self.outstanding_packets_lock:
+                for pn in newly_sacked:
+                    self.timers.cancel(pn)
+                    if pn in self.outstanding_packets:
+                        (_, sent_time) = self.outstanding_packets.pop(pn)
+                        rtt_sample = now - sent_time
+                        sample_pn = pn
+                        delivered.append((pn, sent_time))
+
+            # The last newly SACKed packet still in flight is most likely the
+            # one that triggered this ack, so it gives the best RTT sample.
+            # Karn's rule applies to that packet, not to whichever was SACKed
+            # last.
+            if sample_pn is not None:
+                self.rtt.on_ack(sample_pn, sample_pn, rtt_sample)
+            self.pacer.on_delivered(newly_sacked)
+            self.congestion.on_selective_ack()
+
+        return newly_sacked
+
+    def __accept_acknowledgement(self, apn: int, sack_blocks: List[Tuple[int, int]]):
         if apn < self.hcap:
             # We've already received an ack higher than this, so we
             # don't need to do anything.
             return
 
+        old_hcap = self.hcap
+        # Packets newly acked or SACKed, and when they were last sent.
+        delivered: List[Tuple[int, float]] = []
+
         if apn == self.hcap:
+            self.metrics.count("duplicate_acks")
+
+        if apn == self.hcap and len(sack_blocks) == 0:
+            # Without SACK blocks, all we can do is count duplicates.
             self.logger.debug("Ack for packet %s was duplicate.", apn)
             self.__handle_duplicate_ack()
 
         if apn > self.hcap:
+            now = time.monotonic()
+            rtt_sample = None
+
+            # First, so that the socket writer, which checks it under the lock
+            # below, never puts a packet in flight once it's been taken out
+            # of outstanding packets and released.
+            self.congestion.on_ack(apn, apn - self.hcap)
+
             with self.outstanding_packets_lock:
+                if apn in self.outstanding_packets:
+                    (_, sent_time) = self.outstanding_packets[apn]
+                    rtt_sample = now - sent_time
+
                 # Keep popping packets from outstanding packets until we get
                 # to apn.
-                for pn_to_pop in range(self.hcap, apn + 1):
-                    if pn_to_pop in self.outstanding_packets:
-                        (packet, _) = self.outstanding_packets.pop(pn_to_pop)
-                        self.all_packets[pn_to_pop] = packet
+                self.timers.cancel_all(range(self.hcap + 1, apn + 1))
+                for pn_to_pop in range(self.hcap + 1, apn + 1):
+                    outstanding = self.outstanding_packets.pop(pn_to_pop, None)
+                    if outstanding is not None:
+                        delivered.append((pn_to_pop, outstanding[1]))
 
+            # Nothing up to apn will ever be retransmitted now.
+            self.send_buffer.release_through(apn)
+
+            self.rtt.on_ack(self.hcap + 1, apn, rtt_sample)
+            self.pacer.on_delivered(range(self.hcap + 1, apn + 1))
+            self.scoreboard.advance(self.hcap, apn)
             self.hcap = apn
 
+        newly_sacked = []
+        if len(sack_blocks) > 0:
+            newly_sacked = self.__accept_selective_acks(sack_blocks, delivered)
+
+        if self.hcap > old_hcap or len(newly_sacked) > 0:
+            # Retransmissions of those that are still queued would only
+            # waste the link now.
+            dropped = self.packets_to_send.on_delivered(self.hcap, newly_sacked)
+            for _ in range(dropped):
+                self.congestion.on_retransmission_dequeued()
+
+        if len(delivered) > 0:
+            self.__detect_losses(delivered)
+
+        partial = old_hcap < self.hcap < self.congestion.recovery_point
+        if partial and not self.recovery.is_retransmitted(self.hcap + 1):
+            # A partial ack: we're still recovering from a loss, and the packet
+            # after the new cumulative ack was sent before the loss was
+            # noticed, so it's lost too. Retransmit it straight away, as in
+            # NewReno's fast recovery (RFC 6582), unless a retransmission of it
+            # is in flight already, or the ack SACKed it.
+            self.logger.debug("Partial ack for %s.", self.hcap)
+            self.__retransmit(self.hcap + 1)
+
     def run(self):
         """
         Read acks from the socket, removing packets from outstanding_packets
-        when acked, re-transmitting on duplicate acks and quitting on an EOF
-        ack.
+        when acked or SACKed, re-transmitting packets that acks show are lost
+        (or on duplicate acks, without SACKs) and quitting on an EOF ack.
         """
 
         self.logger.info("Starting to read acks from socket.")
@@ -108,37 +275,89 @@ class SocketReader:
                     self.logger.info(
                         "Received QUIT message from timeout thread; shutting down."
                     )
-                    self.packets_to_send.put((0, {QUIT: True}), block=True)
+                    self.__quit(tell_timeouts=False)
                     return
             except Empty:
                 pass
 
-            received_data = self.sock.recvfrom(self.message_size)
-
-            if not received_data:
+            try:
+                received_data = self.datagram_io.recv_batch()
+            except TimeoutError:
+                # Nothing at all from the receiver for that long; it's gone.
                 self.logger.info("Socket timed out; quitting.")
-                break
+                self.__quit()
+                return
 
-            (received_packet, _) = received_data
-            received_packet = received_packet.decode()
-            decoded_packet = json.loads(received_packet)
+            for (received_packet, _) in received_data:
+                if not self.handle_ack(received_packet):
+                    self.__quit()
+                    return
 
-            if not verify_checksum(decoded_packet):
-                # Received a corrupted ack.
-                continue
+    def __quit(self, tell_timeouts: bool = True):
+        self.packets_to_send.quit()
+        # The socket writer may be waiting for the window, rather than on the
+        # queue, and the input reader for room in the send buffer.
+        self.congestion.on_quit()
+        self.send_buffer.close()
+        if tell_timeouts:
+            self.timeout_messagebox.put({QUIT: True}, block=True)
+            # Rather than letting it sleep until its next tick.
+            self.timers.interrupt()
 
-            # Acknowledged Packet Number
-            #
-            # See note on self.hcap above.
-            apn = decoded_packet[ACKNOWLEDGED]
+    def __close(self):
+        """
+        Tell the receiver we have its EOF ack, so it doesn't wait around for a
+        retransmitted EOF.
+        """
 
-            self.logger.debug("Received ack for %s.", apn)
+        try:
+            self.datagram_io.send_batch(
+                [self.close_packet] * CLOSE_COPIES, self.destination
+            )
+        except OSError:
+            # Not worth waiting for: the receiver gives up on us soon enough.
+            self.logger.info("Couldn't send the close.")
 
-            if apn == END_OF_FILE:
-                self.logger.info("EOF ack received, quitting.")
-                self.packets_to_send.put((0, {QUIT: True}), block=True)
-                self.timeout_messagebox.put({QUIT: True}, block=True)
-                return
+    def handle_ack(self, received_packet: bytes) -> bool:
+        """
+        Process one datagram read from the socket. Returns False once the EOF
+        ack has arrived, and there's nothing left to do.
+        """
+
+        decoded_packet = wire.decode(received_packet)
+
+        if decoded_packet is None or ACKNOWLEDGED not in decoded_packet:
+            # Received a corrupted ack.
+            self.metrics.count("corrupt_acks")
+            return True
+
+        if decoded_packet.get(CONNECTION_ID, self.connection_id) != self.connection_id:
+            # Meant for some other connection, e.g. a stale EOF ack for an
+            # earlier one from the same port.
+            return True
+
+        self.metrics.count("acks_received")
+
+        # Acknowledged Packet Number
+        #
+        # See note on self.hcap above.
+        apn = decoded_packet[ACKNOWLEDGED]
+
+        self.logger.debug("Received ack for %s.", apn)
+
+        if apn in (HELLO, PROBE):
+            # A late answer to the handshake (see src/handshake.py).
+            return True
+
+        if apn == END_OF_FILE:
+            self.logger.info("EOF ack received, closing.")
+            self.__close()
+            self.logger.info("Send buffer: %s", self.send_buffer.stats())
+            self.logger.info("Pacer: %s", self.pacer.stats())
+            self.logger.info("Loss recovery: %s", self.recovery.stats())
+            return False
 
-            apn = int(apn)
-            self.__accept_acknowledgement(apn)
+        apn = int(apn)
+        self.__accept_acknowledgement(apn, decoded_packet[SELECTIVE_ACKS])
+        self.congestion.on_receive_window(decoded_packet[RECEIVE_WINDOW])
+        return True
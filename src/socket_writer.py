@@ -1,13 +1,19 @@
-import heapq
-import json
-from queue import PriorityQueue, Queue
+from queue import Empty
 from socket import socket
 from threading import RLock
 import time
-from typing import Dict, Tuple
+from typing import Dict, List, Tuple
 
-from src.constants import QUIT, SEQUENCE_NUMBER
+from src.congestion import CongestionController
+from src.constants import QUIT
+from src.datagram_io import DatagramIO
+from src.fec import FecEncoder, RepairDatagram
 from src.logging import get_logger
+from src.pacing import Pacer
+from src.recovery import LossRecovery
+from src.scheduler import SendScheduler
+from src.rtt import RttEstimator
+from src.timers import TimerQueue
 
 
 class SocketWriter:
@@ -19,14 +25,28 @@ class SocketWriter:
     def __init__(
         self,
         sock: socket,
-        packets_to_send: "PriorityQueue[Tuple[int,Dict]]",
-        outstanding_packets: Dict[int, Tuple[Dict, float]],
+        packets_to_send: SendScheduler,
+        outstanding_packets: Dict[int, Tuple[bytes, float]],
         outstanding_packets_lock: RLock,
         destination: Tuple[str, int],
+        congestion: CongestionController,
+        rtt: RttEstimator,
+        timers: TimerQueue,
+        datagram_io: DatagramIO,
+        pacer: Pacer,
+        fec: FecEncoder,
+        recovery: LossRecovery,
     ):
         self.sock = sock
+        self.datagram_io = datagram_io
 
         self.packets_to_send = packets_to_send
+        self.congestion = congestion
+        self.rtt = rtt
+        self.timers = timers
+        self.pacer = pacer
+        self.fec = fec
+        self.recovery = recovery
 
         self.outstanding_packets = outstanding_packets
         self.outstanding_packets_lock = outstanding_packets_lock
@@ -39,29 +59,189 @@ class SocketWriter:
         """
         Block on the packets_to_send queue and send any packets in it out the
         socket, putting them into outstanding_packets when doing so.
+
+        New packets are only sent while the congestion window has room for
+        them. Whatever else is queued and may go out at the same time is sent
+        along with each packet, as one burst, as soon as the pacer allows.
         """
 
         self.logger.info("Starting to send to %s", self.destination)
         while True:
-            (_, packet_to_send) = self.packets_to_send.get()
+            (pn, packet_to_send) = self.packets_to_send.get()
+
+            if self.__is_quit(packet_to_send):
+                self.__log_quit()
+                return
+
+            if isinstance(packet_to_send, RepairDatagram):
+                # The packets it covers have gone out already, so it may too.
+                pass
+            elif pn <= self.congestion.highest_sent:
+                # Only new data is gated by the window; retransmissions go out
+                # regardless, since they replace packets presumed lost.
+                self.congestion.on_retransmission_dequeued()
+            else:
+                while not self.congestion.wait_for_window(self.in_flight, pn):
+                    # A retransmission was queued while we were waiting. Those
+                    # always come before new data, so it's next out of the
+                    # queue; send it and get back to waiting.
+                    (retransmit_pn, retransmit_packet) = self.packets_to_send.get()
+
+                    if self.__is_quit(retransmit_packet):
+                        self.__log_quit()
+                        return
+
+                    self.congestion.on_retransmission_dequeued()
+                    self.__wait_for_pacing()
+                    self.__send_all([(retransmit_pn, retransmit_packet)])
+
+            self.__wait_for_pacing()
+            burst = [(pn, packet_to_send)]
+            quitting = not self.collect_burst(burst)
+            self.__send_all(burst)
 
-            if QUIT in packet_to_send and packet_to_send[QUIT]:
-                self.logger.info("Received QUIT message on queue; quitting.")
+            if quitting:
+                self.__log_quit()
                 return
 
-            data_to_send = json.dumps(packet_to_send)
-            pn = packet_to_send[SEQUENCE_NUMBER]
-            self.logger.debug(
-                "Sending %s bytes of packet %s",
-                len(data_to_send),
-                pn,
+    def __send_all(self, burst: List[Tuple[int, bytes]]):
+        # The socket blocks, but the batched backends give up partway through
+        # a burst when its buffer fills, rather than wait with part of it
+        # sent. What's left waits for room here, as nothing would ever send
+        # it, or time it out, otherwise.
+        while len(burst) > 0:
+            burst = self.send_burst(burst)
+
+    def __log_quit(self):
+        self.logger.info("Received QUIT message on queue; quitting.")
+        self.logger.info("FEC: %s", self.fec.stats())
+        self.logger.info("Send queue: %s", self.packets_to_send.stats())
+
+    def __wait_for_pacing(self):
+        delay = self.pacer.delay(time.monotonic())
+        if delay > 0:
+            time.sleep(delay)
+
+    def in_flight(self) -> int:
+        return len(self.outstanding_packets)
+
+    def collect_burst(self, burst: List[Tuple[int, bytes]]) -> bool:
+        """
+        Adds the packets in packets_to_send that may be sent right away to
+        burst, up to as many packets as the pacer allows in one burst, without
+        blocking. Returns False if it comes across a QUIT message.
+        """
+
+        burst_size = self.pacer.burst_size()
+        while len(burst) < burst_size:
+            try:
+                (pn, packet_to_send) = self.packets_to_send.get_nowait()
+            except Empty:
+                return True
+
+            if self.__is_quit(packet_to_send):
+                return False
+
+            if isinstance(packet_to_send, RepairDatagram):
+                pass
+            elif pn <= self.congestion.highest_sent:
+                self.congestion.on_retransmission_dequeued()
+            elif not self.congestion.can_send(self.in_flight() + len(burst), pn):
+                # Retransmissions come first, so everything behind this is new
+                # data too, and has to wait for acks.
+                self.packets_to_send.requeue([(pn, packet_to_send)])
+                return True
+
+            burst.append((pn, packet_to_send))
+
+        return True
+
+    def __is_quit(self, packet_to_send) -> bool:
+        return isinstance(packet_to_send, dict) and packet_to_send.get(QUIT, False)
+
+    def send_burst(self, burst: List[Tuple[int, bytes]]) -> List[Tuple[int, bytes]]:
+        """
+        Write packets out the socket, in as few system calls as the datagram
+        I/O backend allows, and put them into outstanding_packets. Returns the
+        packets that couldn't be sent because the socket is non-blocking and
+        its buffer is full.
+        """
+
+        # Packets acked while they were waiting in the queue to be
+        # retransmitted are dropped. Sending them would only put them back into
+        # outstanding_packets, where nothing would ever remove them again.
+        burst = [
+            (pn, packet) for (pn, packet) in burst if pn > self.congestion.highest_acked
+        ]
+        if len(burst) == 0:
+            return []
+
+        retransmitted = set()
+        for (pn, packet) in burst:
+            if isinstance(packet, RepairDatagram):
+                continue
+            if pn <= self.congestion.highest_sent:
+                self.rtt.on_retransmit(pn)
+                retransmitted.add(pn)
+
+        # Packets are queued already encoded, so there's nothing left to do but
+        # write them out.
+        self.logger.debug("Sending packets %s to %s", burst[0][0], burst[-1][0])
+
+        try:
+            sent = self.datagram_io.send_batch(
+                [packet for (_, packet) in burst], self.destination
             )
+        except BlockingIOError:
+            return burst
 
-            sent_data_size = self.sock.sendto(data_to_send.encode(), self.destination)
+        # Repair packets are never acked, so there's nothing to track for
+        # them, beyond the room they take up on the link.
+        data_sent = [
+            (pn, packet)
+            for (pn, packet) in burst[:sent]
+            if not isinstance(packet, RepairDatagram)
+        ]
 
-            if sent_data_size < len(data_to_send):
-                # Unable to send full packet?
-                self.logger.critical("Unable to send full packet!")
-            else:
-                with self.outstanding_packets_lock:
-                    self.outstanding_packets[pn] = (packet_to_send, time.monotonic())
+        sent_time = time.monotonic()
+        deadline = sent_time + self.rtt.rto
+        with self.outstanding_packets_lock:
+            self.pacer.on_sent(
+                [
+                    (None if isinstance(packet, RepairDatagram) else pn, len(packet))
+                    for (pn, packet) in burst[:sent]
+                ],
+                len(self.outstanding_packets),
+            )
+            # Checked again under the lock: the socket reader moves the
+            # cumulative ack forward before it takes acked packets out of
+            # outstanding_packets, so a packet acked while it was being sent
+            # is seen here, and isn't put back in flight after the send buffer
+            # has let go of it.
+            highest_acked = self.congestion.highest_acked
+            tracked = [(pn, packet) for (pn, packet) in data_sent if pn > highest_acked]
+            for (pn, packet) in tracked:
+                self.outstanding_packets[pn] = (packet, sent_time)
+        for (pn, _) in tracked:
+            self.timers.schedule(pn, deadline)
+        for (pn, _) in data_sent:
+            self.congestion.on_packet_sent(pn)
+
+        retransmitted_sent = [pn for (pn, _) in tracked if pn in retransmitted]
+        self.recovery.on_sent(
+            [pn for (pn, _) in tracked], retransmitted_sent, sent_time
+        )
+        self.fec.on_sent(
+            len(data_sent) - len(retransmitted_sent), len(retransmitted_sent)
+        )
+
+        for (pn, packet) in data_sent:
+            if pn in retransmitted:
+                continue
+            repair = self.fec.add(pn, packet)
+            if repair is not None:
+                # Half a packet number past the last packet it covers, as it
+                # goes out right after it, ahead of any new data.
+                self.packets_to_send.add_repair(pn + 0.5, repair)
+
+        return burst[sent:]
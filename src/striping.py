@@ -0,0 +1,125 @@
+import os
+import shutil
+import stat
+import sys
+from typing import BinaryIO, List, Optional, Sequence, TextIO, Tuple
+
+from src.logging import get_logger
+
+# Striped transfers
+#
+# With --stripes N, the sender and the receiver each fork N worker processes,
+# one per stripe, before doing anything else. Each pair of workers is an
+# ordinary connection of its own, with its own socket, windows and threads,
+# so a transfer can use N cores and N flows' worth of bandwidth. Stripe i goes
+# to the receiver's port plus i.
+#
+# The sender splits its input into N consecutive byte ranges, one per stripe,
+# which only works for input it can map; anything else goes down the first
+# stripe, and the others just send their EOF. The receiver writes the first
+# stripe straight to its output, and the others to temporary files, which are
+# copied after it, in order, once their stripes are done.
+
+logger = get_logger("[4254] striping")
+
+
+def stripe_ranges(size: int, stripes: int, alignment: int) -> List[Tuple[int, int]]:
+    """
+    Splits size bytes into stripes consecutive (start, end) ranges, as even as
+    possible in whole multiples of alignment, so that no packet straddles two
+    stripes. Trailing ranges may be empty.
+    """
+
+    chunks = -(-size // alignment)
+    per_stripe = -(-chunks // stripes) * alignment
+
+    return [
+        (min(i * per_stripe, size), min((i + 1) * per_stripe, size))
+        for i in range(stripes)
+    ]
+
+
+def mappable_size(stream: TextIO) -> Optional[int]:
+    """
+    The size of stream, if it's a non-empty regular file read from the start,
+    which the sender can split into ranges and map; None otherwise.
+    """
+
+    try:
+        fd = stream.fileno()
+        status = os.fstat(fd)
+        if not stat.S_ISREG(status.st_mode) or status.st_size == 0:
+            return None
+        if os.lseek(fd, 0, os.SEEK_CUR) != 0:
+            return None
+    except (OSError, ValueError):
+        return None
+
+    return status.st_size
+
+
+def fork_workers(count: int) -> Tuple[Optional[int], List[int]]:
+    """
+    Forks count worker processes. Returns the stripe index and no pids in each
+    worker, and None and the workers' pids, in stripe order, in the parent.
+
+    It has to be called before any threads or sockets are created, so that
+    the workers start with nothing but the arguments.
+    """
+
+    pids = []
+    for index in range(count):
+        # Anything still buffered would be written twice, once by each process.
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        pid = os.fork()
+        if pid == 0:
+            return (index, [])
+        pids.append(pid)
+
+    logger.info("Forked %s stripe workers: %s", count, pids)
+    return (None, pids)
+
+
+def wait_for_worker(pid: int) -> int:
+    """
+    Waits for a worker to exit, and returns its exit code.
+    """
+
+    (_, status) = os.waitpid(pid, 0)
+    return os.waitstatus_to_exitcode(status)
+
+
+def wait_for_workers(pids: Sequence[int]) -> int:
+    """
+    Waits for every worker to exit, and returns the worst exit code, so that
+    the transfer fails if any stripe did.
+    """
+
+    return max(abs(wait_for_worker(pid)) for pid in pids)
+
+
+def reassemble(
+    pids: Sequence[int], outputs: Sequence[BinaryIO], output: BinaryIO
+) -> int:
+    """
+    Waits for the receiver workers in stripe order, and copies each one's
+    output after the first one's, which went to output directly. Returns the
+    worst exit code. Once a stripe has failed, the ones after it are no longer
+    copied, since the output would have a hole in it anyway.
+    """
+
+    worst = 0
+    for (pid, stripe_output) in zip(pids, outputs):
+        worst = max(worst, abs(wait_for_worker(pid)))
+
+        if stripe_output is output or worst != 0:
+            continue
+
+        stripe_output.seek(0)
+        shutil.copyfileobj(stripe_output, output)
+        output.flush()
+        stripe_output.close()
+
+    return worst
@@ -1,13 +1,27 @@
-import heapq
 import time
-from queue import PriorityQueue, Queue
+from queue import Queue
 from threading import RLock
-from typing import Dict, Tuple
+from typing import Dict, List, Optional, Tuple
 
-from src.constants import QUIT, SEQUENCE_NUMBER
+from src.congestion import CongestionController
+from src.constants import QUIT
 from src.logging import get_logger
+from src.metrics import Metrics, sender_metrics
+from src.recovery import RECOVERY_TIMER, LossRecovery
+from src.rtt import RttEstimator
+from src.scheduler import SendScheduler
+from src.send_buffer import SendBuffer
+from src.timers import TimerQueue
 
-TIMEOUT = 0.6  # seconds
+# The longest the thread waits between checks when no timer expires sooner, so
+# that QUIT messages and idleness are still noticed.
+MAX_TICK = 0.2  # seconds
+# How long to wait with no packets in flight before giving up on the EOF ack.
+IDLE_QUIT_TIME = 0.6  # seconds
+# How long to keep retransmitting the EOF once everything else has been acked,
+# before giving up on its ack. The receiver only waits around for a second
+# after acking it (LINGER_TIME in src/receiver.py), so by then it's gone.
+CLOSE_TIMEOUT = 2  # seconds
 
 
 class Timeouts:
@@ -18,20 +32,40 @@ class Timeouts:
 
     def __init__(
         self,
-        packets_to_send: "PriorityQueue[Tuple[int, Dict]]",
-        outstanding_packets: Dict[int, Tuple[Dict, float]],
+        packets_to_send: SendScheduler,
+        send_buffer: SendBuffer,
+        outstanding_packets: Dict[int, Tuple[bytes, float]],
         outstanding_packets_lock: RLock,
         timeout_messagebox: Queue,
+        congestion: CongestionController,
+        rtt: RttEstimator,
+        timers: TimerQueue,
+        recovery: LossRecovery,
+        metrics: Optional[Metrics] = None,
     ):
         self.packets_to_send = packets_to_send
+        self.send_buffer = send_buffer
+        self.congestion = congestion
+        self.rtt = rtt
+        self.timers = timers
+        self.recovery = recovery
         self.outstanding_packets = outstanding_packets
         self.outstanding_packets_lock = outstanding_packets_lock
         self.timeout_messagebox = timeout_messagebox
+        self.metrics = metrics or sender_metrics(enabled=False)
 
         self.logger = get_logger("[4254send] Timeouts")
-        self.ticks_without_packets = 0
+        self.idle_since = None
+        # When everything but the EOF packet was acked, if it has been.
+        self.closing_since = None
 
     def run(self):
+        """
+        Wait for retransmission timers to expire, and put the packets they
+        belong to back into the send queue, along with any that the recovery
+        timer finds lost, or sends as a tail loss probe.
+        """
+
         self.logger.info("Starting timeout thread.")
         while True:
             try:
@@ -45,38 +79,104 @@ class Timeouts:
             except:
                 pass
 
-            resend_these_packets = []
-
-            with self.outstanding_packets_lock:
-                if len(self.outstanding_packets) == 0:
-                    # We don't want to spend too long waiting for the EOF acks
-                    # so if we have no packets in flight and aren't waiting for
-                    # any acks, why not just quit?
-                    # The only reason we're counting ticks is to ensure we don't
-                    # quit too early, i.e. before any packets have been sent.
-                    self.ticks_without_packets += 1
-                    if self.ticks_without_packets == 3:
-                        self.logger.info(
-                            "Spent 5 ticks with no outstanding packets, quitting."
-                        )
-                        self.timeout_messagebox.put({QUIT: True})
-                        return
-                else:
-                    self.ticks_without_packets = 0
-
-                pns_to_pop = []
-                current_time = time.monotonic()
-
-                for (pn, (packet, sent_time)) in self.outstanding_packets.items():
-                    if current_time - sent_time >= TIMEOUT:
-                        self.logger.debug("Packet %s timed out!", pn)
-                        resend_these_packets.append(packet)
-                        pns_to_pop.append(pn)
-
-                for pn in pns_to_pop:
-                    self.outstanding_packets.pop(pn)
-
-            for packet in resend_these_packets:
-                self.packets_to_send.put((packet[SEQUENCE_NUMBER], packet), block=True)
-
-            time.sleep(0.2)
+            # Sleeps until exactly the next deadline, and only hands back the
+            # timers that have expired, so the work below never depends on how
+            # many packets are in flight.
+            expired_pns = self.timers.wait_for_expired(MAX_TICK)
+
+            if not self.handle_expired(expired_pns):
+                self.timeout_messagebox.put({QUIT: True})
+                # The socket reader won't see that until something arrives,
+                # which may be never, so stop everyone else here.
+                self.packets_to_send.quit()
+                self.congestion.on_quit()
+                self.send_buffer.close()
+                return
+
+    def handle_expired(self, expired_pns: List[int]) -> bool:
+        """
+        Put the packets whose timers expired back into the send queue. Returns
+        False once nothing has been in flight for IDLE_QUIT_TIME, or only the
+        EOF has for CLOSE_TIMEOUT, and it's time to give up on the EOF ack.
+        """
+
+        resend_these_packets = []
+        lost_packets = []
+        probe = None
+        current_time = time.monotonic()
+
+        eof_pn = self.send_buffer.eof_pn
+        if eof_pn is not None and self.send_buffer.released_through == eof_pn - 1:
+            # The receiver has everything but the EOF, so it's either waiting
+            # for that, or has acked it and is waiting for our close.
+            if self.closing_since is None:
+                self.closing_since = current_time
+            elif current_time - self.closing_since >= CLOSE_TIMEOUT:
+                self.logger.info("No EOF ack for %ss; giving up.", CLOSE_TIMEOUT)
+                return False
+
+        with self.outstanding_packets_lock:
+            if len(self.outstanding_packets) == 0:
+                # We don't want to spend too long waiting for the EOF acks
+                # so if we have no packets in flight and aren't waiting for
+                # any acks, why not just quit?
+                # The only reason we're waiting at all is to ensure we don't
+                # quit too early, i.e. before any packets have been sent.
+                if self.idle_since is None:
+                    self.idle_since = current_time
+                elif current_time - self.idle_since >= IDLE_QUIT_TIME:
+                    self.logger.info(
+                        "No outstanding packets for %ss, quitting.",
+                        IDLE_QUIT_TIME,
+                    )
+                    self.logger.info("RTT estimator: %s", self.rtt.stats())
+                    self.logger.info("Loss recovery: %s", self.recovery.stats())
+                    return False
+            else:
+                self.idle_since = None
+
+            if RECOVERY_TIMER in expired_pns:
+                (lost, probe_pn) = self.recovery.on_expired(
+                    self.outstanding_packets, current_time
+                )
+                for pn in lost:
+                    self.logger.debug("Packet %s was lost.", pn)
+                    self.timers.cancel(pn)
+                    (packet, _) = self.outstanding_packets.pop(pn)
+                    lost_packets.append((pn, packet))
+                if probe_pn is not None:
+                    self.logger.debug("Probing with packet %s.", probe_pn)
+                    self.timers.cancel(probe_pn)
+                    (packet, _) = self.outstanding_packets.pop(probe_pn)
+                    probe = (probe_pn, packet)
+
+            for pn in expired_pns:
+                if pn in self.outstanding_packets:
+                    self.logger.debug("Packet %s timed out!", pn)
+                    (packet, _) = self.outstanding_packets.pop(pn)
+                    resend_these_packets.append((pn, packet))
+
+        if len(resend_these_packets) > 0:
+            self.rtt.on_timeout([pn for (pn, _) in resend_these_packets])
+            self.metrics.count("retransmits_timeout", len(resend_these_packets))
+
+        for (pn, packet) in resend_these_packets:
+            self.congestion.on_loss(pn, timeout=True)
+            self.__retransmit(pn, packet)
+
+        for (pn, packet) in lost_packets:
+            self.metrics.count("retransmits_reorder")
+            self.congestion.on_loss(pn, timeout=False)
+            self.__retransmit(pn, packet)
+
+        if probe is not None:
+            # Nothing says the probe was lost, so it doesn't reduce the window
+            # or back the RTO off.
+            self.metrics.count("loss_probes")
+            self.__retransmit(*probe)
+
+        return True
+
+    def __retransmit(self, pn: int, packet: bytes):
+        if self.packets_to_send.add_retransmission(pn, packet):
+            self.congestion.on_retransmission_queued()
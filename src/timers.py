@@ -0,0 +1,142 @@
+import heapq
+import time
+from threading import Condition
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Rebuild the heap once cancelled entries outnumber live ones by this factor.
+COMPACTION_FACTOR = 2
+
+
+class TimerQueue:
+    """
+    Retransmission timers for the sender, ordered by deadline.
+
+    Timers live in a min-heap of (deadline, pn) with a dict from pn to its
+    current deadline alongside it. Cancelling or re-arming a timer only updates
+    the dict; the stale heap entry is skipped when it reaches the top. Once
+    stale entries pile up, the heap is rebuilt from the dict, which is O(n) in
+    the number of packets in flight and happens under the lock. But it only
+    happens after at least n stale entries have been added since the last
+    rebuild, so every operation is still O(log n) amortised, per timer.
+    """
+
+    def __init__(self):
+        self.changed = Condition()
+
+        self.heap: List[Tuple[float, int]] = []
+        self.deadlines: Dict[int, float] = {}
+        # Set once the sender is quitting, so that nothing waits any more.
+        self.interrupted = False
+
+    def __len__(self) -> int:
+        return len(self.deadlines)
+
+    def schedule(self, pn: int, deadline: float):
+        """
+        Arms the timer for packet pn, replacing any earlier timer for it.
+        """
+
+        with self.changed:
+            self.deadlines[pn] = deadline
+            heapq.heappush(self.heap, (deadline, pn))
+            self.__maybe_compact()
+
+            if self.heap[0] == (deadline, pn):
+                # The next expiry moved earlier, so whoever is waiting on it
+                # needs to wake up sooner.
+                self.changed.notify_all()
+
+    def cancel(self, pn: int):
+        with self.changed:
+            if self.deadlines.pop(pn, None) is not None:
+                self.__maybe_compact()
+
+    def cancel_all(self, pns: Iterable[int]):
+        """
+        Cancels the timers for all of pns, taking the lock once.
+        """
+
+        with self.changed:
+            for pn in pns:
+                self.deadlines.pop(pn, None)
+            self.__maybe_compact()
+
+    def wait_for_expired(self, max_wait: float) -> List[int]:
+        """
+        Blocks until the earliest timer expires, or at most max_wait seconds,
+        or until interrupted, and returns the packet numbers of all timers that
+        have expired. Those timers are removed.
+        """
+
+        with self.changed:
+            now = time.monotonic()
+            next_deadline = self.__next_deadline()
+
+            waiting = next_deadline is None or next_deadline > now
+            if waiting and not self.interrupted:
+                timeout = max_wait
+                if next_deadline is not None:
+                    timeout = min(timeout, next_deadline - now)
+                self.changed.wait(timeout)
+
+            return self.pop_expired()
+
+    def interrupt(self):
+        """
+        Wakes up whoever is waiting for timers to expire, and stops anyone
+        waiting from then on, once the sender is quitting.
+        """
+
+        with self.changed:
+            self.interrupted = True
+            self.changed.notify_all()
+
+    def pop_expired(self) -> List[int]:
+        """
+        Returns the packet numbers of all timers that have expired, without
+        waiting, and removes those timers.
+        """
+
+        with self.changed:
+            now = time.monotonic()
+
+            expired = []
+            while len(self.heap) > 0 and self.heap[0][0] <= now:
+                (deadline, pn) = heapq.heappop(self.heap)
+                if self.deadlines.get(pn) == deadline:
+                    del self.deadlines[pn]
+                    expired.append(pn)
+
+            return expired
+
+    def deadline(self, pn: int) -> Optional[float]:
+        """
+        Returns when the timer for pn expires, or None if it isn't armed, or
+        has been cancelled or has expired since.
+        """
+
+        with self.changed:
+            return self.deadlines.get(pn)
+
+    def next_deadline(self) -> Optional[float]:
+        """
+        Returns the earliest deadline of any timer, or None if none are armed.
+        """
+
+        with self.changed:
+            return self.__next_deadline()
+
+    def __next_deadline(self) -> Optional[float]:
+        # Skip over entries for timers that were cancelled or re-armed.
+        while len(self.heap) > 0:
+            (deadline, pn) = self.heap[0]
+            if self.deadlines.get(pn) == deadline:
+                return deadline
+            heapq.heappop(self.heap)
+
+        return None
+
+    def __maybe_compact(self):
+        if len(self.heap) > COMPACTION_FACTOR * (len(self.deadlines) + 1) + 64:
+            self.heap = [(deadline, pn) for (pn, deadline) in self.deadlines.items()]
+            heapq.heapify(self.heap)
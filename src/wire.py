@@ -0,0 +1,565 @@
+import json
+import struct
+from base64 import b64decode, b64encode
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from src import checksum, compression
+from src.constants import (
+    ACKNOWLEDGED,
+    CHECKSUM,
+    CHECKSUM_ALGORITHM,
+    CLOSE,
+    COMPRESSED,
+    CONNECTION_ID,
+    DATA,
+    END_OF_FILE,
+    HELLO,
+    MAX_DATAGRAM,
+    PROBE,
+    RECEIVE_WINDOW,
+    REPAIR,
+    REPAIR_LENGTH,
+    SELECTIVE_ACKS,
+    SEQUENCE_NUMBER,
+)
+
+# Wire formats
+
+BINARY = "binary"
+JSON = "json"
+FORMATS = (BINARY, JSON)
+
+# Binary format
+#
+# Every binary datagram starts with a small header, followed by the raw
+# payload:
+#
+#   version (1) | checksum algorithm (1) | checksum (4 or 8)
+#   | flags (1) | payload length (2) | sequence (4) | [connection ID (4)]
+#   | payload
+#
+# The checksum covers everything after it, so it is computed and verified in a
+# single pass over the bytes on the wire. The version byte doubles as the format
+# marker: a JSON datagram always starts with "{", which can never be a valid
+# version.
+
+WIRE_VERSION = 2
+PREFIX = struct.Struct("!BB")
+HEADER = struct.Struct("!BHI")
+
+FLAG_EOF = 0x01
+FLAG_ACK = 0x02
+FLAG_REPAIR = 0x04
+# The payload of a data packet is compressed (see src/compression.py), and is
+# decompressed as it's decoded.
+FLAG_COMPRESSED = 0x08
+# The header is followed by the ID of the connection the packet belongs to,
+# which a receiver serving several senders on one port tells them apart by.
+# Acks carry the ID of the packets they ack.
+FLAG_CONNECTION_ID = 0x10
+CONNECTION_ID_HEADER = struct.Struct("!I")
+# Sent by the sender once the EOF ack has arrived, so that the receiver can stop
+# waiting around in case it didn't. It has no payload.
+FLAG_CLOSE = 0x20
+# The sender's opening packet (see src/handshake.py). Its sequence is which
+# attempt it is, and its payload the largest datagram the sender would send.
+# The receiver acks it with the largest datagram it will take, and its window.
+FLAG_HELLO = 0x40
+HELLO_HEADER = struct.Struct("!I")
+HELLO_ACK_HEADER = struct.Struct("!II")
+# A path MTU probe: its sequence is its size, and its payload is padding to make
+# it that size. Acked with the receiver's window, as it may shrink to make room
+# for datagrams that big.
+FLAG_PROBE = 0x80
+
+# The payload of an ack is the receiver's window, followed by a list of SACK
+# blocks: inclusive ranges of packet numbers received above the cumulative ack.
+# EOF acks have no payload.
+ACK_HEADER = struct.Struct("!I")
+SACK_BLOCK = struct.Struct("!II")
+
+# A repair packet's sequence is the first packet of the group it covers, and
+# its payload is how many packets there are in the group and the XOR of their
+# payload lengths, followed by the XOR of their payloads.
+REPAIR_HEADER = struct.Struct("!BH")
+
+# JSON format
+#
+# The checksum is the first field, hex encoded, and covers the bytes of the
+# datagram after it, e.g.:
+#
+#   {"cksum": "1c291ca3", "cka": "crc32", "sqn": 1, "data": "...", "eof": false}
+#                         ^-- checksummed from here on
+
+JSON_PREFIX = b'{"' + CHECKSUM.encode() + b'": "'
+JSON_SEPARATOR = b'", '
+
+
+def wire_format(datagram: bytes) -> str:
+    """
+    Returns the format a received datagram was encoded in.
+    """
+
+    if len(datagram) > 0 and datagram[0] == WIRE_VERSION:
+        return BINARY
+    return JSON
+
+
+def _encode_binary(
+    flags: int,
+    sequence: int,
+    payload: bytes,
+    algorithm: str,
+    connection_id: Optional[int] = None,
+) -> bytes:
+    checksum_algorithm = checksum.ALGORITHMS[algorithm]
+    if connection_id is None:
+        body = HEADER.pack(flags, len(payload), sequence) + payload
+    else:
+        body = (
+            HEADER.pack(flags | FLAG_CONNECTION_ID, len(payload), sequence)
+            + CONNECTION_ID_HEADER.pack(connection_id)
+            + payload
+        )
+    digest = checksum.compute_checksum(body, algorithm)
+
+    return PREFIX.pack(WIRE_VERSION, checksum_algorithm.ident) + digest + body
+
+
+def _encode_json(
+    packet: Dict, algorithm: str, connection_id: Optional[int] = None
+) -> bytes:
+    packet[CHECKSUM_ALGORITHM] = algorithm
+    if connection_id is not None:
+        packet[CONNECTION_ID] = connection_id
+    # Drop the opening brace, since the checksum field takes its place.
+    body = json.dumps(packet).encode()[1:]
+    digest = checksum.compute_checksum(body, algorithm)
+
+    return JSON_PREFIX + digest.hex().encode() + JSON_SEPARATOR + body
+
+
+def encode_data(
+    sequence: int,
+    data: bytes,
+    eof: bool,
+    fmt: str = BINARY,
+    algorithm: str = checksum.CRC32,
+    compressed: bool = False,
+    connection_id: Optional[int] = None,
+) -> bytes:
+    """
+    Encodes a data packet, ready to be written to the socket. If compressed is
+    set, data has been compressed already, and is marked as such.
+    """
+
+    if fmt == BINARY:
+        flags = (FLAG_EOF if eof else 0) | (FLAG_COMPRESSED if compressed else 0)
+        return _encode_binary(flags, sequence, data, algorithm, connection_id)
+
+    packet = {
+        SEQUENCE_NUMBER: sequence,
+        DATA: b64encode(data).decode(),
+        END_OF_FILE: eof,
+    }
+    if compressed:
+        packet[COMPRESSED] = True
+
+    return _encode_json(packet, algorithm, connection_id)
+
+
+def encode_repair(
+    first_pn: int,
+    count: int,
+    length_xor: int,
+    data: bytes,
+    fmt: str = BINARY,
+    algorithm: str = checksum.CRC32,
+    connection_id: Optional[int] = None,
+) -> bytes:
+    """
+    Encodes a repair packet for the count packets from first_pn on, ready to
+    be written to the socket.
+    """
+
+    if fmt == BINARY:
+        payload = REPAIR_HEADER.pack(count, length_xor) + data
+        return _encode_binary(FLAG_REPAIR, first_pn, payload, algorithm, connection_id)
+
+    return _encode_json(
+        {
+            SEQUENCE_NUMBER: first_pn,
+            REPAIR: count,
+            REPAIR_LENGTH: length_xor,
+            DATA: b64encode(data).decode(),
+            END_OF_FILE: False,
+        },
+        algorithm,
+        connection_id,
+    )
+
+
+def encode_ack(
+    apn: Any,
+    fmt: str = BINARY,
+    algorithm: str = checksum.CRC32,
+    sack_blocks: Sequence[Tuple[int, int]] = (),
+    receive_window: int = 0,
+    connection_id: Optional[int] = None,
+) -> bytes:
+    """
+    Encodes an ack for packet number apn, or for the EOF packet if apn is
+    END_OF_FILE, along with the receive window (in packets past apn) and any
+    SACK blocks.
+    """
+
+    if fmt == BINARY:
+        if apn == END_OF_FILE:
+            return _encode_binary(FLAG_ACK | FLAG_EOF, 0, b"", algorithm, connection_id)
+
+        payload = ACK_HEADER.pack(receive_window) + b"".join(
+            SACK_BLOCK.pack(start, end) for (start, end) in sack_blocks
+        )
+        return _encode_binary(FLAG_ACK, apn, payload, algorithm, connection_id)
+
+    packet: Dict[str, Any] = {ACKNOWLEDGED: apn}
+    if apn != END_OF_FILE:
+        packet[RECEIVE_WINDOW] = receive_window
+    if len(sack_blocks) > 0:
+        packet[SELECTIVE_ACKS] = [list(block) for block in sack_blocks]
+
+    return _encode_json(packet, algorithm, connection_id)
+
+
+def encode_close(
+    fmt: str = BINARY,
+    algorithm: str = checksum.CRC32,
+    connection_id: Optional[int] = None,
+) -> bytes:
+    """
+    Encodes the packet the sender closes the connection with, once it has the
+    EOF ack.
+    """
+
+    if fmt == BINARY:
+        return _encode_binary(FLAG_CLOSE, 0, b"", algorithm, connection_id)
+
+    return _encode_json({SEQUENCE_NUMBER: 0, CLOSE: True}, algorithm, connection_id)
+
+
+def encode_hello(
+    attempt: int,
+    max_datagram: int,
+    fmt: str = BINARY,
+    algorithm: str = checksum.CRC32,
+    connection_id: Optional[int] = None,
+) -> bytes:
+    """
+    Encodes the sender's opening packet, offering datagrams of up to
+    max_datagram bytes. The format and checksum algorithm it's encoded in are
+    the ones the sender means to use.
+    """
+
+    if fmt == BINARY:
+        payload = HELLO_HEADER.pack(max_datagram)
+        return _encode_binary(FLAG_HELLO, attempt, payload, algorithm, connection_id)
+
+    return _encode_json(
+        {SEQUENCE_NUMBER: attempt, HELLO: max_datagram}, algorithm, connection_id
+    )
+
+
+def encode_hello_ack(
+    attempt: int,
+    max_datagram: int,
+    receive_window: int,
+    fmt: str = BINARY,
+    algorithm: str = checksum.CRC32,
+    connection_id: Optional[int] = None,
+) -> bytes:
+    """
+    Encodes the receiver's answer to hello attempt, taking datagrams of up to
+    max_datagram bytes, and buffering receive_window packets.
+    """
+
+    if fmt == BINARY:
+        payload = HELLO_ACK_HEADER.pack(max_datagram, receive_window)
+        return _encode_binary(
+            FLAG_ACK | FLAG_HELLO, attempt, payload, algorithm, connection_id
+        )
+
+    return _encode_json(
+        {
+            ACKNOWLEDGED: HELLO,
+            HELLO: attempt,
+            MAX_DATAGRAM: max_datagram,
+            RECEIVE_WINDOW: receive_window,
+        },
+        algorithm,
+        connection_id,
+    )
+
+
+def encode_probe(
+    size: int,
+    algorithm: str = checksum.CRC32,
+    connection_id: Optional[int] = None,
+) -> bytes:
+    """
+    Encodes a path MTU probe of exactly size bytes. Probes only come in the
+    binary format: padding them out in JSON would be more trouble than the
+    debugging fallback is worth.
+    """
+
+    padding = size - _header_size(algorithm, connection_id)
+    if padding < 0:
+        raise ValueError(f"A probe can't be as small as {size} bytes.")
+
+    return _encode_binary(FLAG_PROBE, size, bytes(padding), algorithm, connection_id)
+
+
+def encode_probe_ack(
+    size: int,
+    receive_window: int,
+    algorithm: str = checksum.CRC32,
+    connection_id: Optional[int] = None,
+) -> bytes:
+    """
+    Encodes the ack for a probe of size bytes, with the receive window as it is
+    now that datagrams that big fit.
+    """
+
+    payload = ACK_HEADER.pack(receive_window)
+    return _encode_binary(
+        FLAG_ACK | FLAG_PROBE, size, payload, algorithm, connection_id
+    )
+
+
+def max_payload(
+    datagram_size: int,
+    algorithm: str = checksum.CRC32,
+    connection_id: Optional[int] = None,
+) -> int:
+    """
+    The largest payload binary data and repair packets can have, and still fit
+    in datagram_size bytes.
+    """
+
+    return datagram_size - _header_size(algorithm, connection_id) - REPAIR_HEADER.size
+
+
+def _header_size(algorithm: str, connection_id: Optional[int]) -> int:
+    size = PREFIX.size + checksum.ALGORITHMS[algorithm].size + HEADER.size
+    if connection_id is not None:
+        size += CONNECTION_ID_HEADER.size
+    return size
+
+
+def data_payload(datagram: bytes) -> bytes:
+    """
+    Returns the payload of a data packet this end encoded itself, without
+    verifying it all over again, decompressed if it was compressed.
+    """
+
+    if wire_format(datagram) == BINARY:
+        checksum_algorithm = checksum.ALGORITHMS_BY_IDENT[datagram[1]]
+        offset = PREFIX.size + checksum_algorithm.size
+        flags = datagram[offset]
+        offset += HEADER.size
+        if flags & FLAG_CONNECTION_ID:
+            offset += CONNECTION_ID_HEADER.size
+        payload = memoryview(datagram)[offset:]
+        if flags & FLAG_COMPRESSED:
+            return compression.inflate(payload)
+        return payload
+
+    return decode(datagram)[DATA]
+
+
+def _decode_sack_blocks(payload: memoryview) -> Optional[List[Tuple[int, int]]]:
+    if len(payload) % SACK_BLOCK.size != 0:
+        return None
+
+    return list(SACK_BLOCK.iter_unpack(payload))
+
+
+def _decode_binary(view: memoryview) -> Optional[Dict]:
+    if len(view) < PREFIX.size:
+        return None
+
+    checksum_algorithm = checksum.ALGORITHMS_BY_IDENT.get(view[1])
+    if checksum_algorithm is None:
+        return None
+
+    offset = PREFIX.size + checksum_algorithm.size
+    if len(view) < offset + HEADER.size:
+        return None
+
+    if not checksum.verify_checksum(
+        view[offset:], view[PREFIX.size : offset], checksum_algorithm.name
+    ):
+        return None
+
+    (flags, length, sequence) = HEADER.unpack_from(view, offset)
+    offset += HEADER.size
+
+    connection_id = None
+    if flags & FLAG_CONNECTION_ID:
+        if len(view) < offset + CONNECTION_ID_HEADER.size:
+            return None
+        (connection_id,) = CONNECTION_ID_HEADER.unpack_from(view, offset)
+        offset += CONNECTION_ID_HEADER.size
+
+    # A view into the datagram, so the payload is never copied while decoding.
+    payload = view[offset:]
+
+    if len(payload) != length:
+        return None
+
+    packet = _decode_binary_packet(flags, sequence, payload)
+    if packet is None:
+        return None
+
+    packet[CHECKSUM_ALGORITHM] = checksum_algorithm.name
+    if connection_id is not None:
+        packet[CONNECTION_ID] = connection_id
+    return packet
+
+
+def _decode_binary_packet(
+    flags: int, sequence: int, payload: memoryview
+) -> Optional[Dict]:
+    if flags & FLAG_ACK and flags & FLAG_EOF:
+        return {ACKNOWLEDGED: END_OF_FILE}
+
+    if flags & FLAG_ACK and flags & FLAG_HELLO:
+        if len(payload) != HELLO_ACK_HEADER.size:
+            return None
+
+        (max_datagram, receive_window) = HELLO_ACK_HEADER.unpack_from(payload)
+        return {
+            ACKNOWLEDGED: HELLO,
+            HELLO: sequence,
+            MAX_DATAGRAM: max_datagram,
+            RECEIVE_WINDOW: receive_window,
+        }
+
+    if flags & FLAG_ACK and flags & FLAG_PROBE:
+        if len(payload) != ACK_HEADER.size:
+            return None
+
+        (receive_window,) = ACK_HEADER.unpack_from(payload)
+        return {ACKNOWLEDGED: PROBE, PROBE: sequence, RECEIVE_WINDOW: receive_window}
+
+    if flags & FLAG_ACK:
+        if len(payload) < ACK_HEADER.size:
+            return None
+
+        (receive_window,) = ACK_HEADER.unpack_from(payload)
+        sack_blocks = _decode_sack_blocks(payload[ACK_HEADER.size :])
+        if sack_blocks is None:
+            return None
+
+        return {
+            ACKNOWLEDGED: sequence,
+            RECEIVE_WINDOW: receive_window,
+            SELECTIVE_ACKS: sack_blocks,
+        }
+
+    if flags & FLAG_CLOSE:
+        return {SEQUENCE_NUMBER: sequence, CLOSE: True}
+
+    if flags & FLAG_HELLO:
+        if len(payload) != HELLO_HEADER.size:
+            return None
+
+        (max_datagram,) = HELLO_HEADER.unpack_from(payload)
+        return {SEQUENCE_NUMBER: sequence, HELLO: max_datagram}
+
+    if flags & FLAG_PROBE:
+        return {SEQUENCE_NUMBER: sequence, PROBE: True}
+
+    if flags & FLAG_REPAIR:
+        if len(payload) < REPAIR_HEADER.size:
+            return None
+
+        (count, length_xor) = REPAIR_HEADER.unpack_from(payload)
+        return {
+            SEQUENCE_NUMBER: sequence,
+            REPAIR: count,
+            REPAIR_LENGTH: length_xor,
+            DATA: payload[REPAIR_HEADER.size :],
+            END_OF_FILE: False,
+        }
+
+    if flags & FLAG_COMPRESSED:
+        payload = compression.inflate(payload)
+        if payload is None:
+            return None
+
+    return {
+        SEQUENCE_NUMBER: sequence,
+        DATA: payload,
+        END_OF_FILE: bool(flags & FLAG_EOF),
+    }
+
+
+def _decode_json(view: memoryview) -> Optional[Dict]:
+    if view[: len(JSON_PREFIX)] != JSON_PREFIX:
+        return None
+
+    try:
+        packet = json.loads(bytes(view).decode())
+        digest = bytes.fromhex(packet[CHECKSUM])
+        checksum_algorithm = checksum.ALGORITHMS[packet[CHECKSUM_ALGORITHM]]
+    except (KeyError, TypeError, ValueError):
+        return None
+
+    if not isinstance(packet, dict) or len(digest) != checksum_algorithm.size:
+        return None
+
+    offset = len(JSON_PREFIX) + 2 * checksum_algorithm.size + len(JSON_SEPARATOR)
+    if not checksum.verify_checksum(view[offset:], digest, checksum_algorithm.name):
+        return None
+
+    try:
+        if DATA in packet:
+            packet[DATA] = b64decode(packet[DATA].encode())
+            if packet.get(COMPRESSED):
+                packet[DATA] = compression.inflate(packet[DATA])
+                if packet[DATA] is None:
+                    return None
+        if CONNECTION_ID in packet:
+            packet[CONNECTION_ID] = int(packet[CONNECTION_ID])
+        if REPAIR in packet:
+            packet[REPAIR] = int(packet[REPAIR])
+            packet[REPAIR_LENGTH] = int(packet[REPAIR_LENGTH])
+        if HELLO in packet:
+            packet[HELLO] = int(packet[HELLO])
+        if MAX_DATAGRAM in packet:
+            packet[MAX_DATAGRAM] = int(packet[MAX_DATAGRAM])
+        if ACKNOWLEDGED in packet and packet[ACKNOWLEDGED] != END_OF_FILE:
+            packet[RECEIVE_WINDOW] = int(packet[RECEIVE_WINDOW])
+            packet[SELECTIVE_ACKS] = [
+                (int(start), int(end))
+                for (start, end) in packet.get(SELECTIVE_ACKS, [])
+            ]
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+    return packet
+
+
+def decode(datagram: bytes) -> Optional[Dict]:
+    """
+    Decodes a received datagram in either format into a packet dict, with any
+    payload as a bytes-like object, decompressed if it was sent compressed.
+
+    Returns None if the datagram is corrupted or can't be parsed.
+    """
+
+    view = memoryview(datagram)
+
+    if wire_format(datagram) == BINARY:
+        return _decode_binary(view)
+    return _decode_json(view)
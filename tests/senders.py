@@ -0,0 +1,58 @@
+import time
+from queue import Queue
+from threading import RLock
+from typing import NamedTuple
+
+from src import congestion
+from src.microbench import ADDRESS, MESSAGE_SIZE, NullIO, datagrams
+from src.pacing import Pacer
+from src.recovery import LossRecovery
+from src.rtt import RttEstimator
+from src.scheduler import SendScheduler
+from src.send_buffer import SendBuffer
+from src.socket_reader import SocketReader
+from src.timers import TimerQueue
+
+
+class Sender(NamedTuple):
+    socket_reader: SocketReader
+    outstanding_packets: dict
+    timers: TimerQueue
+    rtt: RttEstimator
+
+
+def sender_with_packets_in_flight(count: int) -> Sender:
+    """
+    A socket reader, and what it shares with the rest of the sender, with
+    packets 1 to count sent just now and waiting for their acks.
+    """
+
+    send_buffer = SendBuffer()
+    outstanding_packets = {}
+    timers = TimerQueue()
+    now = time.monotonic()
+    for (pn, datagram) in datagrams(count).items():
+        send_buffer.add(pn, datagram, block=False)
+        outstanding_packets[pn] = (datagram, now)
+        timers.schedule(pn, now + 1)
+
+    rtt = RttEstimator()
+    recovery = LossRecovery(rtt, timers)
+    recovery.on_sent(list(outstanding_packets), [], now)
+    socket_reader = SocketReader(
+        sock=None,
+        packets_to_send=SendScheduler(),
+        send_buffer=send_buffer,
+        outstanding_packets=outstanding_packets,
+        outstanding_packets_lock=RLock(),
+        timeout_messagebox=Queue(maxsize=1),
+        destination=ADDRESS,
+        message_size=MESSAGE_SIZE,
+        congestion=congestion.create_controller(congestion.NEWRENO),
+        rtt=rtt,
+        timers=timers,
+        datagram_io=NullIO(),
+        pacer=Pacer(),
+        recovery=recovery,
+    )
+    return Sender(socket_reader, outstanding_packets, timers, rtt)
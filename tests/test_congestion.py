@@ -0,0 +1,29 @@
+from src.congestion import MINIMUM_WINDOW, Cubic, NewReno
+
+
+def test_timeout_collapses_window():
+    congestion = NewReno(initial_window=40)
+    congestion.highest_sent = 40
+
+    congestion.on_loss(5, timeout=True)
+
+    # The threshold is halved as for any other loss, but the window starts
+    # again from the minimum.
+    assert congestion.ssthresh == 20
+    assert congestion.cwnd == MINIMUM_WINDOW
+
+
+def test_timeout_within_loss_episode():
+    congestion = Cubic(initial_window=40)
+    congestion.highest_sent = 40
+
+    congestion.on_loss(5, timeout=False)
+    assert congestion.cwnd == 28
+    congestion.on_loss(6, timeout=False)
+    assert congestion.cwnd == 28
+
+    # The retransmission timing out as well means recovery has stalled: the
+    # window collapses, but the threshold isn't reduced a second time.
+    congestion.on_loss(7, timeout=True)
+    assert congestion.ssthresh == 28
+    assert congestion.cwnd == MINIMUM_WINDOW
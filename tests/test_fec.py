@@ -0,0 +1,65 @@
+from typing import Dict, List
+
+from src import wire
+from src.constants import DATA, REPAIR, REPAIR_LENGTH, SEQUENCE_NUMBER
+from src.fec import FecDecoder, FecEncoder
+from src.reorder_buffer import ReorderBuffer
+
+DATA_SIZE = 64
+# Payloads of different lengths, so the lengths have to be rebuilt too.
+PAYLOADS = [b"first", b"second packet", b"third", b"and the fourth one"]
+
+
+def encode_group() -> Dict:
+    encoder = FecEncoder(DATA_SIZE)
+    # Enough loss for groups of four.
+    encoder.loss_rate = 1 / 8
+    assert encoder.group_size == len(PAYLOADS)
+
+    repairs = [
+        encoder.add(pn, wire.encode_data(pn, payload, eof=False))
+        for (pn, payload) in enumerate(PAYLOADS, 1)
+    ]
+    assert repairs[:-1] == [None] * (len(PAYLOADS) - 1)
+    return wire.decode(repairs[-1])
+
+
+def receive(buffer: ReorderBuffer, pns: List[int]):
+    for pn in pns:
+        if pn == buffer.hcp + 1:
+            buffer.advance()
+            buffer.keep(pn, PAYLOADS[pn - 1])
+        else:
+            buffer.store(pn, PAYLOADS[pn - 1])
+
+
+def test_rebuild_single_loss():
+    repair = encode_group()
+    buffer = ReorderBuffer(16, DATA_SIZE)
+    decoder = FecDecoder(buffer)
+
+    receive(buffer, [1, 2, 4])
+    recovered = decoder.on_repair(
+        repair[SEQUENCE_NUMBER], repair[REPAIR], repair[REPAIR_LENGTH], repair[DATA]
+    )
+
+    assert recovered == (3, PAYLOADS[2])
+
+
+def test_two_losses():
+    repair = encode_group()
+    buffer = ReorderBuffer(16, DATA_SIZE)
+    decoder = FecDecoder(buffer)
+
+    receive(buffer, [1, 4])
+    # One repair packet can't make up for two lost packets.
+    recovered = decoder.on_repair(
+        repair[SEQUENCE_NUMBER], repair[REPAIR], repair[REPAIR_LENGTH], repair[DATA]
+    )
+    assert recovered is None
+
+    # But it's kept, so once one of them is retransmitted, the other can be
+    # rebuilt.
+    receive(buffer, [3])
+    assert decoder.on_data(3) == (2, PAYLOADS[1])
+    assert decoder.pending == {}
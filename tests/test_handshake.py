@@ -0,0 +1,103 @@
+import io
+import socket
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Tuple
+
+import pytest
+
+from src import handshake, wire
+from src.datagram_io import MAX_UDP_PAYLOAD, DatagramIO
+from src.receiver import Receiver
+
+# As 4254recv and 4254send have them.
+MSG_SIZE = 1500
+DATA_SIZE = 1000
+CONNECTION_ID = 0xF45238E3
+
+
+@contextmanager
+def receiver(max_datagram: int) -> Iterator[Tuple[Receiver, Tuple[str, int]]]:
+    """
+    Runs a receiver on loopback that answers hellos and probes, taking
+    datagrams of up to max_datagram bytes, until the block is done.
+    """
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        sock.settimeout(0.01)
+        recv = Receiver(
+            sock,
+            MSG_SIZE,
+            output=io.BytesIO(),
+            datagram_io=DatagramIO(sock, max_datagram),
+        )
+        done = threading.Event()
+
+        def answer():
+            while not done.is_set():
+                try:
+                    received = recv.datagram_io.recv_batch()
+                except (BlockingIOError, TimeoutError):
+                    continue
+                for data, address in received:
+                    packet = wire.decode(data)
+                    if packet is not None:
+                        recv.handle_packet(packet, data, address)
+                recv.flush()
+
+        thread = threading.Thread(target=answer)
+        thread.start()
+        try:
+            yield (recv, sock.getsockname())
+        finally:
+            done.set()
+            thread.join()
+
+
+def negotiate(destination, probe: bool = True) -> handshake.Negotiated:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        return handshake.negotiate(
+            sock,
+            DatagramIO(sock, MAX_UDP_PAYLOAD),
+            destination,
+            DATA_SIZE,
+            connection_id=CONNECTION_ID,
+            probe=probe,
+        )
+
+
+def test_hello_without_probing():
+    with receiver(MAX_UDP_PAYLOAD) as (recv, destination):
+        negotiated = negotiate(destination, probe=False)
+
+    assert negotiated.data_size == DATA_SIZE
+    assert negotiated.receive_window == recv.receive_window
+    assert negotiated.rtt is not None
+
+
+@pytest.mark.parametrize("max_datagram", [1472, 4000, MAX_UDP_PAYLOAD])
+def test_probes_up_to_what_the_receiver_takes(max_datagram: int):
+    with receiver(max_datagram) as (recv, destination):
+        negotiated = negotiate(destination)
+
+        # Loopback carries datagrams as big as UDP goes, so the receiver's
+        # limit is what stops the probes.
+        assert negotiated.data_size == wire.max_payload(
+            max_datagram, connection_id=CONNECTION_ID
+        )
+        # The receiver made room for packets that big, if it had to, shrinking
+        # its window to keep its buffer the same size, and told the sender so.
+        assert recv.reorder_buffer.slot_size >= max_datagram
+        assert negotiated.receive_window == recv.receive_window
+
+
+def test_no_answer(monkeypatch):
+    monkeypatch.setattr(handshake, "HANDSHAKE_TIMEOUT", 0.2)
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as silent:
+        silent.bind(("127.0.0.1", 0))
+        negotiated = negotiate(silent.getsockname())
+
+    # Going ahead as if the receiver knew nothing of handshakes.
+    assert negotiated == handshake.Negotiated(DATA_SIZE)
@@ -0,0 +1,17 @@
+from src import wire
+from src.recovery import RECOVERY_TIMER
+from tests.senders import sender_with_packets_in_flight
+
+
+def test_recovery_timer_survives_first_cumulative_ack():
+    sender = sender_with_packets_in_flight(4)
+
+    # A SACK for packet 2 arms the recovery timer before anything has been
+    # acked cumulatively...
+    sender.socket_reader.handle_ack(wire.encode_ack(0, sack_blocks=[(2, 2)]))
+    assert sender.timers.deadline(RECOVERY_TIMER) is not None
+
+    # ...and the first cumulative ack, which cancels the timers of the packets
+    # it acks from 0 up, mustn't cancel it for good.
+    sender.socket_reader.handle_ack(wire.encode_ack(1, sack_blocks=[(2, 2)]))
+    assert sender.timers.deadline(RECOVERY_TIMER) is not None
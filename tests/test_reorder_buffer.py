@@ -0,0 +1,79 @@
+import io
+import socket
+
+from src import wire
+from src.receiver import Receiver
+from src.reorder_buffer import ReorderBuffer
+
+CAPACITY = 4
+
+
+def test_wraparound():
+    buffer = ReorderBuffer(CAPACITY, 16)
+
+    # Take the hcp most of the way round the ring, so that the packets stored
+    # next land in slots that have been used before.
+    for pn in range(1, 7):
+        buffer.advance()
+        buffer.keep(pn, b"old")
+
+    for pn in (8, 9, 10):
+        buffer.store(pn, bytes([pn]))
+    assert buffer.sack_blocks(3) == [(8, 10)]
+    assert 9 in buffer
+    assert 11 not in buffer
+
+    assert [bytes(payload) for payload in buffer.advance()] == [
+        bytes([8]),
+        bytes([9]),
+        bytes([10]),
+    ]
+    assert buffer.hcp == 10
+    assert buffer.sack_blocks(3) == []
+
+    # Slots freed by advancing hold nothing as far as the next lap goes.
+    assert 12 not in buffer
+    assert 13 not in buffer
+    # But they keep their payloads until they're reused, for FEC.
+    assert bytes(buffer.payload(9)) == bytes([9])
+    assert buffer.payload(5) is None
+
+
+def test_duplicates():
+    buffer = ReorderBuffer(CAPACITY, 16)
+    buffer.advance()
+    buffer.store(3, b"c")
+
+    # Everything up to the hcp counts as received, however long ago.
+    assert 1 in buffer
+    assert 3 in buffer
+    assert 2 not in buffer
+
+
+def test_duplicates_beyond_the_window():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        address = sock.getsockname()
+        output = io.BytesIO()
+        receiver = Receiver(sock, 1500, receive_window=CAPACITY, output=output)
+
+        def receive(pn: int, data: bytes):
+            datagram = wire.encode_data(pn, data, eof=False)
+            receiver.handle_packet(wire.decode(datagram), datagram, address)
+
+        receive(3, b"c")
+        # Shares packet 3's slot, but is past the window: it must be dropped
+        # rather than taken for a duplicate of it, or for a packet received.
+        receive(3 + CAPACITY, b"x")
+        assert receiver.reorder_buffer.sack_blocks(2) == [(3, 3)]
+        receive(1, b"a")
+        receive(2, b"b")
+        receiver.flush()
+
+        assert output.getvalue() == b"abc"
+        assert receiver.hcp == 3
+        assert 3 + CAPACITY not in receiver.reorder_buffer
+
+        # Once the window has moved, the same packet is accepted.
+        receive(3 + CAPACITY, b"x")
+        assert receiver.reorder_buffer.sack_blocks(1) == [(7, 7)]
@@ -0,0 +1,23 @@
+from src.rtt import CLOCK_GRANULARITY, K, RttEstimator
+
+
+def test_rto_includes_ack_delay():
+    rtt = RttEstimator(min_rto=0, max_ack_delay=0.02)
+
+    rtt.on_ack(1, 1, 0.1)
+
+    # SRTT is the first sample and RTTVAR half of it, as in RFC 6298, and the
+    # receiver may hold the ack back for up to max_ack_delay on top.
+    assert rtt.rto == 0.1 + max(CLOCK_GRANULARITY, K * 0.05) + 0.02
+
+
+def test_steady_rtt_leaves_room_for_delayed_ack():
+    rtt = RttEstimator(min_rto=0, max_ack_delay=0.02)
+
+    for pn in range(1, 200):
+        rtt.on_ack(pn, pn, 0.1)
+
+    # RTTVAR has all but vanished, but a packet whose ack was delayed still
+    # doesn't time out.
+    assert rtt.rto >= 0.1 + 0.02
+    assert rtt.rto < 0.1 + 0.02 + 2 * CLOCK_GRANULARITY
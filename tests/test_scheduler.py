@@ -0,0 +1,44 @@
+from queue import Empty
+
+import pytest
+
+from src.scheduler import SendScheduler
+
+
+def test_requeued_packets_are_dropped_once_delivered():
+    scheduler = SendScheduler()
+    for pn in range(1, 5):
+        scheduler.add_new(pn, bytes([pn]))
+    taken = [scheduler.get_nowait() for _ in range(4)]
+
+    # None of them could be sent after all, and by the time there's room,
+    # packet 2 has been acked cumulatively, and packet 4 SACKed.
+    scheduler.requeue(taken)
+    assert scheduler.on_delivered(2, [4]) == 0
+
+    assert scheduler.get_nowait() == (3, bytes([3]))
+    with pytest.raises(Empty):
+        scheduler.get_nowait()
+
+
+def test_requeued_packet_isnt_queued_for_retransmission_again():
+    scheduler = SendScheduler()
+    scheduler.add_new(1, b"1")
+    scheduler.requeue([scheduler.get_nowait()])
+
+    assert not scheduler.add_retransmission(1, b"1")
+    assert scheduler.get_nowait() == (1, b"1")
+    with pytest.raises(Empty):
+        scheduler.get_nowait()
+
+
+def test_requeue_skips_packets_queued_for_retransmission():
+    scheduler = SendScheduler()
+    scheduler.add_new(1, b"1")
+    taken = scheduler.get_nowait()
+    assert scheduler.add_retransmission(1, b"1 again")
+
+    scheduler.requeue([taken])
+    assert scheduler.get_nowait() == (1, b"1 again")
+    with pytest.raises(Empty):
+        scheduler.get_nowait()
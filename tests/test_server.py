@@ -0,0 +1,100 @@
+import os
+import socket
+
+from src import wire
+from src.constants import (
+    ACKNOWLEDGED,
+    CONNECTION_ID as CONNECTION_ID_FIELD,
+    END_OF_FILE,
+)
+from src.server import PARTIAL_SUFFIX, ReceiverServer, connection_name
+
+CONNECTION_ID = 0xF45238E3
+
+
+def serve(server: ReceiverServer, sender: socket.socket, datagrams):
+    address = server.sock.getsockname()
+    for datagram in datagrams:
+        sender.sendto(datagram, address)
+        server._ReceiverServer__serve_once()
+
+
+def test_late_packet_after_close(tmp_path):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock, socket.socket(
+        socket.AF_INET, socket.SOCK_DGRAM
+    ) as sender:
+        sock.bind(("127.0.0.1", 0))
+        server = ReceiverServer(sock, 1500, str(tmp_path))
+
+        first = wire.encode_data(1, b"hello", eof=False, connection_id=CONNECTION_ID)
+        serve(
+            server,
+            sender,
+            [
+                first,
+                wire.encode_data(2, b"", eof=True, connection_id=CONNECTION_ID),
+                wire.encode_close(connection_id=CONNECTION_ID),
+                # Duplicated, or held up on the way.
+                first,
+            ],
+        )
+
+        path = tmp_path / connection_name(CONNECTION_ID)
+        assert path.read_bytes() == b"hello"
+        assert os.listdir(tmp_path) == [path.name]
+        assert not os.path.exists(str(path) + PARTIAL_SUFFIX)
+
+
+def test_interleaved_connections(tmp_path):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock, socket.socket(
+        socket.AF_INET, socket.SOCK_DGRAM
+    ) as sender, socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as other_sender:
+        sock.bind(("127.0.0.1", 0))
+        sender.bind(("127.0.0.1", 0))
+        other_sender.bind(("127.0.0.1", 0))
+        server = ReceiverServer(sock, 1500, str(tmp_path))
+        other_id = CONNECTION_ID + 1
+
+        def data(pn: int, payload: bytes, connection_id: int) -> bytes:
+            return wire.encode_data(pn, payload, eof=False, connection_id=connection_id)
+
+        # Two connections from the same socket, told apart only by their IDs,
+        # with packets interleaved and out of order.
+        serve(
+            server,
+            sender,
+            [
+                data(1, b"one ", CONNECTION_ID),
+                data(2, b"four", other_id),
+                data(2, b"two", CONNECTION_ID),
+                data(1, b"three ", other_id),
+                wire.encode_data(3, b"", eof=True, connection_id=other_id),
+            ],
+        )
+        # And one without an ID, known by its address.
+        serve(server, other_sender, [wire.encode_data(1, b"five", eof=False)])
+        serve(
+            server,
+            sender,
+            [wire.encode_data(3, b"", eof=True, connection_id=CONNECTION_ID)],
+        )
+        serve(server, other_sender, [wire.encode_data(2, b"", eof=True)])
+
+        assert (tmp_path / connection_name(CONNECTION_ID)).read_bytes() == b"one two"
+        assert (tmp_path / connection_name(other_id)).read_bytes() == b"three four"
+        other_name = connection_name(other_sender.getsockname())
+        assert (tmp_path / other_name).read_bytes() == b"five"
+        assert not any(name.endswith(PARTIAL_SUFFIX) for name in os.listdir(tmp_path))
+
+        # Each connection's acks carry its own ID.
+        sender.settimeout(0.1)
+        eof_acked = set()
+        try:
+            while True:
+                ack = wire.decode(sender.recv(1500))
+                assert ack[CONNECTION_ID_FIELD] in (CONNECTION_ID, other_id)
+                if ack[ACKNOWLEDGED] == END_OF_FILE:
+                    eof_acked.add(ack[CONNECTION_ID_FIELD])
+        except socket.timeout:
+            pass
+        assert eof_acked == {CONNECTION_ID, other_id}
@@ -0,0 +1,30 @@
+import time
+
+from src import wire
+from tests.senders import sender_with_packets_in_flight
+
+
+def test_sack_rtt_sample_is_checked_against_its_own_packet():
+    sender = sender_with_packets_in_flight(3)
+
+    # Packet 2 was sent 100ms ago; packet 3 was presumed lost, and is queued
+    # to be sent again, so it's no longer in flight.
+    (datagram, _) = sender.outstanding_packets[2]
+    sender.outstanding_packets[2] = (datagram, time.monotonic() - 0.1)
+    del sender.outstanding_packets[3]
+    sender.rtt.on_retransmit(3)
+
+    # Only packet 2 gives a sample, and it was only sent once, so Karn's rule
+    # doesn't throw it away because packet 3 was retransmitted.
+    sender.socket_reader.handle_ack(wire.encode_ack(0, sack_blocks=[(2, 3)]))
+    assert sender.rtt.srtt is not None
+    assert 0.1 <= sender.rtt.srtt < 0.5
+
+
+def test_sack_without_rtt_sample():
+    sender = sender_with_packets_in_flight(2)
+    del sender.outstanding_packets[2]
+    sender.rtt.on_retransmit(2)
+
+    sender.socket_reader.handle_ack(wire.encode_ack(0, sack_blocks=[(2, 2)]))
+    assert sender.rtt.srtt is None
@@ -0,0 +1,65 @@
+import time
+from threading import RLock, Thread
+
+from src import congestion
+from src.fec import FecEncoder
+from src.microbench import ADDRESS, DATA_SIZE, NullIO, datagrams
+from src.pacing import Pacer
+from src.recovery import LossRecovery
+from src.rtt import RttEstimator
+from src.scheduler import SendScheduler
+from src.socket_writer import SocketWriter
+from src.timers import TimerQueue
+
+
+class PartialIO(NullIO):
+    """
+    Only ever sends the first datagram of a batch, as the batched backends do
+    when the socket's buffer fills up right after it.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    def send_batch(self, datagrams, address) -> int:
+        self.sent.append(datagrams[0])
+        return 1
+
+
+def test_partial_send_batch():
+    packets_to_send = SendScheduler()
+    packets = datagrams(50)
+    for (pn, datagram) in packets.items():
+        packets_to_send.add_new(pn, datagram)
+
+    timers = TimerQueue()
+    rtt = RttEstimator()
+    datagram_io = PartialIO()
+    outstanding_packets = {}
+    socket_writer = SocketWriter(
+        sock=None,
+        packets_to_send=packets_to_send,
+        outstanding_packets=outstanding_packets,
+        outstanding_packets_lock=RLock(),
+        destination=ADDRESS,
+        congestion=congestion.create_controller(congestion.NONE),
+        rtt=rtt,
+        timers=timers,
+        datagram_io=datagram_io,
+        pacer=Pacer(enabled=False),
+        fec=FecEncoder(DATA_SIZE, enabled=False),
+        recovery=LossRecovery(rtt, timers),
+    )
+    thread = Thread(target=socket_writer.run)
+    thread.start()
+
+    deadline = time.monotonic() + 5
+    while len(packets_to_send) > 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    packets_to_send.quit()
+    thread.join()
+
+    # Every packet went out, in order, and is in flight.
+    assert datagram_io.sent == list(packets.values())
+    assert sorted(outstanding_packets) == sorted(packets)
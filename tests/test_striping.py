@@ -0,0 +1,91 @@
+import io
+import os
+import tempfile
+from typing import BinaryIO, List, Sequence
+
+import pytest
+
+from src.striping import mappable_size, reassemble, stripe_ranges
+
+
+@pytest.mark.parametrize("size", [0, 1, 999, 1000, 1001, 12345])
+@pytest.mark.parametrize("stripes", [1, 2, 3, 7])
+def test_stripe_ranges(size: int, stripes: int):
+    alignment = 100
+    ranges = stripe_ranges(size, stripes, alignment)
+
+    assert len(ranges) == stripes
+    # Consecutive, covering everything exactly once.
+    assert ranges[0][0] == 0
+    assert ranges[-1][1] == size
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start
+    # No packet straddles two stripes.
+    for start, _ in ranges:
+        assert start % alignment == 0 or start == size
+    # As even as whole packets allow.
+    lengths = [end - start for (start, end) in ranges]
+    assert max(lengths) <= -(-size // (stripes * alignment)) * alignment
+
+
+def test_mappable_size(tmp_path):
+    path = tmp_path / "input"
+    path.write_bytes(b"x" * 1000)
+
+    with open(path) as stream:
+        assert mappable_size(stream) == 1000
+        # Part of it has been read already, so it can't be split from the start.
+        stream.buffer.raw.read(1)
+        assert mappable_size(stream) is None
+
+    read_end, write_end = os.pipe()
+    with os.fdopen(read_end) as pipe, os.fdopen(write_end, "w"):
+        assert mappable_size(pipe) is None
+
+    assert mappable_size(io.StringIO("not a file")) is None
+
+
+def workers(exit_codes: Sequence[int]) -> List[int]:
+    """
+    Stands in for the receiver's stripe workers: processes that just exit
+    with the given codes, for reassemble to wait for.
+    """
+
+    pids = []
+    for code in exit_codes:
+        pid = os.fork()
+        if pid == 0:
+            os._exit(code)
+        pids.append(pid)
+    return pids
+
+
+def stripe_outputs(output: BinaryIO, count: int) -> List[BinaryIO]:
+    outputs = [output]
+    for index in range(1, count):
+        stripe_output = tempfile.TemporaryFile()
+        stripe_output.write(f"stripe {index} ".encode())
+        outputs.append(stripe_output)
+    return outputs
+
+
+def test_reassemble():
+    output = io.BytesIO(b"stripe 0 ")
+    output.seek(0, io.SEEK_END)
+
+    assert reassemble(workers([0, 0, 0]), stripe_outputs(output, 3), output) == 0
+    assert output.getvalue() == b"stripe 0 stripe 1 stripe 2 "
+
+
+def test_reassemble_failed_stripe():
+    output = io.BytesIO(b"stripe 0 ")
+    output.seek(0, io.SEEK_END)
+
+    outputs = stripe_outputs(output, 3)
+
+    # Stripe 2 would only go after a hole, so it isn't copied.
+    assert reassemble(workers([0, 3, 0]), outputs, output) == 3
+    assert output.getvalue() == b"stripe 0 "
+
+    for stripe_output in outputs[1:]:
+        stripe_output.close()
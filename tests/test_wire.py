@@ -0,0 +1,69 @@
+import pytest
+
+from src import checksum, wire
+from src.constants import (
+    ACKNOWLEDGED,
+    CHECKSUM_ALGORITHM,
+    CONNECTION_ID,
+    DATA,
+    END_OF_FILE,
+    RECEIVE_WINDOW,
+    SELECTIVE_ACKS,
+    SEQUENCE_NUMBER,
+)
+
+CONNECTION_ID_VALUE = 0xF45238E3
+
+every_encoding = pytest.mark.parametrize(
+    ("fmt", "algorithm"),
+    [(fmt, algorithm) for fmt in wire.FORMATS for algorithm in checksum.ALGORITHMS],
+)
+
+
+@every_encoding
+def test_data_round_trip(fmt: str, algorithm: str):
+    datagram = wire.encode_data(
+        7,
+        bytes(range(256)),
+        eof=False,
+        fmt=fmt,
+        algorithm=algorithm,
+        connection_id=CONNECTION_ID_VALUE,
+    )
+    assert wire.wire_format(datagram) == fmt
+
+    packet = wire.decode(datagram)
+    assert packet[SEQUENCE_NUMBER] == 7
+    assert bytes(packet[DATA]) == bytes(range(256))
+    assert not packet[END_OF_FILE]
+    assert packet[CHECKSUM_ALGORITHM] == algorithm
+    assert packet[CONNECTION_ID] == CONNECTION_ID_VALUE
+    assert bytes(wire.data_payload(datagram)) == bytes(range(256))
+
+
+@every_encoding
+def test_ack_round_trip(fmt: str, algorithm: str):
+    datagram = wire.encode_ack(
+        5, fmt, algorithm, sack_blocks=[(9, 12), (7, 7)], receive_window=64
+    )
+
+    packet = wire.decode(datagram)
+    assert packet[ACKNOWLEDGED] == 5
+    assert packet[RECEIVE_WINDOW] == 64
+    assert [tuple(block) for block in packet[SELECTIVE_ACKS]] == [(9, 12), (7, 7)]
+
+    eof_ack = wire.decode(wire.encode_ack(END_OF_FILE, fmt, algorithm))
+    assert eof_ack[ACKNOWLEDGED] == END_OF_FILE
+
+
+@every_encoding
+def test_corruption_is_rejected(fmt: str, algorithm: str):
+    datagram = wire.encode_data(3, b"some data", eof=False, fmt=fmt, algorithm=algorithm)
+
+    for offset in range(len(datagram)):
+        corrupted = bytearray(datagram)
+        corrupted[offset] ^= 0x01
+        assert wire.decode(bytes(corrupted)) is None, offset
+
+    for length in range(len(datagram)):
+        assert wire.decode(datagram[:length]) is None, length